@@ -0,0 +1,305 @@
+"""
+Benchmark of the intraday day-type classification used by the futures gap scans.
+
+Runs the vectorized classification in maintainHistoricalData_futures and the row-wise implementation
+it replaced (kept below for comparison only) over every futures table in the lookup table, checks that
+both find the same incomplete dates and short sessions, and prints the time each one took.
+
+Usage:
+    python benchmark_day_types.py [db path]         defaults to config.dbname_futures
+"""
+from datetime import datetime
+from rich import print
+from sys import argv
+
+import time
+
+import numpy as np
+import pandas as pd
+
+import config
+import interface_localDB as db
+import maintainHistoricalData_futures as futures
+
+##################### row-wise reference implementation
+def _rowwise_build_schedule_day_type_map(schedule):
+    """
+        Classifies schedule sessions with shortened regular trading hours.
+        Note: exchange_calendars captures regular trading sessions, so this only
+        identifies shortened RTH days. Evening-only behavior is inferred from
+        observed bars in _build_intraday_day_type_counts.
+    """
+    if schedule.empty:
+        return {}
+
+    open_col, close_col = futures._get_schedule_open_close_columns(schedule)
+    if (open_col is None) or (close_col is None):
+        return {}
+
+    session_df = schedule[[open_col, close_col]].copy()
+
+    # convert open and close columns to est 
+    session_df[open_col] = pd.to_datetime(session_df[open_col], utc=True).dt.tz_convert('US/Eastern')
+    session_df[close_col] = pd.to_datetime(session_df[close_col], utc=True).dt.tz_convert('US/Eastern')
+
+    # adjust close to be 1h before current close 
+    # session_df[close_col] = session_df[close_col] - pd.Timedelta(minutes=60)
+
+    session_df['trade_date'] = pd.to_datetime(session_df.index).date
+    session_df['session_minutes'] = (session_df[close_col] - session_df[open_col]).dt.total_seconds() / 60.0
+
+    session_df['weekday'] = pd.to_datetime(session_df['trade_date']).dt.weekday
+
+
+    weekday_minutes = session_df.loc[session_df['weekday'] < 5, 'session_minutes']
+    if weekday_minutes.empty:
+        return {}
+
+    regular_baseline_minutes = float(np.nanmedian(weekday_minutes.to_numpy()))
+    short_ratio = float(getattr(config, 'exchange_calendar_short_session_ratio', 0.85))
+    day_type_map = {}
+
+    for row in session_df.itertuples(index=False):
+        if pd.isna(row.session_minutes):
+            continue
+
+        is_short = float(row.session_minutes) < (regular_baseline_minutes * short_ratio)
+        if not is_short:
+            continue
+
+        day_type_map[row.trade_date] = 'holiday_reduced_hours'
+    
+    return day_type_map
+
+def _rowwise_time_to_minutes(value):
+    """
+        Converts HH:MM[:SS] or datetime-like value to minutes from midnight.
+    """
+    if pd.isna(value):
+        return None
+    value = str(value)
+    if ' ' in value:
+        value = value.split(' ')[-1]
+    parts = value.split(':')
+    if len(parts) < 2:
+        return None
+    try:
+        return (int(parts[0]) * 60) + int(parts[1])
+    except Exception:
+        return None
+
+def _rowwise_build_intraday_day_type_counts(daily_counts: pd.DataFrame, schedule_day_type_map, last_trade_date):
+    """
+        Classifies weekday daily bar counts into day types, combining:
+        1) schedule-derived shortened RTH days, and
+        2) observed all-hours bar shape for evening-dominant sessions.
+    """
+    if daily_counts.empty:
+        return pd.DataFrame(columns=['trade_date', 'daily_count', 'first_bar_time', 'last_bar_time', 'session_span_minutes', 'day_type'])
+
+    typed = daily_counts.copy()
+    typed['trade_date'] = pd.to_datetime(typed['trade_date']).dt.date
+    typed = typed.loc[pd.to_datetime(typed['trade_date']).dt.weekday < 5].copy()
+    if typed.empty:
+        return typed.assign(day_type=pd.Series(dtype='object'))
+
+    if 'first_bar_time' not in typed.columns:
+        typed['first_bar_time'] = None
+    if 'last_bar_time' not in typed.columns:
+        typed['last_bar_time'] = None
+    if 'session_span_minutes' not in typed.columns:
+        typed['session_span_minutes'] = np.nan
+
+    typed['day_type'] = 'regular_weekday'
+    typed.loc[pd.to_datetime(typed['trade_date']).dt.weekday == 4, 'day_type'] = 'friday'
+
+    typed['day_type'] = typed.apply(
+        lambda row: schedule_day_type_map.get(row['trade_date'], row['day_type']),
+        axis=1
+    )
+
+    # exchange_calendars defines regular-hours sessions only; infer evening-only
+    # from observed all-hours bars when a shortened RTH day starts in evening.
+    evening_open_minute = int(getattr(config, 'exchange_calendar_evening_open_minute_utc', 15 * 60))
+    first_minutes = typed['first_bar_time'].apply(_rowwise_time_to_minutes)
+    evening_only_mask = (
+        (typed['day_type'] == 'holiday_reduced_hours')
+        & first_minutes.notnull()
+        & (first_minutes >= evening_open_minute)
+    )
+    typed.loc[evening_only_mask, 'day_type'] = 'holiday_evening_only'
+
+    if last_trade_date is not None:
+        typed.loc[typed['trade_date'] == last_trade_date, 'day_type'] = 'last_trade_date'
+    return typed
+
+def _rowwise_compute_intraday_expected_counts_by_day_type(typed_counts: pd.DataFrame, min_samples=3):
+    """
+        Builds robust expected bar-count baselines per day type.
+    """
+    if typed_counts.empty:
+        return {}, 0
+
+    def _p80(series):
+        if series.empty:
+            return 0
+        return int(round(float(np.percentile(series.to_numpy(), 80))))
+
+    weekday_counts = typed_counts['daily_count']
+    weekday_baseline = _p80(weekday_counts)
+
+    holiday_counts_reduced = typed_counts.loc[
+        typed_counts['day_type'].isin(['holiday_reduced_hours']),
+        'daily_count'
+    ]
+
+    holiday_counts_evenings = typed_counts.loc[
+        typed_counts['day_type'].isin(['holiday_evening_only']),
+        'daily_count'
+    ]
+
+    holiday_baseline_reduced = _p80(holiday_counts_reduced) if not holiday_counts_reduced.empty else 0
+    holiday_baseline_evening = _p80(holiday_counts_evenings) if not holiday_counts_evenings.empty else 0
+
+    expected_by_type = {}
+    for day_type in ['regular_weekday', 'friday', 'holiday_reduced_hours', 'holiday_evening_only', 'last_trade_date']:
+        series = typed_counts.loc[typed_counts['day_type'] == day_type, 'daily_count']
+        if day_type == 'holiday_evening_only':
+            sparse_fallback = holiday_baseline_evening if holiday_baseline_evening > 0 else int(round(weekday_baseline * 0.25))
+        elif day_type == 'holiday_reduced_hours':
+            sparse_fallback = holiday_baseline_reduced if holiday_baseline_reduced > 0 else int(round(weekday_baseline * 0.75))
+        else:
+            sparse_fallback = weekday_baseline
+        
+        if len(series) >= min_samples:
+            baseline = _p80(series)
+        elif len(series) > 0:
+            median_count = int(round(float(series.median())))
+            if sparse_fallback > 0:
+                baseline = max(median_count, int(round(sparse_fallback * 0.9)))
+            else:
+                baseline = median_count
+        else:
+            baseline = sparse_fallback
+
+        if baseline < 0:
+            baseline = 0
+        expected_by_type[day_type] = baseline
+
+    return expected_by_type, weekday_baseline
+
+def _rowwise_intraday_min_acceptable_count(expected_count, day_type):
+    """
+        Returns minimum acceptable bar count before a day is treated as incomplete.
+    """
+    tolerance_by_type = {
+        'regular_weekday': (0.10, 2),
+        'friday': (0.15, 2),
+        'holiday_reduced_hours': (0.20, 2),
+        'holiday_evening_only': (0.25, 2),
+        'last_trade_date': (0.25, 2),
+    }
+
+    expected_count = int(expected_count)
+    if expected_count <= 0:
+        return 0
+
+    tolerance_ratio, min_abs_tolerance = tolerance_by_type.get(day_type, (0.10, 2))
+    allowed_shortfall = max(int(np.ceil(expected_count * tolerance_ratio)), min_abs_tolerance)
+    return max(0, expected_count - allowed_shortfall)
+
+def _rowwise_get_incomplete_intraday_dates(daily_counts: pd.DataFrame, schedule_day_type_map, last_trade_date):
+    """
+        Returns dates with materially low intraday bar counts by day type.
+    """
+    typed_counts = _rowwise_build_intraday_day_type_counts(daily_counts, schedule_day_type_map, last_trade_date)
+    if typed_counts.empty:
+        return []
+    
+
+    expected_by_type, weekday_baseline = _rowwise_compute_intraday_expected_counts_by_day_type(typed_counts)
+
+    if weekday_baseline <= 0:
+        return []
+
+    incomplete_dates = []
+    for row in typed_counts.itertuples(index=False):
+        expected = int(expected_by_type.get(row.day_type, weekday_baseline) or weekday_baseline)
+        if expected <= 0:
+            continue
+        min_acceptable = _rowwise_intraday_min_acceptable_count(expected, row.day_type)
+        observed_count = pd.to_numeric(row.daily_count, errors='coerce')
+        if pd.isna(observed_count):
+            continue
+        if int(observed_count) < min_acceptable:
+            incomplete_dates.append(row.trade_date)
+
+    return sorted(set(incomplete_dates))
+
+
+##################### benchmark
+def _timed(fn, *args):
+    started = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - started
+
+def run(db_path=None):
+    """
+        Returns one row per intraday table: rows classified, seconds per implementation, and whether the results match
+    """
+    db_path = config.dbname_futures if db_path is None else db_path
+    rows = []
+    with db.sqlite_connection(db_path) as conn:
+        lookupTable = db.getLookup_symbolRecords(conn)
+        for record in lookupTable.itertuples(index=False):
+            if not futures._is_intraday_interval(record.interval):
+                continue
+            try:
+                daily_counts = futures._get_intraday_daily_session_stats(conn, record.name)
+                exchange = futures._get_exchange_for_symbol(record.symbol)
+            except Exception as e:
+                print('%s: [yellow]Skipping %s: %s[/yellow]' % (datetime.now().strftime('%H:%M:%S'), record.name, e))
+                continue
+            if daily_counts.empty:
+                continue
+
+            last_trade_date = futures._extract_last_trade_date_from_tablename(record.name, fallback_date=daily_counts['trade_date'].iloc[-1])
+            schedule, _ = futures._get_calendar_schedule(exchange, daily_counts['trade_date'].iloc[0], daily_counts['trade_date'].iloc[-1])
+            raw_schedule = schedule.drop(columns='day_type', errors='ignore')
+
+            # timed as each runs in the gap scan: the vectorized map reads the cached schedule's day types,
+            # results are compared on the same raw schedule
+            _, map_seconds_vectorized = _timed(futures._build_schedule_day_type_map, schedule)
+            map_vectorized = futures._build_schedule_day_type_map(raw_schedule)
+            map_rowwise, map_seconds_rowwise = _timed(_rowwise_build_schedule_day_type_map, raw_schedule)
+            vectorized, seconds_vectorized = _timed(futures._get_incomplete_intraday_dates, daily_counts.copy(), map_vectorized, last_trade_date)
+            rowwise, seconds_rowwise = _timed(_rowwise_get_incomplete_intraday_dates, daily_counts.copy(), map_rowwise, last_trade_date)
+
+            rows.append({
+                'tablename': record.name,
+                'days': len(daily_counts),
+                'rowwise_seconds': seconds_rowwise + map_seconds_rowwise,
+                'vectorized_seconds': seconds_vectorized + map_seconds_vectorized,
+                'identical': (vectorized == rowwise) and (map_vectorized == map_rowwise),
+            })
+    return pd.DataFrame(rows)
+
+def report(db_path=None):
+    results = run(db_path)
+    if results.empty:
+        print('[yellow]No intraday futures tables found[/yellow]')
+        return results
+    rowwise, vectorized = results['rowwise_seconds'].sum(), results['vectorized_seconds'].sum()
+    print('%s intraday tables, %s sessions classified' % (len(results), results['days'].sum()))
+    print('row-wise:   %.3fs' % rowwise)
+    print('vectorized: %.3fs' % vectorized)
+    print('speedup:    %.1fx' % (rowwise / vectorized if vectorized > 0 else np.nan))
+    mismatched = results.loc[~results['identical'], 'tablename'].tolist()
+    if mismatched:
+        print('[red]Results differ for %s[/red]' % mismatched)
+    else:
+        print('[green]Identical results for every table[/green]')
+    return results
+
+if __name__ == '__main__':
+    report(argv[1] if len(argv) > 1 else None)
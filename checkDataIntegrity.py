@@ -1,11 +1,18 @@
 """
 This script is used to check the integrity of the data saved in the database.
     Check are housed by data types: {OHLC, and Termstructure}
+
+Date checks run on datetime64[D] arrays: expected sessions come from a numpy busdaycalendar
+(weekdays minus the exchange's holidays) and missing dates are a set difference with the
+stored dates, so multi-year daily and intraday series are checked in milliseconds.
 """
 from datetime import datetime
-import pandas as pd 
+import numpy as np
+import pandas as pd
 import holidays as hols
 
+_busdaycalendars = {}
+
 def _get_holidays_for_exchange(exchange, years, country='US'):
     exchange = (exchange or '').upper()
 
@@ -16,14 +23,48 @@ def _get_holidays_for_exchange(exchange, years, country='US'):
 
     return hols.country_holidays(country, years=years).keys()
 
+def _get_busdaycalendar(exchange, years, country='US'):
+    """
+        Returns a numpy busdaycalendar of the exchange's sessions (weekdays minus holidays) for the years
+    """
+    key = ((exchange or '').upper(), country, tuple(sorted(int(year) for year in years)))
+    calendar = _busdaycalendars.get(key)
+    if calendar is None:
+        holidays = np.array(sorted(_get_holidays_for_exchange(exchange, list(key[2]), country=country)), dtype='datetime64[D]')
+        calendar = np.busdaycalendar(weekmask='1111100', holidays=holidays)
+        _busdaycalendars[key] = calendar
+    return calendar
+
+def _to_days(values):
+    """
+        Returns datetime-likes as a sorted unique datetime64[D] array
+    """
+    days = pd.DatetimeIndex(pd.to_datetime(values)).dropna()
+    if days.tz is not None:
+        days = days.tz_localize(None)
+    return np.unique(days.to_numpy().astype('datetime64[D]'))
+
+def _years_of(*day_arrays):
+    years = set()
+    for days in day_arrays:
+        if len(days):
+            years.update(range(int(days[0].astype(object).year), int(days[-1].astype(object).year) + 1))
+    return sorted(years)
+
+def _missing_days(present, expected, calendar):
+    """
+        Returns the session dates of expected (datetime64[D], sorted) that are not in present
+    """
+    expected = expected[np.is_busday(expected, busdaycal=calendar)]
+    return np.setdiff1d(expected, present, assume_unique=True)
+
 def _check_for_missing_dates_in_timeseries(timeseries, date_col_name = 'date', dates = None, **kwargs):
     """
-        Check for missing dates in a timeseries. Ignores weekends and holidays. use <dates> if provided to check for specific dates otherwise do a generic test. 
-        
-        Returns a list of missing dates.
-        Returns None if no missing dates are found.
+        Check for missing dates in a timeseries. Ignores weekends and holidays. use <dates> if provided to check for specific dates otherwise do a generic test.
+
+        Returns the missing dates as a DatetimeIndex, empty when no dates are missing.
     """
-    # if date_col_name is index reset index 
+    # if date_col_name is index reset index
     if date_col_name == 'index':
         timeseries.reset_index(inplace=True)
         date_col_name = 'date'
@@ -31,29 +72,37 @@ def _check_for_missing_dates_in_timeseries(timeseries, date_col_name = 'date', d
     country = kwargs.get('country', 'US')
     exchange = kwargs.get('exchange', 'NYSE')
     timeseries[date_col_name] = pd.to_datetime(timeseries[date_col_name])
-    
+
+    present = _to_days(timeseries[date_col_name])
+    if present.size == 0:
+        return pd.DatetimeIndex([])
+
     # If dates are provided, use them; otherwise, use the date range from the timeseries
     if dates is None:
-        start_date = min(timeseries[date_col_name].dt.date)
-        end_date = max(timeseries[date_col_name].dt.date)
-        all_dates = pd.date_range(start=start_date, end=end_date)#.to_pydatetime()
-        all_dates = pd.to_datetime(all_dates)
+        expected = np.arange(present[0], present[-1] + 1, dtype='datetime64[D]')
     else:
-        all_dates = pd.to_datetime(dates)#.to_pydatetime()
-    
-    years = timeseries[date_col_name].dt.year.unique()
-
-    # handle holidays 
-    holidays = _get_holidays_for_exchange(exchange=exchange, years=years, country=country)
-    expected_dates = [
-        date for date in all_dates
-        if date.weekday() < 5
-    ]
-    # remove any dates in holidays that are in expected_dates
-    expected_dates = [date for date in expected_dates if date.date() not in holidays]
-    expected_dates = pd.to_datetime(expected_dates)
-
-    # Identify missing dates
-    missing_dates = [date for date in expected_dates if date.date() not in timeseries[date_col_name].dt.date.to_list()] 
-
-    return pd.to_datetime(missing_dates)
\ No newline at end of file
+        expected = _to_days(dates)
+
+    calendar = _get_busdaycalendar(exchange, _years_of(present, expected), country=country)
+    return pd.to_datetime(_missing_days(present, expected, calendar))
+
+def check_missing_dates_in_tables(timeseries_by_name, date_col_name='date', exchange='NYSE', country='US'):
+    """
+        Runs the missing date check over many tables at once, sharing one session calendar.
+        timeseries_by_name: {tablename: DataFrame (or datetime-likes)}
+        Returns {tablename: DatetimeIndex of missing dates}
+    """
+    present_by_name = {}
+    for name, timeseries in timeseries_by_name.items():
+        values = timeseries[date_col_name] if isinstance(timeseries, pd.DataFrame) else timeseries
+        present_by_name[name] = _to_days(values)
+
+    calendar = _get_busdaycalendar(exchange, _years_of(*present_by_name.values()), country=country)
+    missing = {}
+    for name, present in present_by_name.items():
+        if present.size == 0:
+            missing[name] = pd.DatetimeIndex([])
+            continue
+        expected = np.arange(present[0], present[-1] + 1, dtype='datetime64[D]')
+        missing[name] = pd.to_datetime(_missing_days(present, expected, calendar))
+    return missing
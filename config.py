@@ -8,6 +8,8 @@ path_lib_analysis_strategies = '../workbench/analysis/venv/strategy_implementati
 dbname_stock = '/workbench/historicalData/saveHistoricalData/data/historicalData_index.db'
 dbname_futures = '/workbench/historicalData/saveHistoricalData/data/historicalData_futures.db'
 dbname_termstructure = '/workbench/historicalData/saveHistoricalData/data/termstructure.db'
+dbname_ibkr_state = '/workbench/historicalData/saveHistoricalData/data/ibkr_state.db'
+dbname_scheduler = '/workbench/historicalData/saveHistoricalData/data/fetch_scheduler.db'
 dbname_rwtools_futures_vix_csv = '/workbench/historicalData/saveHistoricalData/data/vix_chunks01.csv'
 
 #_____________________________________________________________________________________________________________ Watchlist locations 
@@ -15,6 +17,14 @@ watchlist_main = 'tickerList.csv'
 watchlist_futures = 'futuresWatchlist.csv'
 lookupTableName = '00-lookup_symbolRecords'
 table_name_futures_pxhistory_metadata = '00-lookup_pxhistory_metadata'
+table_name_unfilled_gaps = '00-lookup_unfilled_gaps'
+table_name_daily_session_stats = '00-daily_session_stats'     # per table and trade date: bar count, first/last bar time, session span
+table_name_termstructure_metadata = '00-lookup_termstructure_metadata'     # per term structure table: the contracts it was last built from
+gap_fill_max_attempts = 3      # gap dates still missing after this many fill passes are no longer requested
+gap_scan_workers = None        # processes scanning tables for gaps, None = every core, 1 = scan in-process
+bar_gap_min_missing_bars = 3   # intraday runs of missing bars shorter than this are taken as minutes without trades
+bar_gap_min_slot_coverage = 0.5    # time-of-day slots with bars on fewer sessions than this are not expected (halts, thin hours)
+pxhistory_timezone = 'US/Eastern'  # wall clock of the stored bar timestamps
 
 #_____________________________________________________________________________________________________________ Lookup tables
 HIGH_PRIORITY_SYMBOLS = ['SPX', 'VIX', 'VIX3M', 'VVIX', 'AVGO']
@@ -194,6 +204,12 @@ exchange_calendar_mapping = {
 exchange_calendar_short_session_ratio = 0.85
 exchange_calendar_evening_open_minute_utc = 15 * 60
 
+# Precomputed session tables per calendar code (exchange_calendar_cache), one .npz file each
+calendar_cache_dir = '/workbench/historicalData/saveHistoricalData/data/calendar_cache'
+calendar_cache_start = '2000-01-01'
+calendar_cache_lookahead_days = 365     # sessions stored past today, rebuilt when less than half is left
+calendar_cache_max_age_days = 30        # rebuilt after this many days to pick up newly announced holidays
+
 futures_symbol_metadata = {
     'CL': {
         'exchange': 'NYMEX',
@@ -245,5 +261,104 @@ futures_symbol_metadata = {
     },
 }
 
+#_____________________________________________________________________________________________________________ Additional bar series
+# whatToShow series fetched alongside TRADES, keyed by secType then symbol. They are requested for the same
+# window as the TRADES bars and stored as <series>_open | _high | _low | _close columns of the TRADES table.
+# IBKR serves only TRADES for IND contracts, index volatility is covered through the futures.
+extra_series = {
+    'FUT': {'VIX': ['MIDPOINT', 'BID_ASK']},
+    'STK': {},
+}
+
+#_____________________________________________________________________________________________________________ Live bar streaming (realtime_ingest)
+streaming_intervals = ['1 min', '5 mins', '30 mins']
+streaming_seed_duration = '1 D'         # history requested when a subscription opens
+streaming_max_subscriptions = 50        # IBKR caps concurrent keepUpToDate subscriptions
+streaming_flush_seconds = 60
+
+#_____________________________________________________________________________________________________________ Fetch scheduler (fetch_scheduler)
+scheduler_jobs_table = '00-fetch_jobs'
+# score = kind weight + sum(weight * factor), each factor in [0, 1]
+scheduler_weights = {
+    'priority_symbol': 4.0,     # symbol in HIGH_PRIORITY_SYMBOLS
+    'staleness': 3.0,           # days since last update, capped at scheduler_staleness_cap_days
+    'expiry_proximity': 2.0,    # futures only, closer to expiry scores higher
+}
+scheduler_kind_weights = {'new_contract': 1.5, 'forward_fill': 2.0, 'gap_fill': 1.0, 'backfill': 0.5}
+scheduler_staleness_cap_days = 10
+scheduler_expiry_horizon_days = 120
+scheduler_max_attempts = 3
+scheduler_failed_cooldown_days = 7     # a failed job gets one more attempt once this long has passed since its last one
+
+#_____________________________________________________________________________________________________________ Gap coverage report (gap_coverage_report)
+coverage_report_dir = '/workbench/historicalData/saveHistoricalData/data/coverage_report'
+coverage_report_top_ranges = 20     # longest missing ranges listed per symbol and interval
+
+#_____________________________________________________________________________________________________________ Telemetry (ibkr_telemetry)
+telemetry_enabled = True
+telemetry_path = '/workbench/historicalData/saveHistoricalData/data/ibkr_telemetry.jsonl'    # also IBKR_TELEMETRY_PATH
+
 #_____________________________________________________________________________________________________________ API thresholds and timeouts 
-ibkr_max_consecutive_calls = 50
\ No newline at end of file
+ibkr_max_consecutive_calls = 50
+
+# TWS/Gateway session settings; ibkr_connection_pool hands out one session per client id 
+ibkr_host = '127.0.0.1'
+ibkr_port = 7496
+ibkr_client_id = 10                         # setupConnection() sessions (getHistoricalData, futures maintainers)
+ibkr_pool_client_ids = [11, 12, 13, 14]     # must not include ibkr_client_id, TWS refuses a second session on an id (326)
+ibkr_connect_timeout_seconds = 10
+ibkr_reconnect_max_attempts = 5
+ibkr_reconnect_backoff_seconds = 2
+ibkr_reconnect_backoff_max_seconds = 60
+ibkr_health_check_interval_seconds = 30
+ibkr_resume_max_attempts = 10           # reconnect attempts after a mid-run disconnect before giving up on the request
+ibkr_request_max_reconnects = 3         # times a single request is retried after its session was restored
+ibkr_connectivity_wait_seconds = 300    # max wait for TWS to report connectivity restored (1101/1102) after 1100
+
+# failure handling (ibkr_circuit_breaker): breakers open per contract after consecutive failures of a class 
+ibkr_breaker_table = '00-ibkr_circuit_breakers'
+ibkr_breaker_thresholds = {'invalid_contract': 1, 'no_permission': 2, 'no_data': 3, 'transient': 5}
+ibkr_breaker_open_hours = {'invalid_contract': 24 * 30, 'no_permission': 24 * 7, 'no_data': 24, 'transient': 1}
+ibkr_breaker_max_open_hours = 24 * 60     # re-tripped breakers double their wait up to this
+ibkr_retry_budget = 20                    # retries of pacing violations / transient errors per window, all requests combined
+ibkr_retry_budget_window_seconds = 3600
+ibkr_retry_backoff_seconds = 15
+
+# offline stand-in for TWS (ibkr_fake_server), can also be enabled with IBKR_FAKE=1 
+ibkr_use_fake_server = False
+ibkr_fake_seed = 7
+ibkr_fake_enforce_pacing = False
+ibkr_fake_latency_seconds = 0.0
+ibkr_fake_error_rates = {162: 0.0, 1100: 0.0, 504: 0.0}     # probability per historical request
+
+# record/replay of IBKR responses (ibkr_cassette): None | 'record' | 'replay' 
+ibkr_cassette_mode = None
+ibkr_cassette_path = 'ibkr_cassette.pkl.gz'
+ibkr_cassette_speed = 1.0       # replay timing: 1 = as recorded, 10 = 10x faster, 0 = no waiting
+
+# Widest durationStr allowed per bar size, used by ibkr_request_planner to size reqHistoricalData calls.
+# Step sizes: https://interactivebrokers.github.io/tws-api/historical_limitations.html#hd_step_sizes
+# 'D' durations are counted in trading days by IBKR.
+ibkr_max_duration_by_bar_size = {
+    '1 secs': '1800 S',
+    '5 secs': '3600 S',
+    '10 secs': '14400 S',
+    '15 secs': '14400 S',
+    '30 secs': '28800 S',
+    '1 min': '10 D',
+    '2 mins': '20 D',
+    '3 mins': '30 D',
+    '5 mins': '60 D',
+    '10 mins': '100 D',
+    '15 mins': '120 D',
+    '20 mins': '150 D',
+    '30 mins': '300 D',
+    '1 hour': '365 D',
+    '2 hours': '365 D',
+    '3 hours': '365 D',
+    '4 hours': '365 D',
+    '8 hours': '365 D',
+    '1 day': '5 Y',
+    '1 week': '10 Y',
+    '1 month': '20 Y',
+}
\ No newline at end of file
@@ -80,6 +80,7 @@ def drop_tables_with_malformed_expiry(conn):
     for table in tables['name']:
         sql_dropTable = 'DROP TABLE \'%s\''%(table)
         conn.execute(sql_dropTable)
+        db.delete_daily_session_stats(conn, table, config.table_name_daily_session_stats)
 
 def generate_subset_of_db(conn, subset_db_path:str, table_name_fragment:str, table_name_fragment2:str):
     subset_conn = sqlite3.connect(subset_db_path)
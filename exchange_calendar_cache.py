@@ -0,0 +1,194 @@
+"""
+Disk-persisted exchange session tables.
+
+pandas_market_calendars builds a schedule from its holiday rules on every schedule(start, end) call,
+which the gap scans make once per table and again per gap lookup. Instead, the sessions of each
+calendar code are computed once, from config.calendar_cache_start to a year past today
+(config.calendar_cache_lookahead_days), and stored as one .npz file per calendar code in
+config.calendar_cache_dir:
+    date            datetime64[D], sorted
+    open, close     int64 epoch ns (UTC)
+    break_start/end int64 epoch ns (UTC), NaT when the session has no break
+    day_type        'regular' | 'holiday_reduced_hours'
+
+Files are loaded once per process and sliced with np.searchsorted, a schedule lookup is two binary
+searches. A file is rebuilt when it does not reach far enough ahead any more, starts later than
+config.calendar_cache_start, or is older than config.calendar_cache_max_age_days (calendars pick up
+newly announced holidays).
+
+Usage:
+    python exchange_calendar_cache.py           rebuilds the files of every mapped calendar code
+"""
+from datetime import datetime
+from rich import print
+
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+import pandas_market_calendars as xcals
+
+import config
+
+_FILE_VERSION = 2
+
+_lock = threading.Lock()
+_sessions = {}
+
+def _now():
+    return datetime.now().strftime('%H:%M:%S')
+
+def _path(calendar_code):
+    return os.path.join(config.calendar_cache_dir, '%s.npz' % calendar_code)
+
+def _day(value):
+    return np.datetime64(pd.Timestamp(value).date(), 'D')
+
+def _classify_day_types(open_ns, close_ns, dates):
+    """
+        Flags sessions materially shorter than the calendar's regular weekday session
+        (config.exchange_calendar_short_session_ratio of the median weekday session length)
+    """
+    session_minutes = (close_ns - open_ns) / 6e10
+    # 1970-01-01 was a thursday
+    weekday = (dates.astype(np.int64) + 3) % 7
+    day_type = np.full(len(dates), 'regular', dtype='<U24')
+    weekday_minutes = session_minutes[weekday < 5]
+    if weekday_minutes.size == 0:
+        return day_type
+    baseline = float(np.nanmedian(weekday_minutes))
+    day_type[session_minutes < baseline * config.exchange_calendar_short_session_ratio] = 'holiday_reduced_hours'
+    return day_type
+
+def build(calendar_code):
+    """
+        Computes the session table of a calendar code and writes it to config.calendar_cache_dir
+    """
+    start = pd.Timestamp(config.calendar_cache_start)
+    end = pd.Timestamp.today().normalize() + pd.Timedelta(days=config.calendar_cache_lookahead_days)
+    print('%s: [yellow]Building %s sessions %s - %s...[/yellow]' % (_now(), calendar_code, start.date(), end.date()))
+
+    schedule = xcals.get_calendar(calendar_code).schedule(start, end)
+    open_col = 'market_open' if 'market_open' in schedule.columns else 'open'
+    close_col = 'market_close' if 'market_close' in schedule.columns else 'close'
+
+    dates = pd.DatetimeIndex(schedule.index).to_numpy().astype('datetime64[D]')
+    open_ns = pd.DatetimeIndex(pd.to_datetime(schedule[open_col], utc=True)).as_unit('ns').asi8
+    close_ns = pd.DatetimeIndex(pd.to_datetime(schedule[close_col], utc=True)).as_unit('ns').asi8
+    break_ns = {}
+    for col in ['break_start', 'break_end']:
+        if col in schedule.columns:
+            break_ns[col] = pd.DatetimeIndex(pd.to_datetime(schedule[col], utc=True)).as_unit('ns').asi8
+        else:
+            break_ns[col] = np.full(len(dates), pd.NaT.value, dtype=np.int64)
+    sessions = {
+        'version': np.array(_FILE_VERSION),
+        'built': np.datetime64(pd.Timestamp.today().date(), 'D'),
+        'start': _day(start),
+        'end': _day(end),
+        'date': dates,
+        'open': open_ns,
+        'close': close_ns,
+        'break_start': break_ns['break_start'],
+        'break_end': break_ns['break_end'],
+        'day_type': _classify_day_types(open_ns, close_ns, dates),
+    }
+
+    try:
+        os.makedirs(config.calendar_cache_dir, exist_ok=True)
+        # write then rename so a concurrent reader never sees a partial file
+        tmp_path = _path(calendar_code) + '.tmp.npz'
+        np.savez(tmp_path, **sessions)
+        os.replace(tmp_path, _path(calendar_code))
+    except OSError as e:
+        # an unsaved table still serves this process
+        print('%s: [yellow]Could not save %s sessions: %s[/yellow]' % (_now(), calendar_code, e))
+    return sessions
+
+def _is_stale(sessions):
+    today = np.datetime64(pd.Timestamp.today().date(), 'D')
+    return (
+        int(sessions['version']) != _FILE_VERSION
+        or sessions['start'] > _day(config.calendar_cache_start)
+        or sessions['end'] < today + np.timedelta64(config.calendar_cache_lookahead_days // 2, 'D')
+        or sessions['built'] < today - np.timedelta64(config.calendar_cache_max_age_days, 'D')
+    )
+
+def _load(calendar_code):
+    try:
+        with np.load(_path(calendar_code)) as f:
+            return {key: f[key] for key in f.files}
+    except (OSError, KeyError, ValueError):
+        return None
+
+def get_sessions(calendar_code):
+    """
+        Returns the session table of a calendar code as a dict of arrays, loading or building it on first use
+    """
+    with _lock:
+        sessions = _sessions.get(calendar_code)
+        if sessions is None:
+            sessions = _load(calendar_code)
+            if sessions is None or _is_stale(sessions):
+                sessions = build(calendar_code)
+            _sessions[calendar_code] = sessions
+    return sessions
+
+def _bounds(sessions, start_date, end_date):
+    dates = sessions['date']
+    return np.searchsorted(dates, _day(start_date), 'left'), np.searchsorted(dates, _day(end_date), 'right')
+
+def session_dates(calendar_code, start_date, end_date):
+    """
+        Returns the session dates in [start_date, end_date] as datetime64[D]
+    """
+    sessions = get_sessions(calendar_code)
+    lo, hi = _bounds(sessions, start_date, end_date)
+    return sessions['date'][lo:hi]
+
+def get_schedule(calendar_code, start_date, end_date):
+    """
+        Returns the sessions in [start_date, end_date] shaped like a pandas_market_calendars schedule:
+        index session date | market_open | market_close (UTC) | day_type
+    """
+    sessions = get_sessions(calendar_code)
+    lo, hi = _bounds(sessions, start_date, end_date)
+    schedule = pd.DataFrame({
+        'market_open': pd.to_datetime(sessions['open'][lo:hi], utc=True),
+        'market_close': pd.to_datetime(sessions['close'][lo:hi], utc=True),
+        'day_type': sessions['day_type'][lo:hi],
+    }, index=pd.DatetimeIndex(sessions['date'][lo:hi].astype('datetime64[ns]')))
+    return schedule
+
+def bar_grid(calendar_code, start_date, end_date, step_ns):
+    """
+        Returns the expected bar start times of the sessions in [start_date, end_date] for a bar size of step_ns:
+        (int64 epoch ns UTC, session date datetime64[D]), bars starting inside a session break left out
+    """
+    sessions = get_sessions(calendar_code)
+    lo, hi = _bounds(sessions, start_date, end_date)
+    open_ns, close_ns = sessions['open'][lo:hi], sessions['close'][lo:hi]
+
+    num_bars = np.maximum(-((open_ns - close_ns) // step_ns), 0)
+    session = np.repeat(np.arange(hi - lo), num_bars)
+    offset = np.arange(num_bars.sum()) - np.repeat(np.cumsum(num_bars) - num_bars, num_bars)
+    grid = open_ns[session] + offset * step_ns
+
+    # NaT breaks are the smallest int64, no bar falls inside them
+    in_break = (grid >= sessions['break_start'][lo:hi][session]) & (grid < sessions['break_end'][lo:hi][session])
+    return grid[~in_break], sessions['date'][lo:hi][session[~in_break]]
+
+def clear():
+    """
+        Drops the tables loaded in this process, the next lookup reloads them from disk
+    """
+    with _lock:
+        _sessions.clear()
+
+if __name__ == '__main__':
+    for calendar_code in sorted(set(config.exchange_calendar_mapping.values())):
+        sessions = build(calendar_code)
+        with _lock:
+            _sessions[calendar_code] = sessions
+        print('%s: [green]%s: %s sessions[/green]' % (_now(), calendar_code, len(sessions['date'])))
@@ -0,0 +1,294 @@
+"""
+Unified fetch scheduler for the equity and futures maintainers.
+
+Every pending piece of work is a job in a persistent priority queue (config.dbname_scheduler):
+    forward_fill    bring an existing table up to date
+    backfill        load history older than the first stored bar (equities)
+    gap_fill        fill missing sessions inside a finished contract (futures)
+    new_contract    first load of a symbol / contract that has no table yet
+
+Jobs are scored as
+    kind weight + priority symbol + staleness + expiry proximity
+(weights in config.scheduler_weights / config.scheduler_kind_weights), and the highest scoring
+job is always run next. All jobs run on one leased session and share the process-wide pacing
+budget in interface_ibkr, so when the budget is scarce the most valuable bars are fetched first
+instead of whichever maintainer loop happens to be running.
+
+The maintainers keep their own entry points; the scheduler drives the same per-table functions
+(getHistoricalData.updateRecordHistory / updatePreHistoricData, futures v2 _forward_fetch_contract /
+_verify_and_fill_gaps), one job at a time.
+
+Usage:
+    python fetch_scheduler.py
+"""
+from datetime import datetime
+from rich import print
+
+import pandas as pd
+import time
+
+import config
+import interface_ibkr as ibkr
+import interface_localDB as db
+import ibkr_cassette
+import ibkr_connection_pool
+import getHistoricalData
+import maintainHistoricalData_futures_v2 as futures_v2
+from maintainHistoricalData_futures import _getWatchlist
+
+_dbName_scheduler = config.dbname_scheduler
+_dbName_index = config.dbname_stock
+_dbName_futures = config.dbname_futures
+_jobsTable = config.scheduler_jobs_table
+
+# futures v2 progress status -> job kind
+_FUTURES_STATUS_KINDS = {
+    'not_started': 'new_contract',
+    'forward_fetch_in_progress': 'forward_fill',
+    'active': 'forward_fill',
+    'gap_fill_in_progress': 'gap_fill',
+}
+
+def _now():
+    return datetime.now().strftime('%H:%M:%S')
+
+def score_job(kind, symbol, days_stale=None, expiry=None, now=None):
+    """
+        Returns the priority score of a job, higher runs first
+    """
+    now = ibkr_cassette.now() if now is None else now
+    weights = config.scheduler_weights
+    score = config.scheduler_kind_weights.get(kind, 0.0)
+
+    if symbol in config.HIGH_PRIORITY_SYMBOLS:
+        score += weights['priority_symbol']
+
+    if days_stale is not None and pd.notna(days_stale):
+        score += weights['staleness'] * min(max(float(days_stale), 0.0) / config.scheduler_staleness_cap_days, 1.0)
+
+    if expiry is not None:
+        expiry_dt = futures_v2._parse_expiry_to_datetime(expiry)
+        days_to_expiry = (expiry_dt - now).days
+        if days_to_expiry >= 0:
+            score += weights['expiry_proximity'] * max(0.0, 1.0 - days_to_expiry / config.scheduler_expiry_horizon_days)
+
+    return round(score, 4)
+
+def _make_job(kind, asset, symbol, interval, tablename, score, expiry=None):
+    return {
+        'job_id': '%s|%s|%s' % (kind, asset, tablename),
+        'kind': kind,
+        'asset': asset,
+        'symbol': symbol,
+        'interval': interval,
+        'expiry': expiry,
+        'tablename': tablename,
+        'score': score,
+    }
+
+##################### discovery
+def _discover_equity_jobs():
+    jobs = []
+    with db.sqlite_connection(_dbName_index) as conn:
+        records = db.getRecords(conn)
+        try:
+            lookupTable = db.getLookup_symbolRecords(conn)
+        except Exception:
+            lookupTable = pd.DataFrame()
+
+    watchlist = _getWatchlist(config.watchlist_main)
+    watchlist = watchlist.loc[~watchlist['symbol'].isin(config.delisted_symbols)]
+
+    if not records.empty:
+        records = records.loc[~records['symbol'].isin(config.delisted_symbols)]
+        outdated = records.loc[records['daysSinceLastUpdate'] >= 1]
+        for row in outdated.itertuples(index=False):
+            jobs.append(_make_job('forward_fill', 'equity', row.symbol, row.interval, row.name,
+                score_job('forward_fill', row.symbol, days_stale=row.daysSinceLastUpdate)))
+
+    known_symbols = set(records['symbol']) if not records.empty else set()
+    for symbol in watchlist['symbol']:
+        if symbol not in known_symbols:
+            # a new symbol is loaded for every tracked interval in one job
+            jobs.append(_make_job('new_contract', 'equity', symbol, 'all', '%s_new' % symbol,
+                score_job('new_contract', symbol, days_stale=config.scheduler_staleness_cap_days)))
+
+    if not lookupTable.empty:
+        lookupTable = lookupTable.loc[
+            ((lookupTable['numMissingBusinessDays'] > 2) | (lookupTable['numMissingBusinessDays'].isnull())) &
+            (~lookupTable['symbol'].isin(config.delisted_symbols))
+        ]
+        for row in lookupTable.itertuples(index=False):
+            jobs.append(_make_job('backfill', 'equity', row.symbol, row.interval, row.name,
+                score_job('backfill', row.symbol)))
+
+    return jobs
+
+def _discover_futures_jobs(ib):
+    jobs = []
+    now = ibkr_cassette.now()
+    with db.sqlite_connection(_dbName_futures) as conn:
+        futures_v2._initialize_progress_tracker(conn, ib)
+        futures_v2._set_active_contracts_in_progress_tracker(conn, ib)
+        tracker = db.get_progress_tracker(conn, futures_v2.PROGRESS_TABLE)
+
+    if tracker.empty:
+        return jobs
+
+    tracker = tracker.loc[tracker['status'].isin(_FUTURES_STATUS_KINDS.keys())]
+    for row in tracker.itertuples(index=False):
+        kind = _FUTURES_STATUS_KINDS[row.status]
+        last_fetched = pd.to_datetime(row.last_fetched_end_date, errors='coerce')
+        days_stale = (now - last_fetched).days if pd.notna(last_fetched) else config.scheduler_staleness_cap_days
+        if kind == 'gap_fill':
+            # gaps in finished contracts do not get more urgent with time
+            days_stale = None
+        jobs.append(_make_job(kind, 'future', row.symbol, row.interval, row.tablename,
+            score_job(kind, row.symbol, days_stale=days_stale, expiry=row.expiry, now=now), expiry=str(row.expiry)))
+
+    return jobs
+
+def discover_jobs(ib):
+    """
+        Scans equity records and the futures progress tracker and enqueues every job found,
+        pending jobs that are no longer found are dropped. Returns the number of jobs enqueued or re-scored.
+    """
+    jobs = _discover_equity_jobs() + _discover_futures_jobs(ib)
+    with db.sqlite_connection(_dbName_scheduler) as conn:
+        db.create_fetch_jobs_table(conn, _jobsTable)
+        for job in jobs:
+            db.upsert_fetch_job(conn, job, _jobsTable)
+        # work that was done elsewhere or went away since it was queued
+        pruned = db.prune_fetch_jobs(conn, [job['job_id'] for job in jobs], _jobsTable)
+    print('%s: [yellow]Enqueued %s fetch jobs, dropped %s no longer found[/yellow]' % (_now(), len(jobs), pruned))
+    return len(jobs)
+
+##################### execution
+def _run_equity_job(ib, job):
+    if job['kind'] == 'backfill':
+        getHistoricalData.updatePreHistoricData(ib, symbols=[job['symbol']], intervals=[job['interval']])
+        return
+
+    with db.sqlite_connection(_dbName_index) as conn:
+        records = db.getRecords(conn)
+    if records.empty:
+        records = pd.DataFrame(columns=['name', 'symbol', 'interval'])
+    symbol_records = records.loc[records['symbol'] == job['symbol']]
+    # updateRecordHistory indexes both frames by symbol, empty ones still need the column
+    nothing = pd.DataFrame(columns=['symbol'])
+
+    if job['kind'] == 'new_contract':
+        getHistoricalData.updateRecordHistory(ib, symbol_records, nothing, pd.DataFrame({'symbol': [job['symbol']]}))
+        return
+
+    outdated = symbol_records.loc[symbol_records['name'] == job['tablename']]
+    if outdated.empty:
+        return
+    getHistoricalData.updateRecordHistory(ib, symbol_records, outdated.copy(), nothing)
+
+def _run_futures_job(ib, job):
+    with db.sqlite_connection(_dbName_futures) as conn:
+        tracker = db.get_progress_tracker(conn, futures_v2.PROGRESS_TABLE)
+        row = tracker.loc[tracker['tablename'] == job['tablename']]
+        if row.empty:
+            return
+        row = row.iloc[0]
+
+        if job['kind'] in ['new_contract', 'forward_fill']:
+            futures_v2._forward_fetch_contract(conn, ib, row)
+            return
+
+        gap_metadata = db.getTable(conn, futures_v2.GAP_DATES_TABLE)
+        last_polled = None
+        if not gap_metadata.empty:
+            polled = gap_metadata.loc[gap_metadata['tablename'] == job['tablename'], 'date_of_last_gap_date_polled']
+            if not polled.empty:
+                last_polled = pd.to_datetime(polled.iloc[0], errors='coerce')
+        futures_v2._verify_and_fill_gaps(conn, ib, row, last_polled)
+
+def _next_job():
+    with db.sqlite_connection(_dbName_scheduler) as conn:
+        pending = db.get_fetch_jobs(conn, 'pending', _jobsTable)
+        if pending.empty:
+            return None
+        job = pending.iloc[0].to_dict()
+        db.update_fetch_job_fields(conn, job['job_id'], {'status': 'running'}, _jobsTable)
+    return job
+
+def _finish_job(job, error=None):
+    with db.sqlite_connection(_dbName_scheduler) as conn:
+        if error is None:
+            db.update_fetch_job_fields(conn, job['job_id'], {'status': 'done', 'last_error': None}, _jobsTable)
+            return
+        attempts = int(job['attempts']) + 1
+        status = 'pending' if attempts < config.scheduler_max_attempts else 'failed'
+        db.update_fetch_job_fields(conn, job['job_id'], {'status': status, 'attempts': attempts, 'last_error': str(error)[:500]}, _jobsTable)
+
+def run_job(ib, job):
+    print('%s: [yellow]Running %s %s %s (score %.2f, pacing budget %s)[/yellow]' % (
+        _now(), job['kind'], job['tablename'], job['interval'], job['score'], ibkr.get_pacing_budget()))
+    if job['asset'] == 'future':
+        _run_futures_job(ib, job)
+    else:
+        _run_equity_job(ib, job)
+
+def _wait_for_session(ib):
+    """
+        Waits out an outage with the reconnect backoff, False if the session is still down after
+        config.ibkr_resume_max_attempts tries
+    """
+    delay = config.ibkr_reconnect_backoff_seconds
+    for attempt in range(1, config.ibkr_resume_max_attempts + 1):
+        try:
+            ibkr._ensure_connected(ib, 'fetch scheduler')
+            return True
+        except ibkr.IbkrDisconnectedError as e:
+            print('%s: [yellow]IBKR still unavailable (attempt %s/%s): %s[/yellow]' % (_now(), attempt, config.ibkr_resume_max_attempts, e))
+            if attempt < config.ibkr_resume_max_attempts:
+                time.sleep(delay)
+                delay = min(delay * 2, config.ibkr_reconnect_backoff_max_seconds)
+    return False
+
+def run(max_jobs=None):
+    """
+        Discovers jobs, then runs them highest score first until the queue is empty or max_jobs have run.
+        Work found while running is picked up by the next run.
+    """
+    with db.sqlite_connection(_dbName_scheduler) as conn:
+        db.create_fetch_jobs_table(conn, _jobsTable)
+        db.reset_fetch_jobs(conn, _jobsTable, failed_cooldown_days=config.scheduler_failed_cooldown_days)
+
+    num_jobs = 0
+    with ibkr_connection_pool.lease() as ib:
+        discover_jobs(ib)
+        while max_jobs is None or num_jobs < max_jobs:
+            job = _next_job()
+            if job is None:
+                break
+
+            try:
+                run_job(ib, job)
+            except ibkr.IbkrDisconnectedError as e:
+                # the job keeps its attempt count, progress is saved per request
+                print('%s: [red]IBKR unavailable (%s), requeueing %s[/red]' % (_now(), e, job['tablename']))
+                with db.sqlite_connection(_dbName_scheduler) as conn:
+                    db.update_fetch_job_fields(conn, job['job_id'], {'status': 'pending', 'last_error': str(e)[:500]}, _jobsTable)
+                if not _wait_for_session(ib):
+                    # pending jobs stay queued for the next run
+                    print('%s: [red]IBKR did not come back, stopping with the queue intact[/red]' % _now())
+                    break
+                continue
+            except Exception as e:
+                print('%s: [red]Job %s failed: %s[/red]' % (_now(), job['job_id'], e))
+                _finish_job(job, e)
+                num_jobs += 1
+                continue
+
+            _finish_job(job)
+            num_jobs += 1
+
+    print('%s: [green]Fetch scheduler finished, %s jobs run[/green]' % (_now(), num_jobs))
+    return num_jobs
+
+if __name__ == '__main__':
+    run()
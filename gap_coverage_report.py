@@ -0,0 +1,268 @@
+"""
+Gap coverage report over the whole futures db.
+
+Builds a contract x session coverage matrix per symbol and interval from the materialized daily
+session stats (config.table_name_daily_session_stats); a pxhistory table is only read when its stats are missing:
+    cell = bars stored that session / the contract's typical (p80) session bar count, capped at 1
+    NaN where no session is expected (before the contract's first stored day, after its last trade date or today)
+Sessions come from the exchange session tables (exchange_calendar_cache).
+
+Writes to config.coverage_report_dir:
+    coverage_by_table.<fmt>         expected / missing sessions, coverage % and the largest missing range per contract
+    coverage_by_symbol.<fmt>        the same rolled up per symbol and interval
+    largest_missing_ranges.<fmt>    the config.coverage_report_top_ranges longest missing runs per symbol and interval
+    heatmap_<symbol>_<interval>.png contracts by expiry x weeks, mean coverage per week
+<fmt> is csv, or parquet with --parquet (needs pyarrow).
+
+Usage:
+    python gap_coverage_report.py [db path] [--parquet] [--no-heatmap]
+"""
+from datetime import datetime
+from rich import print
+from sys import argv
+
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+import config
+import exchange_calendar_cache
+import interface_localDB as db
+
+def _now():
+    return datetime.now().strftime('%H:%M:%S')
+
+def _load_stats(conn):
+    """
+        Returns every stored session stats row: tablename | trade_date (datetime64[D]) | daily_count
+        Tables of the lookup table without stats yet (not saved since the stats table existed) get theirs computed first.
+    """
+    db.materialize_daily_session_stats(conn, db.getLookup_symbolRecords(conn)['name'], config.table_name_daily_session_stats)
+    stats = pd.read_sql(
+        "SELECT tablename, trade_date, daily_count FROM '%s'" % config.table_name_daily_session_stats, conn)
+    stats['trade_date'] = stats['trade_date'].to_numpy().astype('datetime64[D]')
+    return stats
+
+def _describe_tables(stats):
+    """
+        Returns one row per futures table: tablename | symbol | expiry | interval | first_day | end_day,
+        end_day being the last trade date or today, whichever comes first
+    """
+    tables = stats.groupby('tablename', sort=False)['trade_date'].min().rename('first_day').reset_index()
+    parts = tables['tablename'].str.split('_', expand=True)
+    if parts.shape[1] != 3:
+        return tables.iloc[0:0]
+    tables['symbol'], tables['expiry'], tables['interval'] = parts[0], parts[1], parts[2]
+    tables = tables.loc[tables['expiry'].str.fullmatch(r'\d{8}', na=False)].copy()
+
+    last_trade_day = pd.to_datetime(tables['expiry'], format='%Y%m%d').to_numpy().astype('datetime64[D]')
+    today = np.datetime64(pd.Timestamp.today().date(), 'D')
+    tables['end_day'] = np.minimum(last_trade_day, today)
+    return tables.loc[tables['end_day'] >= tables['first_day']].sort_values(['symbol', 'interval', 'expiry']).reset_index(drop=True)
+
+def _get_session_axis(symbol, start_day, end_day):
+    """
+        Returns the exchange sessions of the symbol in [start_day, end_day] as datetime64[D], weekdays when its calendar is unknown
+    """
+    calendar_code = config.exchange_calendar_mapping.get(str(config.exchange_mapping.get(symbol, '')).upper())
+    if calendar_code:
+        try:
+            return exchange_calendar_cache.session_dates(calendar_code, start_day, end_day)
+        except Exception as e:
+            print('%s: [yellow]No sessions for %s (%s), using weekdays: %s[/yellow]' % (_now(), symbol, calendar_code, e))
+    days = np.arange(start_day, end_day + 1, dtype='datetime64[D]')
+    return days[np.is_busday(days)]
+
+def coverage_matrix(tables, stats):
+    """
+        Returns (coverage matrix, session axis) for the tables of one symbol and interval, rows in the order of tables
+    """
+    axis = _get_session_axis(tables['symbol'].iloc[0], tables['first_day'].min(), tables['end_day'].max())
+    row_of = pd.Series(np.arange(len(tables)), index=tables['tablename'].to_numpy())
+    rows = row_of.reindex(stats['tablename'].to_numpy()).to_numpy()
+    keep = ~np.isnan(rows)
+    rows = rows[keep].astype(np.int64)
+    days = stats['trade_date'].to_numpy()[keep]
+    counts = stats['daily_count'].to_numpy(dtype=np.float64)[keep]
+
+    # only sessions on the axis count, weekend evenings of futures tables are folded into no cell
+    cols = np.searchsorted(axis, days).clip(max=max(len(axis) - 1, 0))
+    on_axis = (axis[cols] == days) if len(axis) else np.zeros(len(days), dtype=bool)
+    rows, cols, counts = rows[on_axis], cols[on_axis], counts[on_axis]
+
+    baseline = pd.Series(counts).groupby(rows).quantile(0.8).reindex(range(len(tables))).to_numpy()
+    ratio = np.clip(counts / np.where(baseline[rows] > 0, baseline[rows], np.nan), 0, 1)
+
+    expected = (axis[None, :] >= tables['first_day'].to_numpy()[:, None]) & (axis[None, :] <= tables['end_day'].to_numpy()[:, None])
+    matrix = np.where(expected, 0.0, np.nan)
+    matrix[rows, cols] = np.where(expected[rows, cols], np.nan_to_num(ratio), np.nan)
+    return matrix, axis
+
+def missing_runs(matrix, axis):
+    """
+        Returns the runs of consecutive expected sessions with no bars: row | start | end | sessions
+    """
+    rows, cols = np.nonzero(~np.isnan(matrix))
+    is_missing = matrix[rows, cols] == 0
+    rows, cols = rows[is_missing], cols[is_missing]
+    if rows.size == 0:
+        return pd.DataFrame(columns=['row', 'start', 'end', 'sessions'])
+
+    run_start = np.ones(len(rows), dtype=bool)
+    run_start[1:] = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1] + 1)
+    first = np.flatnonzero(run_start)
+    last = np.append(first[1:], len(rows)) - 1
+    return pd.DataFrame({
+        'row': rows[first],
+        'start': axis[cols[first]],
+        'end': axis[cols[last]],
+        'sessions': last - first + 1,
+    })
+
+def summarize_tables(tables, matrix, runs):
+    """
+        Returns one row per table with its coverage and largest missing range
+    """
+    expected = (~np.isnan(matrix)).sum(axis=1)
+    summary = tables[['tablename', 'symbol', 'expiry', 'interval']].copy()
+    summary['first_day'] = tables['first_day'].to_numpy()
+    summary['end_day'] = tables['end_day'].to_numpy()
+    summary['expected_sessions'] = expected
+    summary['missing_sessions'] = (matrix == 0).sum(axis=1)
+    summary['coverage_pct'] = np.where(expected > 0, np.nansum(matrix, axis=1) / np.maximum(expected, 1) * 100, np.nan)
+    summary['session_coverage_pct'] = np.where(expected > 0, (matrix > 0).sum(axis=1) / np.maximum(expected, 1) * 100, np.nan)
+
+    summary['largest_missing_start'] = pd.NaT
+    summary['largest_missing_end'] = pd.NaT
+    summary['largest_missing_sessions'] = 0
+    if not runs.empty:
+        largest = runs.sort_values(['row', 'sessions', 'start'], ascending=[True, False, False]).drop_duplicates('row')
+        summary.loc[largest['row'].to_numpy(), 'largest_missing_start'] = pd.to_datetime(largest['start']).to_numpy()
+        summary.loc[largest['row'].to_numpy(), 'largest_missing_end'] = pd.to_datetime(largest['end']).to_numpy()
+        summary.loc[largest['row'].to_numpy(), 'largest_missing_sessions'] = largest['sessions'].to_numpy()
+    return summary
+
+def summarize_symbols(table_summary):
+    """
+        Rolls the per-table summary up per symbol and interval
+    """
+    grouped = table_summary.groupby(['symbol', 'interval'], sort=True)
+    summary = grouped.agg(
+        contracts=('tablename', 'size'),
+        expected_sessions=('expected_sessions', 'sum'),
+        missing_sessions=('missing_sessions', 'sum'),
+        largest_missing_sessions=('largest_missing_sessions', 'max'),
+    ).reset_index()
+    covered = (table_summary['coverage_pct'] * table_summary['expected_sessions']).groupby([table_summary['symbol'], table_summary['interval']]).sum()
+    summary['coverage_pct'] = covered.to_numpy() / summary['expected_sessions'].clip(lower=1).to_numpy()
+    worst = table_summary.sort_values('coverage_pct').drop_duplicates(['symbol', 'interval']).set_index(['symbol', 'interval'])
+    summary['worst_table'] = worst.reindex(pd.MultiIndex.from_frame(summary[['symbol', 'interval']]))['tablename'].to_numpy()
+    summary['worst_coverage_pct'] = worst.reindex(pd.MultiIndex.from_frame(summary[['symbol', 'interval']]))['coverage_pct'].to_numpy()
+    return summary
+
+def compress_weeks(matrix, axis):
+    """
+        Returns (mean coverage per row and week, first session of each week) for the heatmap
+    """
+    # 1970-01-05 was a monday
+    week = (axis.astype(np.int64) + 3) // 7
+    starts = np.flatnonzero(np.r_[True, week[1:] != week[:-1]])
+    expected = np.add.reduceat((~np.isnan(matrix)).astype(np.float64), starts, axis=1)
+    covered = np.add.reduceat(np.nan_to_num(matrix), starts, axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(expected > 0, covered / expected, np.nan), axis[starts]
+
+def render_heatmap(path, title, tables, matrix, axis):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    weekly, weeks = compress_weeks(matrix, axis)
+    fig, ax = plt.subplots(figsize=(min(4 + weekly.shape[1] * 0.05, 30), min(2 + len(tables) * 0.2, 30)))
+    image = ax.imshow(np.ma.masked_invalid(weekly), aspect='auto', interpolation='nearest', cmap='RdYlGn', vmin=0, vmax=1)
+    ax.set_yticks(np.arange(len(tables)))
+    ax.set_yticklabels(tables['expiry'].tolist(), fontsize=6)
+    ticks = np.linspace(0, len(weeks) - 1, num=min(len(weeks), 12)).astype(int)
+    ax.set_xticks(ticks)
+    ax.set_xticklabels([str(weeks[i]) for i in ticks], rotation=45, ha='right', fontsize=7)
+    ax.set_title(title)
+    fig.colorbar(image, ax=ax, label='coverage')
+    fig.tight_layout()
+    fig.savefig(path, dpi=100)
+    plt.close(fig)
+
+def _write(frame, out_dir, name, fmt):
+    path = os.path.join(out_dir, '%s.%s' % (name, fmt))
+    if fmt == 'parquet':
+        frame.to_parquet(path, index=False)
+    else:
+        frame.to_csv(path, index=False)
+    return path
+
+def build(conn):
+    """
+        Returns (per table summary, per symbol summary, largest missing ranges, {(symbol, interval): (tables, matrix, axis)})
+    """
+    stats = _load_stats(conn)
+    tables = _describe_tables(stats)
+
+    table_summaries, ranges, matrices = [], [], {}
+    for (symbol, interval), group in tables.groupby(['symbol', 'interval'], sort=True):
+        group = group.reset_index(drop=True)
+        matrix, axis = coverage_matrix(group, stats.loc[stats['tablename'].isin(group['tablename'])])
+        runs = missing_runs(matrix, axis)
+        table_summaries.append(summarize_tables(group, matrix, runs))
+        matrices[(symbol, interval)] = (group, matrix, axis)
+
+        top = runs.sort_values(['sessions', 'start'], ascending=[False, False]).head(config.coverage_report_top_ranges)
+        ranges.append(pd.DataFrame({
+            'symbol': symbol,
+            'interval': interval,
+            'tablename': group['tablename'].to_numpy()[top['row'].to_numpy(dtype=np.int64)],
+            'start': pd.to_datetime(top['start']).to_numpy(),
+            'end': pd.to_datetime(top['end']).to_numpy(),
+            'sessions': top['sessions'].to_numpy(),
+        }))
+
+    if not table_summaries:
+        return pd.DataFrame(), pd.DataFrame(), pd.DataFrame(), matrices
+    table_summary = pd.concat(table_summaries, ignore_index=True)
+    return table_summary, summarize_symbols(table_summary), pd.concat(ranges, ignore_index=True), matrices
+
+def report(db_path=None, fmt='csv', heatmaps=True, out_dir=None):
+    db_path = config.dbname_futures if db_path is None else db_path
+    out_dir = config.coverage_report_dir if out_dir is None else out_dir
+    started = time.perf_counter()
+
+    with db.sqlite_connection(db_path) as conn:
+        table_summary, symbol_summary, ranges, matrices = build(conn)
+    if table_summary.empty:
+        print('[yellow]No session stats found in %s[/yellow]' % db_path)
+        return symbol_summary
+
+    os.makedirs(out_dir, exist_ok=True)
+    paths = [
+        _write(table_summary, out_dir, 'coverage_by_table', fmt),
+        _write(symbol_summary, out_dir, 'coverage_by_symbol', fmt),
+        _write(ranges, out_dir, 'largest_missing_ranges', fmt),
+    ]
+    if heatmaps:
+        for (symbol, interval), (tables, matrix, axis) in matrices.items():
+            path = os.path.join(out_dir, 'heatmap_%s_%s.png' % (symbol, interval))
+            render_heatmap(path, '%s %s coverage' % (symbol, interval), tables, matrix, axis)
+            paths.append(path)
+
+    with pd.option_context('display.max_columns', None, 'display.width', 200, 'display.float_format', '{:.1f}'.format):
+        print(symbol_summary[['symbol', 'interval', 'contracts', 'expected_sessions', 'missing_sessions', 'coverage_pct', 'worst_table', 'worst_coverage_pct']].to_string(index=False))
+    print('%s: [green]%s contracts, %s files written to %s in %.1fs[/green]' % (_now(), len(table_summary), len(paths), out_dir, time.perf_counter() - started))
+    return symbol_summary
+
+if __name__ == '__main__':
+    args = [arg for arg in argv[1:] if not arg.startswith('--')]
+    report(
+        args[0] if args else None,
+        fmt='parquet' if '--parquet' in argv else 'csv',
+        heatmaps='--no-heatmap' not in argv,
+    )
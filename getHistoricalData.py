@@ -40,6 +40,8 @@ import re
 import time
 
 import interface_ibkr as ib
+import ibkr_cassette
+import ibkr_request_planner as planner
 import interface_localDb_old as db
 import interface_localDB as db_new
 
@@ -325,22 +327,12 @@ def updateRecordHistory(ibkr, records, indicesWithOutdatedData= pd.DataFrame(),
             ## add records for each tracked interval 
             for _intvl in intervals_index:
                 
-                ## set lookback based on interval
-                if ( _intvl in ['5 mins', '15 mins']):
-                    lookback = 80
-            
-                elif (_intvl in ['30 mins', '1 day']):
-                    lookback = 300
-                
-                elif (_intvl in ['1 min']):
-                    lookback = 15
-                
-                else:
-                    print('[red]Interval not supported![/red]')
+                ## set lookback to the widest window ibkr allows for the interval
+                lookback = planner.get_max_lookback(_intvl)
                 
                 ## get history from ibkr 
-                print('Adding %s - %s interval - %s day lookback'%(newIndex, _intvl, lookback))
-                history = ib.getBars(ibkr, symbol=newIndex,lookback='%s D'%(lookback), interval=_intvl)
+                print('Adding %s - %s interval - %s lookback'%(newIndex, _intvl, lookback))
+                history = ib.getBars(ibkr, symbol=newIndex,lookback=lookback, interval=_intvl)
 
                 # if history is empty, skip to next interval
                 if history.empty:
@@ -374,24 +366,10 @@ def updateRecordHistory(ibkr, records, indicesWithOutdatedData= pd.DataFrame(),
             # normalize interval formatting (e.g., "1day" -> "1 day")
             interval = str(row['interval']).strip()
 
-            # choose max lookback per interval
-            if interval in ['1 min', '5 mins', '15 mins']:
-                max_lb_days = 15
-            elif interval in ['30 mins', '1 day']:
-                max_lb_days = 300
-            else:
-            # default to original behavior for other intervals
-                max_lb_days = int(row['daysSinceLastUpdate'])
-
             total_days = int(row['daysSinceLastUpdate']) if pd.notna(row['daysSinceLastUpdate']) else 0
             if total_days <= 0:
                 continue
 
-            # gather all chunks before saving
-            all_chunks = []
-            remaining = total_days
-            endDate = None
-
             # earliestTimeStamp for DB save
             if row['symbol'] in earliestAvailableTimestamps_cache:
                 earliestTimestamp = earliestAvailableTimestamps_cache[row['symbol']]
@@ -401,21 +379,30 @@ def updateRecordHistory(ibkr, records, indicesWithOutdatedData= pd.DataFrame(),
             if not earliestTimestamp: 
                 continue 
 
-            while remaining > 0:
+            # plan the fewest requests covering last update -> now, newest first
+            requests = planner.plan_requests(
+                interval,
+                [(pd.to_datetime(row['lastUpdateDate']), ibkr_cassette.now().floor('s'))],
+                contract_start=earliestTimestamp,
+                exchange=exchange_mapping.get(row['symbol'], 'SMART'))
+
+            # gather all chunks before saving
+            all_chunks = []
+            for request in requests:
             # refresh connection every N calls
                 if count % config.ibkr_max_consecutive_calls == 0:
                     ibkr = ib.refreshConnection(ibkr)
 
-                chunk_days = min(max_lb_days, remaining)
-
                 try:
                     history_chunk = ib.getBars(
                         ibkr,
                         symbol=row['symbol'],
-                        lookback=f'{chunk_days} D',
+                        lookback=request['lookback'],
                         interval=interval,
-                        endDate=endDate
+                        endDate=request['endDate']
                     )
+                except ib.IbkrDisconnectedError:
+                    raise
                 except Exception:
                     history_chunk = pd.DataFrame()
 
@@ -423,20 +410,8 @@ def updateRecordHistory(ibkr, records, indicesWithOutdatedData= pd.DataFrame(),
                     print('%s: No data available for %s-%s' % (datetime.datetime.today().strftime('%H:%M:%S'), row['symbol'], interval))
                     break
                 all_chunks.append(history_chunk)
-
-                # prepare next chunk endDate to go further back without gaps
-                earliest_in_chunk = pd.to_datetime(history_chunk['date'].min(), errors='coerce')
-                if pd.isna(earliest_in_chunk):
-                    break
-                endDate = earliest_in_chunk #- pd.Timedelta(minutes=1)
-
-                remaining -= chunk_days
                 count += 1
 
-                # if remaining > 0:
-                #     print('%s: [yellow]Pausing %.2fs before next record...[/yellow]' % (datetime.datetime.now().strftime("%H:%M:%S"), ibkrThrottleTime/4))
-                #     time.sleep(ibkrThrottleTime/4)
-
             if not all_chunks:
                 continue
 
@@ -461,17 +436,7 @@ def updateRecordHistory(ibkr, records, indicesWithOutdatedData= pd.DataFrame(),
         print('%s: [yellow]Some records have missing intervals, updating...[/yellow]'%(datetime.datetime.now().strftime("%H:%M:%S")))
         for item in missingIntervals:
             [_tkr, _intvl] = item.split('-')
-            if ( _intvl in ['5 mins', '15 mins']):
-                history = ib.getBars(ibkr, symbol=_tkr,lookback='100 D', interval=_intvl )
-            
-            elif ( _intvl in ['1 min']):
-                history = ib.getBars(ibkr, symbol=_tkr,lookback='10 D', interval=_intvl )
-            
-            elif (_intvl in ['30 mins', '1 day', '1 hour']):
-                history = ib.getBars(ibkr, symbol=_tkr,lookback='365 D', interval=_intvl )
-
-            elif (_intvl in ['1 month']):
-                history = ib.getBars(ibkr, symbol=_tkr,lookback='2 Y', interval=_intvl )
+            history = ib.getBars(ibkr, symbol=_tkr, lookback=planner.get_max_lookback(_intvl), interval=_intvl)
             
             if history.empty:
                 print('%s: [yellow]No data available for %s-%s[/yellow]'%(datetime.datetime.now().strftime("%H:%M:%S"), _tkr, _intvl))
@@ -521,9 +486,10 @@ def getMissingIntervals(records, type = 'stock'):
     ## return the missing symbol-interval combos
     return missingCombos
 
-def updatePreHistoricData(ibkr):
+def updatePreHistoricData(ibkr, symbols=None, intervals=None):
     """
     Updates a chunk of pre-histric data for existing records  
+    symbols, intervals: optionally restrict the pass to these records (used by fetch_scheduler)
     __
     Logic:
     0. get records from the lookup table
@@ -543,6 +509,10 @@ def updatePreHistoricData(ibkr):
         (lookupTable['numMissingBusinessDays'] > 2) | (lookupTable['numMissingBusinessDays'].isnull())
     ].reset_index(drop=True)
     lookupTable = lookupTable.loc[~lookupTable['symbol'].isin(config.delisted_symbols)]
+    if symbols is not None:
+        lookupTable = lookupTable.loc[lookupTable['symbol'].isin(symbols)]
+    if intervals is not None:
+        lookupTable = lookupTable.loc[lookupTable['interval'].apply(lambda x: _addspace(x)).isin([_addspace(i.replace(' ', '')) for i in intervals])]
 
     if lookupTable.empty:
         print('[green]All historic data has been loaded![/green]')
@@ -581,6 +551,8 @@ def updatePreHistoricData(ibkr):
                     ibkr,
                     get_contract(symbol=symbol, type='index' if symbol in _index else 'stock')
                 )
+            except ib.IbkrDisconnectedError:
+                raise
             except Exception:
                 symbol_earliest_ts_cache[symbol] = pd.NaT
 
@@ -604,68 +576,53 @@ def updatePreHistoricData(ibkr):
                 print('[yellow]Skipping %s-%s due to invalid firstRecordDate.[/yellow]' % (symbol, interval))
                 continue
 
-            if interval == '1 min':
-                base_lookback_days = 5
-            elif interval == '1 day':
-                base_lookback_days = 100
-            else:
-                base_lookback_days = 30
+            # plan the fewest requests from the first stored record back to the head timestamp
+            requests = planner.plan_requests(
+                interval,
+                [(earliestAvailableTimestamp, endDate)],
+                contract_start=earliestAvailableTimestamp,
+                exchange=exchange_mapping.get(symbol, 'SMART'))
 
-            empty_retry_count = 0
-            max_empty_retries = 3
             had_backward_progress = False
 
-            print('%s: Updating %s-%s from %s back to %s' % (
+            print('%s: Updating %s-%s from %s back to %s in %s request(s)' % (
                 datetime.datetime.now().strftime("%H:%M:%S"),
                 symbol,
                 interval,
                 endDate,
-                earliestAvailableTimestamp
+                earliestAvailableTimestamp,
+                len(requests)
             ))
 
-            while True:
-                remaining_days = (endDate - earliestAvailableTimestamp).days
-                if remaining_days <= 0:
-                    print('[green]Exhausted available history for %s-%s[/green]' % (symbol, interval))
-                    break
-
-                lookback_days = min(base_lookback_days, remaining_days)
-                if lookback_days <= 0:
-                    break
+            if not requests:
+                print('[green]Exhausted available history for %s-%s[/green]' % (symbol, interval))
 
+            for request in requests:
                 if ibkr_call_count and ibkr_call_count % max_consecutive_calls == 0:
                     ibkr = ib.refreshConnection(ibkr)
 
+                # retryable failures are retried inside interface_ibkr under the shared retry budget
                 try:
                     currentIterationHistoricalBars = ib.getBars(
                         ibkr,
                         symbol=symbol,
-                        lookback='%s D' % lookback_days,
+                        lookback=request['lookback'],
                         interval=interval,
-                        endDate=endDate
+                        endDate=request['endDate']
                     )
                     ibkr_call_count += 1
+                except ib.IbkrDisconnectedError:
+                    raise
                 except Exception:
                     currentIterationHistoricalBars = pd.DataFrame()
 
                 if currentIterationHistoricalBars.empty:
-                    empty_retry_count += 1
-                    if empty_retry_count <= max_empty_retries:
-                        print('[yellow]Empty history for %s-%s. Retry %s/%s...[/yellow]' % (
-                            symbol,
-                            interval,
-                            empty_retry_count,
-                            max_empty_retries
-                        ))
-                        continue
-
-                    print('[yellow]No data returned after retries for %s-%s. Moving to next interval.[/yellow]' % (
+                    print('[yellow]No data returned for %s-%s. Moving to next interval.[/yellow]' % (
                         symbol,
                         interval
                     ))
                     break
 
-                empty_retry_count = 0
                 chunk_min_date = pd.to_datetime(currentIterationHistoricalBars['date'].min(), errors='coerce')
                 if pd.isna(chunk_min_date):
                     print('[yellow]Invalid date values returned for %s-%s. Moving to next interval.[/yellow]' % (
@@ -674,7 +631,7 @@ def updatePreHistoricData(ibkr):
                     ))
                     break
 
-                # guard against non-progressing windows that can cause infinite loops
+                # guard against windows that return nothing older than what is stored
                 if chunk_min_date >= endDate:
                     print('[yellow]No backward progress for %s-%s (chunk min: %s, endDate: %s). Moving to next interval.[/yellow]' % (
                         symbol,
@@ -759,6 +716,8 @@ def _fetch_earliest_available_timestamps(ibkr, lookupRecords):
             ts = ib.getEarliestTimeStamp(ibkr, contract)
             if not ts:
                 continue
+        except ib.IbkrDisconnectedError:
+            raise
         except Exception:
             ts = pd.NaT
 
@@ -894,18 +853,23 @@ def bulkUpdate():
     cycletime_= []
     print('\n[green]Starting bulk update of pre-historic data...[/green]')
     while i < numcycles:
-        ## connect to ibkr
-        ibkr = ib.setupConnection()
-
-        if not ibkr.isConnected():  
-            print('[red]  Exiting!\n[/red]')
-            return
         starttime = datetime.datetime.now()
-        
-        # refreshLookupTable(ibkr, _dbName_index, fetchEarliestTimestamps=False)
-        # ibkr = ib.refreshConnection(ibkr)        
-        updatePreHistoricData(ibkr)
-        ibkr.disconnect()
+        ibkr = None
+        try:
+            ## connect to ibkr
+            ibkr = ib.setupConnection()
+            
+            # refreshLookupTable(ibkr, _dbName_index, fetchEarliestTimestamps=False)
+            # ibkr = ib.refreshConnection(ibkr)        
+            updatePreHistoricData(ibkr)
+        except ib.IbkrDisconnectedError as e:
+            # an outage only costs this cycle, the next one resumes from the first stored record
+            print('%s: [red]IBKR unavailable (%s), retrying next cycle[/red]'%(datetime.datetime.now().strftime("%H:%M:%S"), e))
+        finally:
+            # a session left open (e.g. after a 1100 wait timed out) would make TWS refuse
+            # the next cycle's connection on the same client id (326)
+            if ibkr is not None:
+                ibkr.disconnect()
 
         cycletime = (datetime.datetime.now() - starttime).seconds
         # add cycle time to list
@@ -920,21 +884,22 @@ def bulkUpdate():
             time.sleep(ibkrThrottleTime * 10)
         i=i+1
 
-# if more than 0 args
-if len(argv) > 1:
-    if argv[1] == 'csv':
-        #update_vix_futures_history_from_rwtools(config.dbname_rwtools_futures_vix_csv)
-        # if no arg 2 , print 
-        updateHistoryFromCSV('data/FXB.csv', 'FXB', '1day')
-        #print('error 11 - no csv file specified')
-else:
-
-    # print('\n\n*****!!!!!!!!!*****!!!!    SLEEPING FOR 2 HOURS BEFORE STARTING UPDATE...    !!!!*****!!!!!!!!!*****\n\n')
-    # time.sleep(7200)
-
-    ## update existing records after EST market close or on weekends
-    if (datetime.datetime.today().weekday() < 5 and datetime.datetime.now().hour >= 17) or (datetime.datetime.today().weekday() > 6): #or (datetime.datetime.today().weekday() < 5 and datetime.datetime.now().hour<= 9):
-        print('[green]Updating existing records...[/green]')
-        updateRecords()
+if __name__ == '__main__':
+    # if more than 0 args
+    if len(argv) > 1:
+        if argv[1] == 'csv':
+            #update_vix_futures_history_from_rwtools(config.dbname_rwtools_futures_vix_csv)
+            # if no arg 2 , print 
+            updateHistoryFromCSV('data/FXB.csv', 'FXB', '1day')
+            #print('error 11 - no csv file specified')
+    else:
+
+        # print('\n\n*****!!!!!!!!!*****!!!!    SLEEPING FOR 2 HOURS BEFORE STARTING UPDATE...    !!!!*****!!!!!!!!!*****\n\n')
+        # time.sleep(7200)
+
+        ## update existing records after EST market close or on weekends
+        if (datetime.datetime.today().weekday() < 5 and datetime.datetime.now().hour >= 17) or (datetime.datetime.today().weekday() > 6): #or (datetime.datetime.today().weekday() < 5 and datetime.datetime.now().hour<= 9):
+            print('[green]Updating existing records...[/green]')
+            updateRecords()
     
-    bulkUpdate()
+        bulkUpdate()
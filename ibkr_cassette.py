@@ -0,0 +1,328 @@
+"""
+Record/replay layer for IBKR sessions.
+
+record: wraps a live (or fake) session, forwards every call and appends each request with its
+        response, round trip and pacing wait to a cassette file
+replay: serves the recorded responses without a broker connection, with the original timing
+        (speed=1) or compressed (speed>1, 0 = no waiting at all)
+
+Recorded calls: reqHistoricalData, reqHeadTimeStamp, reqContractDetails, qualifyContracts, reqMktData.
+Identical requests are served back in the order they were recorded, together with the error events
+IBKR raised while they ran, so circuit breaker, retry and resume paths take the same turns on replay.
+A request that was never recorded raises CassetteMissError instead of coming back empty.
+
+The cassette is a gzip stream of pickled records, appended as the run progresses so a
+crashed overnight run still leaves a usable cassette; each recording run starts a new file. Its first record holds the time the recording
+started; while replaying, now() returns that time so request parameters computed from the wall
+clock (endDateTime, durationStr, days since last update) match the recorded ones.
+
+Enable with config.ibkr_cassette_mode = 'record' | 'replay' (or IBKR_CASSETTE / IBKR_CASSETTE_PATH
+in the environment); ibkr_connection_pool wraps every session it opens.
+"""
+from rich import print
+
+import copy
+import dataclasses
+import datetime
+import gzip
+import os
+import pickle
+import threading
+import time
+from collections import defaultdict, deque
+
+import pandas as pd
+
+import config
+
+_CONTRACT_KEY_FIELDS = ['secType', 'symbol', 'lastTradeDateOrContractMonth', 'exchange', 'currency', 'localSymbol']
+
+_file_lock = threading.Lock()
+_started_at = {}
+_recording_paths = set()
+
+class CassetteMissError(LookupError):
+    """
+        Raised on replay for a request the cassette has no recording of
+    """
+    pass
+
+def get_mode():
+    mode = os.environ.get('IBKR_CASSETTE') or getattr(config, 'ibkr_cassette_mode', None)
+    return mode.lower() if mode else None
+
+def get_path():
+    return os.environ.get('IBKR_CASSETTE_PATH') or getattr(config, 'ibkr_cassette_path', 'ibkr_cassette.pkl.gz')
+
+def get_speed():
+    return float(os.environ.get('IBKR_CASSETTE_SPEED', getattr(config, 'ibkr_cassette_speed', 1.0)))
+
+def _read_header(path):
+    try:
+        with gzip.open(path, 'rb') as f:
+            record = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+    return record if record.get('header') else None
+
+def now():
+    """
+        Returns the time request parameters are computed from: the recording's start time while
+        replaying a cassette, the current time otherwise
+    """
+    if get_mode() != 'replay':
+        return pd.Timestamp.now()
+    path = get_path()
+    if path not in _started_at:
+        header = _read_header(path)
+        _started_at[path] = None if header is None else pd.Timestamp(header['started_at'])
+    started_at = _started_at[path]
+    return pd.Timestamp.now() if started_at is None else started_at
+
+def _contract_key(contract):
+    return tuple(str(getattr(contract, field, '') or '') for field in _CONTRACT_KEY_FIELDS)
+
+def _arg_key(value):
+    if dataclasses.is_dataclass(value):
+        return _contract_key(value)
+    if isinstance(value, (list, tuple)):
+        return tuple(_arg_key(v) for v in value)
+    return str(value)
+
+def request_key(method, args, kwargs):
+    """
+        Hashable key identifying a request independent of object identity
+    """
+    return (method, tuple(_arg_key(a) for a in args), tuple(sorted((k, _arg_key(v)) for k, v in kwargs.items())))
+
+def load(path):
+    """
+        Returns the request records of a cassette file in recorded order
+    """
+    records = []
+    if not os.path.exists(path):
+        return records
+    with gzip.open(path, 'rb') as f:
+        while True:
+            try:
+                record = pickle.load(f)
+            except EOFError:
+                break
+            if not record.get('header'):
+                records.append(record)
+    return records
+
+def _pack_response(method, response):
+    if method == 'reqHistoricalData':
+        # BarDataList carries request state (and an event) we do not need, keep just the bars
+        return {'bars': [copy.copy(bar) for bar in response], 'attrs': {k: getattr(response, k, None) for k in ['barSizeSetting', 'durationStr', 'whatToShow', 'useRTH']}}
+    if method == 'qualifyContracts':
+        return [dataclasses.asdict(c) for c in response]
+    if method == 'reqMktData':
+        return {k: getattr(response, k, None) for k in ['time', 'last', 'bid', 'ask', 'close', 'high', 'low', 'volume']}
+    return response
+
+class _ReplayClient:
+    def __init__(self):
+        self.clientId = -1
+
+class CassetteIB:
+    """
+        Wraps an IB-like session for record, or stands in for one on replay
+    """
+    def __init__(self, mode, path=None, inner=None, speed=None):
+        if mode not in ('record', 'replay'):
+            raise ValueError('Unknown cassette mode: %s' % mode)
+        self.mode = mode
+        self.path = get_path() if path is None else path
+        self.speed = get_speed() if speed is None else speed
+        self._inner = inner
+        self._pending_pacing_wait = 0.0
+        self._pending_errors = []
+        # replay sessions do their own (scaled) waiting, so interface_ibkr skips live pacing
+        self.requires_pacing = mode == 'record' or self.speed == 1.0
+
+        if mode == 'record':
+            self._write_header()
+            event = getattr(inner, 'errorEvent', None)
+            if event is not None:
+                event += self._on_error
+
+        if mode == 'replay':
+            from eventkit import Event
+            self.client = _ReplayClient()
+            self.errorEvent = Event('errorEvent')
+            self.timeoutEvent = Event('timeoutEvent')
+            self.disconnectedEvent = Event('disconnectedEvent')
+            self._connected = False
+            self._responses = defaultdict(deque)
+            self._last_response = {}
+            for record in load(self.path):
+                self._responses[record['key']].append(record)
+            print('%s: [yellow]Replaying %s IBKR requests from %s[/yellow]' % (
+                datetime.datetime.now().strftime('%H:%M:%S'), sum(len(q) for q in self._responses.values()), self.path))
+
+    def __getattr__(self, name):
+        # only reached for attributes not set on the wrapper
+        inner = self.__dict__.get('_inner')
+        if inner is None:
+            raise AttributeError(name)
+        return getattr(inner, name)
+
+    ##################### session
+    def connect(self, *args, **kwargs):
+        if self.mode == 'record':
+            self._inner.connect(*args, **kwargs)
+        else:
+            self.client.clientId = kwargs.get('clientId', args[2] if len(args) > 2 else -1)
+            self._connected = True
+        return self
+
+    def disconnect(self):
+        if self.mode == 'record':
+            return self._inner.disconnect()
+        self._connected = False
+
+    def isConnected(self):
+        if self.mode == 'record':
+            return self._inner.isConnected()
+        return self._connected
+
+    def sleep(self, secs=0.02):
+        if self.mode == 'record':
+            self._pending_pacing_wait += secs
+            return self._inner.sleep(secs)
+        if self.speed > 0:
+            time.sleep(secs / self.speed)
+        return True
+
+    def reqCurrentTime(self):
+        if self.mode == 'record':
+            return self._inner.reqCurrentTime()
+        return datetime.datetime.now(datetime.timezone.utc)
+
+    ##################### record
+    def _write_header(self):
+        # sessions of a pool share the cassette: the first one in the process starts a fresh file and
+        # stamps the start time, a cassette left by an earlier run is replaced rather than mixed in
+        with _file_lock:
+            if self.path in _recording_paths:
+                return
+            _recording_paths.add(self.path)
+            if os.path.exists(self.path) and os.path.getsize(self.path) > 0:
+                print('%s: [yellow]Overwriting IBKR cassette %s from an earlier recording[/yellow]' % (datetime.datetime.now().strftime('%H:%M:%S'), self.path))
+            with gzip.open(self.path, 'wb') as f:
+                pickle.dump({'header': True, 'started_at': pd.Timestamp.now().floor('s')}, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def _on_error(self, reqId, errorCode, errorString, contract=None):
+        self._pending_errors.append((reqId, errorCode, errorString, copy.copy(contract)))
+
+    def _record(self, method_name, method, args, kwargs):
+        # key before the call, qualifyContracts fills contracts in place
+        key = request_key(method_name, args, kwargs)
+        self._pending_errors = []
+        started = time.monotonic()
+        response = method(*args, **kwargs)
+        elapsed = time.monotonic() - started
+
+        record = {
+            'key': key,
+            'method': method_name,
+            'recorded_at': datetime.datetime.now(),
+            'elapsed': elapsed,
+            'pacing_wait': self._pending_pacing_wait,
+            'response': _pack_response(method_name, response),
+            'errors': self._pending_errors,
+        }
+        self._pending_pacing_wait = 0.0
+        self._pending_errors = []
+        with _file_lock:
+            with gzip.open(self.path, 'ab') as f:
+                pickle.dump(record, f, protocol=pickle.HIGHEST_PROTOCOL)
+        return response
+
+    ##################### replay
+    def _next_record(self, method_name, args, kwargs):
+        if not self._connected:
+            raise ConnectionError('Not connected')
+        key = request_key(method_name, args, kwargs)
+        queue = self._responses.get(key)
+        if queue:
+            record = queue.popleft()
+            self._last_response[key] = record
+        elif key in self._last_response:
+            # repeated more often than recorded, serve the last answer again
+            record = self._last_response[key]
+        else:
+            raise CassetteMissError('No recorded response in %s for %s' % (self.path, key))
+
+        if self.speed > 0:
+            wait = record['elapsed'] + (0.0 if self.requires_pacing else record['pacing_wait'])
+            time.sleep(wait / self.speed)
+        # errors arrive while the request runs, before its response
+        for error in record.get('errors', []):
+            self.errorEvent.emit(*error)
+        return record['response']
+
+    def reqHistoricalData(self, contract, *args, **kwargs):
+        if self.mode == 'record':
+            return self._record('reqHistoricalData', self._inner.reqHistoricalData, (contract,) + args, kwargs)
+        from ib_insync import BarDataList
+        response = self._next_record('reqHistoricalData', (contract,) + args, kwargs)
+        bars = BarDataList()
+        bars.contract = contract
+        if response:
+            for k, v in response['attrs'].items():
+                setattr(bars, k, v)
+            bars.extend(copy.copy(bar) for bar in response['bars'])
+        return bars
+
+    def reqHeadTimeStamp(self, *args, **kwargs):
+        if self.mode == 'record':
+            return self._record('reqHeadTimeStamp', self._inner.reqHeadTimeStamp, args, kwargs)
+        return self._next_record('reqHeadTimeStamp', args, kwargs)
+
+    def reqContractDetails(self, *args, **kwargs):
+        if self.mode == 'record':
+            return self._record('reqContractDetails', self._inner.reqContractDetails, args, kwargs)
+        return copy.deepcopy(self._next_record('reqContractDetails', args, kwargs) or [])
+
+    def qualifyContracts(self, *contracts):
+        if self.mode == 'record':
+            return self._record('qualifyContracts', self._inner.qualifyContracts, contracts, {})
+        # keys are taken before the contracts are filled in, same as when recording
+        fields = self._next_record('qualifyContracts', contracts, {}) or []
+        for contract, values in zip(contracts, fields):
+            for k, v in values.items():
+                setattr(contract, k, v)
+        return list(contracts)[:len(fields)]
+
+    def reqMktData(self, contract, *args, **kwargs):
+        if self.mode == 'record':
+            return self._record('reqMktData', self._inner.reqMktData, (contract,) + args, kwargs)
+        from ib_insync import Ticker
+        values = self._next_record('reqMktData', (contract,) + args, kwargs) or {}
+        return Ticker(contract=contract, **{k: v for k, v in values.items() if v is not None})
+
+    def cancelHistoricalData(self, *args, **kwargs):
+        if self.mode == 'record':
+            return self._inner.cancelHistoricalData(*args, **kwargs)
+
+    def cancelMktData(self, *args, **kwargs):
+        if self.mode == 'record':
+            return self._inner.cancelMktData(*args, **kwargs)
+
+    def cancelHeadTimeStamp(self, *args, **kwargs):
+        if self.mode == 'record':
+            return self._inner.cancelHeadTimeStamp(*args, **kwargs)
+
+def wrap(ibkr=None):
+    """
+        Wraps a new session per the configured cassette mode, returns it unchanged when off
+    """
+    mode = get_mode()
+    if mode is None:
+        return ibkr
+    if mode == 'replay':
+        return CassetteIB('replay')
+    return CassetteIB('record', inner=ibkr)
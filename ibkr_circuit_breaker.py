@@ -0,0 +1,314 @@
+"""
+Failure handling for IBKR requests.
+
+    - classify(): sorts IBKR error codes/messages into classes that decide what happens next
+        pacing, transient      retried (after config.ibkr_retry_backoff_seconds) while the retry budget lasts
+        no_data, no_permission,
+        invalid_contract       not retried, counted against the contract's breaker
+        connectivity           left to the reconnect/resume logic in interface_ibkr
+        invalid_request        our request is malformed, neither retried nor counted
+    - per-contract circuit breakers: after config.ibkr_breaker_thresholds[class] consecutive failures a
+      contract's breaker opens and its requests are skipped until config.ibkr_breaker_open_hours[class]
+      have passed. One probe request is then let through (half open); if it fails the breaker re-opens
+      for twice as long (capped at config.ibkr_breaker_max_open_hours), if it succeeds the breaker closes.
+      Breakers are persisted (config.dbname_ibkr_state) so dead contracts stay skipped across runs. They are
+      written with sqlite3 directly, interface_ibkr imports this module and does not depend on the db module.
+      Extra series and gap fill requests count against breakers of their own (see contract_key).
+    - a global retry budget: at most config.ibkr_retry_budget retries per rolling
+      config.ibkr_retry_budget_window_seconds, shared by every request in the process.
+
+interface_ibkr._request_with_resume applies all of this to every request that carries a contract.
+"""
+from rich import print
+
+import datetime
+import sqlite3
+import threading
+import time
+from collections import deque
+
+import pandas as pd
+
+import config
+
+RETRYABLE = ('pacing', 'transient')
+PERMANENT = ('no_data', 'no_permission', 'invalid_contract')
+
+_ERROR_CODE_CLASSES = {
+    200: 'invalid_contract',    # no security definition found
+    354: 'no_permission',       # market data not subscribed
+    10090: 'no_permission',     # part of requested market data is not subscribed
+    10167: 'no_permission',     # delayed data only
+    10168: 'no_permission',     # market data not subscribed, delayed data not enabled
+    321: 'invalid_request',     # error validating request
+    322: 'pacing',              # duplicate / too many requests
+    366: 'transient',           # no historical data query found
+    420: 'pacing',              # invalid real-time query / pacing
+    502: 'connectivity',
+    504: 'connectivity',
+    1100: 'connectivity',
+    2110: 'connectivity',
+}
+
+# informational codes that arrive on the request id but do not mean it failed
+_INFO_CODES = {165, 2104, 2106, 2107, 2108, 2158}
+
+_lock = threading.Lock()
+_breakers = None
+_retry_timestamps = deque()
+
+def _now():
+    return datetime.datetime.now().strftime('%H:%M:%S')
+
+def classify(error_code, error_string=''):
+    """
+        Returns the failure class of an IBKR error, None for informational messages
+    """
+    if error_code in _INFO_CODES:
+        return None
+    if error_code == 162:
+        # 162 is a catch-all for historical data errors, the message tells them apart
+        message = str(error_string).lower()
+        if 'pacing violation' in message:
+            return 'pacing'
+        if 'no data' in message:
+            return 'no_data'
+        if 'permission' in message or 'not subscribed' in message:
+            return 'no_permission'
+        return 'transient'
+    return _ERROR_CODE_CLASSES.get(error_code, 'transient')
+
+def worst_class(classes):
+    """
+        Returns the class that decides the outcome when a request raised several errors
+    """
+    for failure_class in ['invalid_contract', 'no_permission', 'no_data', 'invalid_request', 'connectivity', 'pacing', 'transient']:
+        if failure_class in classes:
+            return failure_class
+    return None
+
+class ErrorCollector:
+    """
+        Collects the errors IBKR raises while a request runs
+        usage:
+            with ErrorCollector(ibkr) as errors:
+                ibkr.reqHistoricalData(...)
+            errors.classes
+    """
+    def __init__(self, ibkr):
+        self.ibkr = ibkr
+        self.errors = []
+
+    def _on_error(self, reqId, errorCode, errorString, contract=None):
+        # reqId -1 are session wide notices, handled by the connection pool
+        if reqId == -1:
+            return
+        failure_class = classify(errorCode, errorString)
+        if failure_class is not None:
+            self.errors.append((errorCode, errorString, failure_class))
+
+    def __enter__(self):
+        event = getattr(self.ibkr, 'errorEvent', None)
+        if event is not None:
+            event += self._on_error
+        return self
+
+    def __exit__(self, *exc):
+        event = getattr(self.ibkr, 'errorEvent', None)
+        if event is not None:
+            event -= self._on_error
+        return False
+
+    @property
+    def classes(self):
+        return [failure_class for _, _, failure_class in self.errors]
+
+    @property
+    def last_error(self):
+        if not self.errors:
+            return None
+        code, message, _ = self.errors[-1]
+        return '%s: %s' % (code, message)
+
+##################### retry budget
+def take_retry():
+    """
+        Takes one retry from the global budget, False when it is used up
+    """
+    now = time.monotonic()
+    with _lock:
+        while _retry_timestamps and (now - _retry_timestamps[0]) >= config.ibkr_retry_budget_window_seconds:
+            _retry_timestamps.popleft()
+        if len(_retry_timestamps) >= config.ibkr_retry_budget:
+            return False
+        _retry_timestamps.append(now)
+        return True
+
+##################### circuit breakers
+def contract_key(contract, series=None, scope=None):
+    """
+        Breaker key of a contract; extra whatToShow series (config.extra_series) get their own breaker so a
+        series IBKR will not serve never blocks the contract's TRADES bars.
+        scope: kind of request with its own breaker, e.g. 'gap_fill' windows that IBKR may answer with
+        no data (unrecorded sessions) without that blocking the contract's forward fill
+    """
+    key = '|'.join(str(getattr(contract, field, '') or '') for field in ['secType', 'symbol', 'lastTradeDateOrContractMonth', 'exchange', 'currency'])
+    if series is not None and series != 'TRADES':
+        key = '%s|%s' % (key, series)
+    if scope is not None:
+        key = '%s|%s' % (key, scope)
+    return key
+
+_COLUMNS = ['key', 'state', 'failures', 'trips', 'error_class', 'open_until', 'last_error', 'updated_at']
+
+def _connect():
+    conn = sqlite3.connect(config.dbname_ibkr_state)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS '%s' ("
+        "key TEXT PRIMARY KEY, "
+        "state TEXT NOT NULL, "
+        "failures INTEGER NOT NULL, "
+        "trips INTEGER NOT NULL, "
+        "error_class TEXT, "
+        "open_until TEXT, "
+        "last_error TEXT, "
+        "updated_at TEXT NOT NULL"
+        ")" % config.ibkr_breaker_table)
+    return conn
+
+def _to_text(ts):
+    return None if ts is None or pd.isna(ts) else pd.Timestamp(ts).strftime('%Y-%m-%d %H:%M:%S')
+
+def _read_breakers():
+    conn = _connect()
+    try:
+        rows = conn.execute("SELECT %s FROM '%s'" % (', '.join(_COLUMNS), config.ibkr_breaker_table)).fetchall()
+    finally:
+        conn.close()
+    breakers = {}
+    for row in rows:
+        breaker = dict(zip(_COLUMNS, row))
+        breaker['open_until'] = None if breaker['open_until'] is None else pd.Timestamp(breaker['open_until'])
+        breaker['updated_at'] = pd.Timestamp(breaker['updated_at'])
+        breakers[breaker['key']] = breaker
+    return breakers
+
+def _write_breaker(breaker):
+    conn = _connect()
+    try:
+        conn.execute(
+            "INSERT INTO '%s' (%s) VALUES (%s) ON CONFLICT(key) DO UPDATE SET %s" % (
+                config.ibkr_breaker_table, ', '.join(_COLUMNS), ', '.join('?' * len(_COLUMNS)),
+                ', '.join('%s=excluded.%s' % (col, col) for col in _COLUMNS if col != 'key')),
+            (breaker['key'], breaker['state'], int(breaker['failures']), int(breaker['trips']), breaker.get('error_class'),
+             _to_text(breaker.get('open_until')), breaker.get('last_error'), _to_text(breaker.get('updated_at'))))
+        conn.commit()
+    finally:
+        conn.close()
+
+def _load():
+    global _breakers
+    if _breakers is None:
+        try:
+            _breakers = _read_breakers()
+        except Exception as e:
+            print('%s: [yellow]Could not load IBKR circuit breakers: %s[/yellow]' % (_now(), e))
+            _breakers = {}
+    return _breakers
+
+def _save(breaker):
+    try:
+        _write_breaker(breaker)
+    except Exception as e:
+        # a breaker that is not persisted still works for this run
+        print('%s: [yellow]Could not save IBKR circuit breaker %s: %s[/yellow]' % (_now(), breaker['key'], e))
+
+def allow(contract, series=None, scope=None):
+    """
+        True when requests for the contract may be sent. An open breaker whose wait is over lets one probe through.
+    """
+    if contract is None:
+        return True
+    key = contract_key(contract, series, scope)
+    with _lock:
+        breaker = _load().get(key)
+        if breaker is None or breaker['state'] == 'closed':
+            return True
+        if breaker['state'] == 'half_open':
+            # the probe is already out
+            return False
+        if pd.Timestamp.now() < pd.Timestamp(breaker['open_until']):
+            return False
+        breaker['state'] = 'half_open'
+        breaker['updated_at'] = pd.Timestamp.now().floor('s')
+    print('%s: [yellow]Probing %s after its circuit breaker wait[/yellow]' % (_now(), key))
+    _save(breaker)
+    return True
+
+def record_success(contract, series=None, scope=None):
+    if contract is None:
+        return
+    key = contract_key(contract, series, scope)
+    with _lock:
+        breaker = _load().get(key)
+        if breaker is None or (breaker['state'] == 'closed' and breaker['failures'] == 0):
+            return
+        breaker.update({'state': 'closed', 'failures': 0, 'trips': 0, 'open_until': None, 'updated_at': pd.Timestamp.now().floor('s')})
+    print('%s: [green]Circuit breaker closed for %s[/green]' % (_now(), key))
+    _save(breaker)
+
+def record_failure(contract, failure_class, error=None, series=None, scope=None):
+    """
+        Counts a failed request against the contract, opening its breaker once the class threshold is reached
+    """
+    if contract is None or failure_class not in PERMANENT + RETRYABLE:
+        return
+    if failure_class == 'pacing':
+        # pacing is ours, not the contract's
+        return
+    key = contract_key(contract, series, scope)
+    now = pd.Timestamp.now().floor('s')
+    with _lock:
+        breakers = _load()
+        breaker = breakers.setdefault(key, {'key': key, 'state': 'closed', 'failures': 0, 'trips': 0, 'error_class': None, 'open_until': None, 'last_error': None, 'updated_at': now})
+        breaker['failures'] = 0 if breaker['error_class'] != failure_class else breaker['failures']
+        breaker['failures'] += 1
+        breaker['error_class'] = failure_class
+        breaker['last_error'] = None if error is None else str(error)[:500]
+        breaker['updated_at'] = now
+
+        tripped = breaker['state'] == 'half_open' or breaker['failures'] >= config.ibkr_breaker_thresholds.get(failure_class, 5)
+        if tripped:
+            hours = min(config.ibkr_breaker_open_hours.get(failure_class, 1) * (2 ** breaker['trips']), config.ibkr_breaker_max_open_hours)
+            breaker['trips'] += 1
+            breaker['state'] = 'open'
+            breaker['open_until'] = now + pd.Timedelta(hours=hours)
+    if tripped:
+        print('%s: [red]Circuit breaker open for %s (%s) until %s[/red]' % (_now(), key, failure_class, breaker['open_until']))
+    _save(breaker)
+
+def get_open_breakers():
+    """
+        Returns the breakers currently open or half open
+    """
+    with _lock:
+        return [dict(b) for b in _load().values() if b['state'] != 'closed']
+
+def reset(contract=None):
+    """
+        Closes the breakers of a contract (its series and scopes included), or every breaker
+    """
+    with _lock:
+        breakers = _load()
+        if contract is None:
+            keys = list(breakers.keys())
+        else:
+            base = contract_key(contract)
+            keys = [key for key in breakers if key == base or key.startswith(base + '|')]
+        changed = []
+        for key in keys:
+            if key in breakers:
+                breakers[key].update({'state': 'closed', 'failures': 0, 'trips': 0, 'open_until': None, 'updated_at': pd.Timestamp.now().floor('s')})
+                changed.append(breakers[key])
+    for breaker in changed:
+        _save(breaker)
@@ -0,0 +1,287 @@
+"""
+Pool of IBKR sessions against one TWS/Gateway.
+
+Each session uses its own client id (config.ibkr_pool_client_ids) so equity, futures and
+realtime jobs can run side by side without colliding on a single id. Sessions are
+health checked before they are handed out and reconnected with exponential backoff.
+
+Usage:
+    with ibkr_connection_pool.lease() as ibkr:
+        bars = interface_ibkr.getBars(ibkr, symbol='SPY', lookback='1 D', interval='1 min')
+
+Notes:
+    - ib_insync binds a session to the event loop it connected on. A session leased from a
+      different thread is reconnected on that thread's loop, so long-running workers should
+      hold their lease rather than acquiring per request.
+    - With config.ibkr_use_fake_server (or IBKR_FAKE=1) sessions are ibkr_fake_server.FakeIB.
+    - With config.ibkr_cassette_mode set sessions are recorded / replayed by ibkr_cassette.
+    - Request pacing stays global in interface_ibkr._paceIbkrRequest, all sessions share it.
+"""
+from ib_insync import IB
+from rich import print
+
+import asyncio
+import contextlib
+import datetime
+import threading
+import time
+
+import config
+import ibkr_cassette
+import ibkr_fake_server
+
+def _now():
+    return datetime.datetime.now().strftime('%H:%M:%S')
+
+def _get_thread_loop():
+    """
+        Returns the event loop of the calling thread, creating one for worker threads
+    """
+    try:
+        return asyncio.get_event_loop()
+    except RuntimeError:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        return loop
+
+# sessions whose TWS reported lost connectivity to IB (1100), id(ibkr) -> monotonic time lost
+_connectivity_lost = {}
+_watched_sessions = set()
+
+def _on_error(ibkr, reqId, errorCode, errorString, contract=None):
+    if errorCode == 1100:
+        print('%s: [red]IBKR connectivity lost (1100): %s[/red]' % (_now(), errorString))
+        _connectivity_lost.setdefault(id(ibkr), time.monotonic())
+    elif errorCode in (1101, 1102):
+        print('%s: [green]IBKR connectivity restored (%s)[/green]' % (_now(), errorCode))
+        _connectivity_lost.pop(id(ibkr), None)
+
+def watch_connectivity(ibkr):
+    """
+        Tracks 1100 / 1101 / 1102 connectivity messages for the session
+    """
+    if id(ibkr) in _watched_sessions:
+        return
+    _watched_sessions.add(id(ibkr))
+    ibkr.errorEvent += lambda reqId, errorCode, errorString, contract=None: _on_error(ibkr, reqId, errorCode, errorString, contract)
+
+def connectivity_lost(ibkr):
+    return id(ibkr) in _connectivity_lost
+
+def wait_for_connectivity(ibkr, timeout=None):
+    """
+        Blocks while TWS reports lost connectivity to IB, returns False if it is not restored in time
+    """
+    timeout = config.ibkr_connectivity_wait_seconds if timeout is None else timeout
+    started = time.monotonic()
+    while connectivity_lost(ibkr):
+        if time.monotonic() - started >= timeout:
+            return False
+        ibkr.sleep(1)
+    return True
+
+def connect(client_id=None, host=None, port=None, ibkr=None):
+    """
+        Connects a single session, returns the IB object. Raises on failure.
+    """
+    client_id = config.ibkr_client_id if client_id is None else client_id
+    host = config.ibkr_host if host is None else host
+    port = config.ibkr_port if port is None else port
+
+    _get_thread_loop()
+    if ibkr is None:
+        ibkr = ibkr_fake_server.FakeIB() if ibkr_fake_server.is_enabled() else IB()
+        ibkr = ibkr_cassette.wrap(ibkr)
+        watch_connectivity(ibkr)
+    # a fresh connection starts with connectivity intact
+    _connectivity_lost.pop(id(ibkr), None)
+    ibkr.connect(host, port, clientId=client_id, timeout=config.ibkr_connect_timeout_seconds)
+    return ibkr
+
+def connect_with_backoff(client_id=None, ibkr=None, max_attempts=None):
+    """
+        Connects a session, retrying with exponential backoff
+        returns:
+            connected IB object, or None once max_attempts is exhausted
+    """
+    client_id = config.ibkr_client_id if client_id is None else client_id
+    max_attempts = config.ibkr_reconnect_max_attempts if max_attempts is None else max_attempts
+    delay = config.ibkr_reconnect_backoff_seconds
+
+    for attempt in range(1, max_attempts + 1):
+        try:
+            if ibkr is not None and ibkr.isConnected():
+                ibkr.disconnect()
+            return connect(client_id, ibkr=ibkr)
+        except Exception as e:
+            print('%s: [yellow]IBKR connect failed for client id %s (attempt %s/%s): %s[/yellow]' % (_now(), client_id, attempt, max_attempts, e))
+            if attempt == max_attempts:
+                break
+            time.sleep(delay)
+            delay = min(delay * 2, config.ibkr_reconnect_backoff_max_seconds)
+
+    print('%s: [red]Could not connect with IBKR on client id %s[/red]' % (_now(), client_id))
+    return None
+
+def is_healthy(ibkr):
+    """
+        True when the session is connected and answers a reqCurrentTime round trip
+    """
+    if ibkr is None or not ibkr.isConnected():
+        return False
+    try:
+        return ibkr.reqCurrentTime() is not None
+    except Exception:
+        return False
+
+class _Session:
+    def __init__(self, client_id):
+        self.client_id = client_id
+        self.ibkr = None
+        self.loop = None
+        self.last_health_check = 0.0
+
+class IbkrConnectionPool:
+    """
+        Hands out one IBKR session per client id to concurrent workers.
+        acquire() blocks until a client id is free, release() returns it.
+    """
+    def __init__(self, client_ids=None):
+        client_ids = list(config.ibkr_pool_client_ids if client_ids is None else client_ids)
+        if not client_ids:
+            raise ValueError('IBKR connection pool needs at least one client id')
+        if config.ibkr_client_id in client_ids:
+            # setupConnection() sessions use this id outside the pool, both at once would collide (326)
+            raise ValueError('IBKR connection pool client ids must not include config.ibkr_client_id (%s)' % config.ibkr_client_id)
+        self._sessions = {client_id: _Session(client_id) for client_id in client_ids}
+        self._idle = list(client_ids)
+        self._leased = {}
+        self._condition = threading.Condition()
+
+    @property
+    def size(self):
+        return len(self._sessions)
+
+    def _ensure_connected(self, session):
+        loop = _get_thread_loop()
+        if session.ibkr is not None and session.loop is not loop:
+            # session was opened on another thread's loop, it cannot be driven from here
+            with contextlib.suppress(Exception):
+                session.ibkr.disconnect()
+            session.ibkr = None
+
+        check_due = (time.monotonic() - session.last_health_check) >= config.ibkr_health_check_interval_seconds
+        if session.ibkr is not None and session.ibkr.isConnected() and (not check_due or is_healthy(session.ibkr)):
+            if check_due:
+                session.last_health_check = time.monotonic()
+            return session.ibkr
+
+        if session.ibkr is not None:
+            print('%s: [yellow]IBKR session %s unhealthy, reconnecting...[/yellow]' % (_now(), session.client_id))
+        session.ibkr = connect_with_backoff(session.client_id, ibkr=session.ibkr)
+        session.loop = loop
+        session.last_health_check = time.monotonic()
+        return session.ibkr
+
+    def acquire(self, timeout=None):
+        """
+            Leases a healthy session, blocking up to timeout seconds for a free client id.
+            Returns None when no client id frees up in time or the session cannot connect.
+        """
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._idle, timeout=timeout):
+                return None
+            client_id = self._idle.pop(0)
+
+        session = self._sessions[client_id]
+        try:
+            ibkr = self._ensure_connected(session)
+        except Exception:
+            ibkr = None
+        if ibkr is None:
+            self._return(client_id)
+            return None
+
+        with self._condition:
+            self._leased[id(ibkr)] = client_id
+        return ibkr
+
+    def _return(self, client_id):
+        with self._condition:
+            self._idle.append(client_id)
+            self._condition.notify()
+
+    def release(self, ibkr):
+        """
+            Returns a leased session to the pool
+        """
+        if ibkr is None:
+            return
+        with self._condition:
+            client_id = self._leased.pop(id(ibkr), None)
+        if client_id is not None:
+            self._return(client_id)
+
+    def refresh(self, ibkr):
+        """
+            Reconnects a leased session in place, keeping its client id
+        """
+        with self._condition:
+            client_id = self._leased.get(id(ibkr))
+        if client_id is None:
+            return ibkr
+        session = self._sessions[client_id]
+        session.ibkr = connect_with_backoff(client_id, ibkr=ibkr)
+        session.loop = _get_thread_loop()
+        session.last_health_check = time.monotonic()
+        if session.ibkr is None:
+            # lease is lost with the session, free the client id for a later reconnect
+            with self._condition:
+                self._leased.pop(id(ibkr), None)
+            self._return(client_id)
+        return session.ibkr
+
+    def is_leased(self, ibkr):
+        with self._condition:
+            return id(ibkr) in self._leased
+
+    @contextlib.contextmanager
+    def lease(self, timeout=None):
+        ibkr = self.acquire(timeout=timeout)
+        if ibkr is None:
+            raise ConnectionError('No IBKR session available from the pool')
+        try:
+            yield ibkr
+        finally:
+            self.release(ibkr)
+
+    def close_all(self):
+        """
+            Disconnects every session, leased or not
+        """
+        with self._condition:
+            for session in self._sessions.values():
+                if session.ibkr is not None:
+                    with contextlib.suppress(Exception):
+                        session.ibkr.disconnect()
+                session.ibkr = None
+                session.loop = None
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """
+        Returns the process-wide pool, created on first use from config
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = IbkrConnectionPool()
+        return _pool
+
+def lease(timeout=None):
+    """
+        Shortcut for get_pool().lease()
+    """
+    return get_pool().lease(timeout=timeout)
@@ -0,0 +1,385 @@
+"""
+Local stand-in for the IBKR API surface used by this repo.
+
+FakeIB mirrors the ib_insync.IB methods interface_ibkr, the maintainers and realtime_monitor
+call (connect, reqHistoricalData, reqHeadTimeStamp, reqContractDetails, reqMktData, ...)
+so the fetch and save loops can be benchmarked and exercised without TWS.
+
+    - bars and contracts are synthetic and deterministic: the same request always returns the
+      same data, and overlapping requests agree bar for bar
+    - sessions follow the exchange holiday calendar used elsewhere (checkDataIntegrity)
+    - optional pacing enforcement and injected error codes:
+        162  historical data farm error / pacing violation, request returns no bars
+        1100 connectivity between TWS and IB lost, request returns no bars
+        504  not connected, session drops and the request raises ConnectionError
+
+Enable with config.ibkr_use_fake_server = True or IBKR_FAKE=1 in the environment;
+ibkr_connection_pool then hands out FakeIB sessions instead of connecting to TWS.
+"""
+from eventkit import Event
+from ib_insync import BarData, BarDataList, ContractDetails, Future, Ticker
+
+import collections
+import datetime
+import os
+import threading
+import time
+import zlib
+
+import numpy as np
+import pandas as pd
+
+import config
+import checkDataIntegrity as cdi
+
+_TIMEZONE = 'US/Eastern'
+_DURATION_UNIT_DAYS = {'W': 7, 'M': 30, 'Y': 365}
+_MONTH_CODES = 'FGHJKMNQUVXZ'
+
+# client ids currently connected, TWS refuses a second session on the same id (error 326)
+_CONNECTED_CLIENT_IDS = set()
+_CONNECTED_LOCK = threading.Lock()
+
+def is_enabled():
+    """
+        True when sessions should be served by FakeIB instead of TWS
+    """
+    return bool(getattr(config, 'ibkr_use_fake_server', False)) or os.environ.get('IBKR_FAKE', '') not in ('', '0')
+
+def _seed(*parts):
+    return zlib.crc32('|'.join(str(p) for p in parts).encode()) + int(getattr(config, 'ibkr_fake_seed', 0))
+
+def _bar_seconds(bar_size):
+    value, unit = bar_size.split()
+    unit = unit.rstrip('s')
+    seconds = {'sec': 1, 'min': 60, 'hour': 3600, 'day': 86400, 'week': 7 * 86400, 'month': 30 * 86400}[unit]
+    return int(value) * seconds
+
+def _third_friday(year, month):
+    first = datetime.date(year, month, 1)
+    return first + datetime.timedelta(days=(4 - first.weekday()) % 7 + 14)
+
+def _price(seed, minutes, whatToShow):
+    """
+        Deterministic synthetic price at each epoch minute
+    """
+    base = 20 + seed % 480
+    noise = ((minutes * 2654435761 + seed) % 10007) / 10007.0 - 0.5
+    price = base * (1
+                    + 0.10 * np.sin(2 * np.pi * minutes / (60 * 24 * 90))
+                    + 0.02 * np.sin(2 * np.pi * minutes / (60 * 24))
+                    + 0.002 * noise)
+    if whatToShow == 'BID':
+        price = price - 0.01 * base / 100
+    elif whatToShow == 'ASK':
+        price = price + 0.01 * base / 100
+    return np.round(price, 2)
+
+class _FakeClient:
+    def __init__(self):
+        self.clientId = -1
+
+class FakeIB:
+    """
+        Drop-in for ib_insync.IB backed by synthetic data
+    """
+    def __init__(self, enforce_pacing=None, error_rates=None, latency_seconds=None, seed=None):
+        self.client = _FakeClient()
+        self.errorEvent = Event('errorEvent')
+        self.timeoutEvent = Event('timeoutEvent')
+        self.disconnectedEvent = Event('disconnectedEvent')
+        self.connectedEvent = Event('connectedEvent')
+        self._connected = False
+        self._outage = False
+        self._req_id = 0
+        self._request_log = collections.deque()
+        self._last_identical = {}
+        self._contract_request_log = collections.defaultdict(collections.deque)
+        self.enforce_pacing = getattr(config, 'ibkr_fake_enforce_pacing', False) if enforce_pacing is None else enforce_pacing
+        self.error_rates = dict(getattr(config, 'ibkr_fake_error_rates', {}) if error_rates is None else error_rates)
+        self.latency_seconds = getattr(config, 'ibkr_fake_latency_seconds', 0.0) if latency_seconds is None else latency_seconds
+        self._rng = np.random.default_rng(int(getattr(config, 'ibkr_fake_seed', 0) if seed is None else seed))
+
+    ##################### session
+    def connect(self, host='127.0.0.1', port=7496, clientId=1, timeout=4, readonly=False, account=''):
+        with _CONNECTED_LOCK:
+            if clientId in _CONNECTED_CLIENT_IDS and not (self._connected and self.client.clientId == clientId):
+                raise ConnectionError('Error 326: Unable to connect as the client id is already in use')
+            _CONNECTED_CLIENT_IDS.add(clientId)
+        self.client.clientId = clientId
+        self._connected = True
+        self.connectedEvent.emit()
+        return self
+
+    def disconnect(self):
+        if not self._connected:
+            return
+        with _CONNECTED_LOCK:
+            _CONNECTED_CLIENT_IDS.discard(self.client.clientId)
+        self._connected = False
+        self.disconnectedEvent.emit()
+
+    def isConnected(self):
+        return self._connected
+
+    def sleep(self, secs=0.02):
+        time.sleep(secs)
+        if self._outage:
+            # a 1100 outage is restored the next time the client waits
+            self._outage = False
+            self._error(-1, 1102, 'Connectivity between IB and Trader Workstation has been restored - data maintained.')
+        return True
+
+    def reqCurrentTime(self):
+        self._check_connected()
+        return datetime.datetime.now(datetime.timezone.utc)
+
+    def _check_connected(self):
+        if not self._connected:
+            raise ConnectionError('Not connected')
+
+    def _next_req_id(self):
+        self._req_id += 1
+        return self._req_id
+
+    def _error(self, req_id, code, message, contract=None):
+        self.errorEvent.emit(req_id, code, message, contract)
+
+    def _inject_error(self, req_id, contract):
+        """
+            Rolls the configured error rates, returns the code raised (or None)
+        """
+        for code, rate in self.error_rates.items():
+            if rate and self._rng.random() < rate:
+                code = int(code)
+                if code == 504:
+                    self._error(req_id, 504, 'Not connected', contract)
+                    self.disconnect()
+                    raise ConnectionError('Not connected')
+                if code == 1100:
+                    self._outage = True
+                    self._error(-1, 1100, 'Connectivity between IB and Trader Workstation has been lost.')
+                else:
+                    self._error(req_id, code, 'Historical Market Data Service error message:HMDS query returned no data', contract)
+                return code
+        return None
+
+    def _check_pacing(self, req_id, contract, key):
+        """
+            Applies IBKR historical pacing rules, returns True on violation
+        """
+        if not self.enforce_pacing:
+            return False
+        now = time.monotonic()
+        while self._request_log and now - self._request_log[0] >= 600:
+            self._request_log.popleft()
+        contract_log = self._contract_request_log[contract.conId or contract.symbol]
+        while contract_log and now - contract_log[0] >= 2:
+            contract_log.popleft()
+
+        violation = (len(self._request_log) >= 60
+                     or len(contract_log) >= 6
+                     or (key in self._last_identical and now - self._last_identical[key] < 15))
+        if violation:
+            self._error(req_id, 162, 'Historical Market Data Service error message:API historical data query cancelled: pacing violation', contract)
+            return True
+        self._request_log.append(now)
+        contract_log.append(now)
+        self._last_identical[key] = now
+        return False
+
+    ##################### contracts
+    def _fill_contract(self, contract):
+        if not contract.conId:
+            contract.conId = _seed(contract.secType, contract.symbol, contract.lastTradeDateOrContractMonth) % 900000000 + 1
+        if not contract.exchange:
+            contract.exchange = config.exchange_mapping.get(contract.symbol, 'SMART')
+        if not contract.currency:
+            contract.currency = config.currency_mapping.get(contract.symbol, 'USD')
+        if contract.secType == 'FUT' and not contract.localSymbol and contract.lastTradeDateOrContractMonth:
+            expiry = str(contract.lastTradeDateOrContractMonth)
+            contract.localSymbol = '%s%s%s' % (contract.symbol, _MONTH_CODES[int(expiry[4:6]) - 1], expiry[3])
+        return contract
+
+    def qualifyContracts(self, *contracts):
+        self._check_connected()
+        return [self._fill_contract(c) for c in contracts]
+
+    def _futures_expiries(self, symbol, include_expired):
+        cycle = config.futures_symbol_metadata.get(symbol, {}).get('listing_cycle', 'monthly')
+        months = range(1, 13) if cycle == 'monthly' else (3, 6, 9, 12)
+        today = datetime.date.today()
+        first_year = today.year - (2 if include_expired else 0)
+        expiries = []
+        for year in range(first_year, today.year + 2):
+            for month in months:
+                expiry = _third_friday(year, month)
+                if expiry < today and not include_expired:
+                    continue
+                expiries.append(expiry)
+        return expiries
+
+    def reqContractDetails(self, contract):
+        self._check_connected()
+        if contract.secType != 'FUT':
+            details = ContractDetails(contract=self._fill_contract(contract), marketName=contract.symbol, minTick=0.01, timeZoneId=_TIMEZONE)
+            return [details]
+
+        market_name = 'VX' if contract.symbol == 'VIX' else contract.symbol
+        exchange = contract.exchange or config.exchange_mapping.get(contract.symbol, '')
+        details = []
+        for expiry in self._futures_expiries(contract.symbol, contract.includeExpired):
+            expiry_str = expiry.strftime('%Y%m%d')
+            if contract.lastTradeDateOrContractMonth and not expiry_str.startswith(str(contract.lastTradeDateOrContractMonth)):
+                continue
+            fut = self._fill_contract(Future(symbol=contract.symbol, lastTradeDateOrContractMonth=expiry_str, exchange=exchange,
+                                             currency=contract.currency or config.currency_mapping.get(contract.symbol, 'USD'),
+                                             multiplier=contract.multiplier, includeExpired=contract.includeExpired))
+            details.append(ContractDetails(contract=fut, marketName=market_name, minTick=0.01, contractMonth=expiry_str[:6],
+                                           realExpirationDate=expiry_str, timeZoneId=_TIMEZONE))
+        return details
+
+    def _head_timestamp(self, contract):
+        if contract.secType == 'FUT' and contract.lastTradeDateOrContractMonth:
+            expiry = pd.Timestamp(str(contract.lastTradeDateOrContractMonth)[:8])
+            return (expiry - pd.DateOffset(months=12)).normalize() + pd.Timedelta(hours=18)
+        return pd.Timestamp('2005-01-03 04:00:00') + pd.Timedelta(days=_seed(contract.symbol) % 1000)
+
+    def reqHeadTimeStamp(self, contract, whatToShow='TRADES', useRTH=False, formatDate=1):
+        self._check_connected()
+        self._fill_contract(contract)
+        return self._head_timestamp(contract).to_pydatetime()
+
+    def cancelHeadTimeStamp(self, *args, **kwargs):
+        pass
+
+    ##################### historical data
+    def _session_mask(self, contract, stamps, useRTH):
+        """
+            True for bar start times that fall inside a trading session (Eastern time)
+        """
+        minutes = stamps.hour * 60 + stamps.minute
+        weekday = stamps.weekday
+        years = list(range(stamps.min().year, stamps.max().year + 1)) if len(stamps) else []
+        holidays = pd.DatetimeIndex(list(cdi._get_holidays_for_exchange(contract.exchange, years))) if years else pd.DatetimeIndex([])
+        is_holiday = stamps.normalize().isin(holidays)
+
+        if contract.secType == 'FUT':
+            # sunday 18:00 -> friday 17:00 with a daily 17:00-18:00 maintenance break
+            open_ = ((weekday < 4) & ((minutes < 17 * 60) | (minutes >= 18 * 60))) \
+                | ((weekday == 4) & (minutes < 17 * 60)) \
+                | ((weekday == 6) & (minutes >= 18 * 60))
+            if useRTH:
+                open_ = open_ & (weekday < 5) & (minutes >= 9 * 60 + 30) & (minutes < 16 * 60)
+        else:
+            start, end = (9 * 60 + 30, 16 * 60) if (useRTH or contract.secType == 'IND') else (4 * 60, 20 * 60)
+            open_ = (weekday < 5) & (minutes >= start) & (minutes < end)
+        return np.asarray(open_ & ~is_holiday)
+
+    def _duration_start(self, end, durationStr):
+        value, unit = durationStr.split()
+        value = int(value)
+        if unit == 'S':
+            return end - pd.Timedelta(seconds=value)
+        if unit == 'D':
+            return end.normalize() - pd.offsets.BDay(value)
+        return end - pd.Timedelta(days=value * _DURATION_UNIT_DAYS[unit])
+
+    def _bars(self, contract, end, durationStr, barSizeSetting, whatToShow, useRTH):
+        start = max(self._duration_start(end, durationStr), self._head_timestamp(contract))
+        if contract.secType == 'FUT' and contract.lastTradeDateOrContractMonth:
+            end = min(end, pd.Timestamp(str(contract.lastTradeDateOrContractMonth)[:8]) + pd.Timedelta(days=1))
+        if start >= end:
+            return []
+
+        step = _bar_seconds(barSizeSetting)
+        daily = step >= 86400
+        if daily:
+            stamps = pd.date_range(start.normalize(), end.normalize() - pd.Timedelta(days=0 if end > end.normalize() else 1), freq='D')
+            stamps = stamps[self._session_mask(contract, stamps + pd.Timedelta(hours=12), False)]
+            if step == 7 * 86400:
+                stamps = stamps.to_series().groupby(stamps.to_period('W')).first()
+                stamps = pd.DatetimeIndex(stamps.values)
+            elif step == 30 * 86400:
+                stamps = stamps.to_series().groupby(stamps.to_period('M')).first()
+                stamps = pd.DatetimeIndex(stamps.values)
+        else:
+            first = start.ceil('%ss' % step)
+            stamps = pd.date_range(first, end, freq='%ss' % step, inclusive='left')
+            stamps = stamps[self._session_mask(contract, stamps, useRTH)]
+        if len(stamps) == 0:
+            return []
+
+        seed = _seed(contract.symbol, contract.lastTradeDateOrContractMonth)
+        epoch_minutes = np.asarray((stamps - pd.Timestamp(0)) // pd.Timedelta(minutes=1), dtype=np.int64)
+        span = max(step // 60, 1)
+        open_ = _price(seed, epoch_minutes, whatToShow)
+        close = _price(seed, epoch_minutes + span, whatToShow)
+        swing = np.round(np.abs(_price(seed, epoch_minutes + span // 2 + 1, whatToShow) - open_) + 0.01, 2)
+        high = np.maximum(open_, close) + swing
+        low = np.minimum(open_, close) - swing
+        volume = 100 + (epoch_minutes * 40503 + seed) % 5000 if whatToShow == 'TRADES' else np.full(len(stamps), -1)
+        bar_count = volume // 10
+        average = np.round((high + low + close) / 3, 4)
+
+        if daily:
+            dates = [d.date() for d in stamps]
+        else:
+            dates = [d.to_pydatetime() for d in stamps.tz_localize(_TIMEZONE)]
+        return [BarData(date=dates[i], open=float(open_[i]), high=float(high[i]), low=float(low[i]), close=float(close[i]),
+                        volume=float(volume[i]), average=float(average[i]), barCount=int(bar_count[i]))
+                for i in range(len(dates))]
+
+    def reqHistoricalData(self, contract, endDateTime, durationStr, barSizeSetting, whatToShow, useRTH,
+                          formatDate=1, keepUpToDate=False, chartOptions=[], timeout=60):
+        self._check_connected()
+        self._fill_contract(contract)
+        req_id = self._next_req_id()
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+
+        result = BarDataList()
+        result.reqId = req_id
+        result.contract = contract
+        result.endDateTime = endDateTime
+        result.durationStr = durationStr
+        result.barSizeSetting = barSizeSetting
+        result.whatToShow = whatToShow
+        result.useRTH = useRTH
+        result.formatDate = formatDate
+        result.keepUpToDate = keepUpToDate
+        result.chartOptions = chartOptions
+
+        key = (contract.conId, str(endDateTime), durationStr, barSizeSetting, whatToShow, useRTH)
+        if self._check_pacing(req_id, contract, key) or self._inject_error(req_id, contract):
+            return result
+
+        if endDateTime in ('', None):
+            end = pd.Timestamp.now(tz=_TIMEZONE).tz_localize(None)
+        else:
+            end = pd.Timestamp(endDateTime)
+            if end.tzinfo is not None:
+                end = end.tz_convert(_TIMEZONE).tz_localize(None)
+
+        bars = self._bars(contract, end, durationStr, barSizeSetting, whatToShow, useRTH)
+        if not bars:
+            self._error(req_id, 162, 'Historical Market Data Service error message:HMDS query returned no data', contract)
+        result.extend(bars)
+        return result
+
+    def cancelHistoricalData(self, bars):
+        pass
+
+    ##################### market data
+    def reqMktData(self, contract, genericTickList='', snapshot=False, regulatorySnapshot=False, mktDataOptions=[]):
+        self._check_connected()
+        self._fill_contract(contract)
+        seed = _seed(contract.symbol, contract.lastTradeDateOrContractMonth)
+        now = pd.Timestamp.now(tz=_TIMEZONE)
+        minute = np.int64(now.value // 60_000_000_000)
+        last = float(_price(seed, minute, 'TRADES'))
+        return Ticker(contract=contract, time=now.to_pydatetime(), last=last, bid=round(last - 0.01, 2), ask=round(last + 0.01, 2),
+                      close=float(_price(seed, minute - 60 * 24, 'TRADES')))
+
+    def cancelMktData(self, contract):
+        pass
@@ -0,0 +1,294 @@
+"""
+Plans IBKR historical data requests.
+
+Turns a (interval, missing time ranges) request into the fewest valid
+durationStr/endDateTime pairs for reqHistoricalData, bounded by:
+    1. the max duration IBKR accepts for the bar size (config.ibkr_max_duration_by_bar_size)
+    2. the exchange session calendar (ranges with no sessions are never requested)
+    3. the life of the contract (head timestamp -> expiry)
+
+Each planned request is a dict; endDate/lookback map straight onto getBars/getBars_futures:
+    {'start': pd.Timestamp, 'end': pd.Timestamp, 'endDate': pd.Timestamp | '', 'lookback': 'N D'}
+
+plan_gap_requests does the same for a set of gap dates, coalescing nearby gaps into shared requests,
+plan_range_requests for short missing time ranges (runs of missing bars).
+"""
+import math
+import re
+
+import numpy as np
+import pandas as pd
+
+import config
+import checkDataIntegrity as cdi
+import ibkr_cassette
+
+_DURATION_UNIT_SECONDS = {
+    'S': 1,
+    'D': 86400,
+    'W': 7 * 86400,
+    'M': 30 * 86400,
+    'Y': 365 * 86400,
+}
+
+def normalize_bar_size(interval):
+    """
+        Returns interval in IBKR bar size format e.g. 1min -> 1 min, 5mins -> 5 mins
+    """
+    interval = str(interval).strip()
+    if ' ' in interval:
+        return interval
+    return re.sub("[A-Za-z]+", lambda elm: " "+elm[0], interval)
+
+def _parse_duration(duration):
+    """
+        Splits an IBKR durationStr e.g. '10 D' into (10, 'D')
+    """
+    value, unit = str(duration).strip().split()
+    unit = unit.upper()
+    if unit not in _DURATION_UNIT_SECONDS:
+        raise ValueError('Unsupported IBKR duration unit: %s' % duration)
+    return int(value), unit
+
+def get_max_duration(interval):
+    """
+        Returns (value, unit) of the widest durationStr IBKR accepts for the interval
+    """
+    bar_size = normalize_bar_size(interval)
+    duration = config.ibkr_max_duration_by_bar_size.get(bar_size)
+    if duration is None:
+        raise KeyError('No max duration configured for bar size: %s' % bar_size)
+    return _parse_duration(duration)
+
+def get_max_lookback(interval):
+    """
+        Returns the widest valid durationStr for the interval e.g. '10 D'
+    """
+    value, unit = get_max_duration(interval)
+    return '%s %s' % (value, unit)
+
+def lookback_start(end, lookback):
+    """
+        Returns the timestamp a lookback durationStr reaches back to from end.
+        'D' durations are counted in business days to match IBKR semantics.
+    """
+    end = pd.to_datetime(end)
+    value, unit = _parse_duration(lookback)
+    if unit == 'D':
+        return end.normalize() - pd.offsets.BDay(value)
+    return end - pd.Timedelta(seconds=value * _DURATION_UNIT_SECONDS[unit])
+
+def _get_session_dates(start_date, end_date, exchange=None):
+    """
+        Returns (weekdays, sessions) as datetime64[D] arrays for [start_date, end_date].
+        sessions excludes exchange holidays; weekdays does not, and is used to size
+        durations conservatively so a misclassified holiday never shortens a request.
+    """
+    start_date = np.datetime64(pd.Timestamp(start_date).date(), 'D')
+    end_date = np.datetime64(pd.Timestamp(end_date).date(), 'D')
+    if end_date < start_date:
+        empty = np.array([], dtype='datetime64[D]')
+        return empty, empty
+
+    all_dates = np.arange(start_date, end_date + 1, dtype='datetime64[D]')
+    weekdays = all_dates[np.is_busday(all_dates)]
+    if exchange is None or weekdays.size == 0:
+        return weekdays, weekdays
+
+    years = list(range(pd.Timestamp(start_date).year, pd.Timestamp(end_date).year + 1))
+    holidays = np.array([np.datetime64(d, 'D') for d in cdi._get_holidays_for_exchange(exchange, years)], dtype='datetime64[D]')
+    sessions = weekdays[~np.isin(weekdays, holidays)]
+    return weekdays, sessions
+
+def _merge_ranges(ranges):
+    """
+        Sorts and merges overlapping or touching (start, end) ranges
+    """
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+def _plan_seconds_windows(start, end, max_seconds):
+    windows = []
+    while end > start:
+        window_start = max(start, end - pd.Timedelta(seconds=max_seconds))
+        seconds = int(math.ceil((end - window_start).total_seconds()))
+        windows.append({'start': window_start, 'end': end, 'endDate': end, 'lookback': '%s S' % seconds})
+        end = window_start
+    return windows
+
+def _plan_day_windows(start, end, max_days, exchange):
+    # a range ending exactly at midnight does not touch that date
+    last_date = end.normalize()
+    if end == last_date:
+        last_date = last_date - pd.Timedelta(days=1)
+    weekdays, sessions = _get_session_dates(start, last_date, exchange)
+    if sessions.size == 0:
+        return []
+
+    windows = []
+    for group_end in range(len(weekdays), 0, -max_days):
+        group = weekdays[max(group_end - max_days, 0):group_end]
+        if not np.isin(group, sessions).any():
+            continue
+        window_end = min(end, pd.Timestamp(group[-1]) + pd.Timedelta(days=1))
+        window_start = max(start, pd.Timestamp(group[0]))
+        windows.append({'start': window_start, 'end': window_end, 'endDate': window_end, 'lookback': '%s D' % len(group)})
+    return windows
+
+def _plan_year_windows(start, end, max_years, exchange):
+    windows = []
+    while end > start:
+        window_start = max(start, end - pd.DateOffset(years=max_years))
+        num_days = (end - window_start).days
+        if num_days <= 365:
+            # short spans are cheaper to express in trading days
+            windows.extend(_plan_day_windows(window_start, end, 365, exchange))
+        else:
+            windows.append({'start': window_start, 'end': end, 'endDate': end, 'lookback': '%s Y' % min(max_years, int(math.ceil(num_days / 365.25)))})
+        end = window_start
+    return windows
+
+def plan_requests(interval, missing_ranges, contract_start=None, contract_end=None, exchange=None, now=None, newest_first=True):
+    """
+        Returns the list of requests needed to cover missing_ranges for the interval
+        inputs:
+            interval: bar size e.g. '1 min' or '1min'
+            missing_ranges: iterable of (start, end) datetime-likes
+            contract_start: earliest timestamp data is available for (head timestamp)
+            contract_end: last trade date of the contract (futures only)
+            exchange: IBKR exchange code, used to skip ranges with no trading sessions
+            now: upper bound of any request, defaults to ibkr_cassette.now() (current time, or the recording's start on replay)
+            newest_first: order of returned requests, backfills walk newest -> oldest
+        returns:
+            [{'start': pd.Timestamp, 'end': pd.Timestamp, 'endDate': pd.Timestamp | '', 'lookback': str}]
+            endDate is '' when the request ends at the current time, end is always set
+    """
+    now = ibkr_cassette.now().floor('s') if now is None else pd.to_datetime(now)
+    upper = now
+    if contract_end is not None and not pd.isna(pd.to_datetime(contract_end, errors='coerce')):
+        # contracts trade through the end of their last trade date
+        upper = min(upper, pd.to_datetime(contract_end).normalize() + pd.Timedelta(days=1))
+    lower = None
+    if contract_start is not None and not pd.isna(pd.to_datetime(contract_start, errors='coerce')):
+        lower = pd.to_datetime(contract_start)
+        if lower.tzinfo is not None:
+            lower = lower.tz_localize(None)
+
+    ranges = []
+    for start, end in missing_ranges:
+        start = pd.to_datetime(start, errors='coerce')
+        end = pd.to_datetime(end, errors='coerce')
+        if pd.isna(start) or pd.isna(end):
+            continue
+        if getattr(start, 'tzinfo', None) is not None:
+            start = start.tz_localize(None)
+        if getattr(end, 'tzinfo', None) is not None:
+            end = end.tz_localize(None)
+        if lower is not None:
+            start = max(start, lower)
+        end = min(end, upper)
+        if start < end:
+            ranges.append((start, end))
+
+    max_value, unit = get_max_duration(interval)
+    windows = []
+    for start, end in reversed(_merge_ranges(ranges)):
+        if unit == 'D':
+            windows.extend(_plan_day_windows(start, end, max_value, exchange))
+        elif unit == 'Y':
+            windows.extend(_plan_year_windows(start, end, max_value, exchange))
+        else:
+            windows.extend(_plan_seconds_windows(start, end, max_value * _DURATION_UNIT_SECONDS[unit]))
+
+    # requests that run up to the present are sent without an end date
+    for window in windows:
+        if window['end'] >= now:
+            window['endDate'] = ''
+
+    if not newest_first:
+        windows.reverse()
+    return windows
+
+def _gap_span_fits(oldest, newest, max_value, unit):
+    """
+        True when gap dates oldest..newest (inclusive) can be covered by one request
+    """
+    if unit == 'D':
+        # 'D' durations count trading days, weekdays is the conservative upper bound
+        return np.busday_count(np.datetime64(oldest, 'D'), np.datetime64(newest, 'D') + 1) <= max_value
+    if unit == 'Y':
+        return (newest - oldest).days + 1 <= 365 * max_value
+    return ((newest - oldest).days + 1) * 86400 <= max_value * _DURATION_UNIT_SECONDS[unit]
+
+def group_gap_dates(interval, gap_dates):
+    """
+        Groups gap dates into the fewest runs that each fit in one request for the interval.
+        Walks newest -> oldest and keeps extending the current run while the whole span still fits,
+        so consecutive gaps (and gaps a few sessions apart) share one request.
+        returns:
+            [[newest, ..., oldest], ...] as pd.Timestamp dates, newest run first
+    """
+    dates = sorted({pd.Timestamp(d).normalize() for d in gap_dates if not pd.isna(pd.to_datetime(d, errors='coerce'))}, reverse=True)
+    max_value, unit = get_max_duration(interval)
+    if unit == 'D':
+        # leave room for the lead-in day plan_gap_requests adds
+        max_value = max(max_value - 1, 1)
+
+    groups = []
+    for gap_date in dates:
+        if groups and _gap_span_fits(gap_date.date(), groups[-1][0].date(), max_value, unit):
+            groups[-1].append(gap_date)
+        else:
+            groups.append([gap_date])
+    return groups
+
+def plan_gap_requests(interval, gap_dates, contract_start=None, contract_end=None, exchange=None, now=None):
+    """
+        Returns the fewest requests covering every gap date (whole trading dates) for the interval, newest first.
+        Each request also carries 'gap_dates', the dates it is meant to fill.
+    """
+    requests = []
+    for group in group_gap_dates(interval, gap_dates):
+        newest, oldest = group[0], group[-1]
+        # start a day early: the evening bars of a futures trade date belong to the next session
+        windows = plan_requests(
+            interval,
+            [(oldest - pd.Timedelta(days=1), newest + pd.Timedelta(days=1))],
+            contract_start=contract_start,
+            contract_end=contract_end,
+            exchange=exchange,
+            now=now)
+        for window in windows:
+            window['gap_dates'] = [d for d in group if window['start'].normalize() - pd.Timedelta(days=1) <= d < window['end']]
+        requests.extend(windows)
+    return requests
+
+def plan_range_requests(interval, missing_ranges, contract_start=None, contract_end=None, exchange=None, now=None):
+    """
+        Returns the fewest requests covering short missing (start, end) ranges, e.g. runs of missing bars, newest first.
+        Ranges whose whole span fits in one request share it, each request covers only the span from its
+        oldest range start to its newest range end.
+    """
+    max_value, unit = get_max_duration(interval)
+    groups = []
+    for start, end in sorted(missing_ranges, key=lambda r: r[1], reverse=True):
+        if groups and _gap_span_fits(start.date(), groups[-1][1].date(), max_value, unit):
+            groups[-1][0] = min(groups[-1][0], start)
+        else:
+            groups.append([start, end])
+
+    requests = []
+    for start, end in groups:
+        if unit != 'D':
+            requests.extend(plan_requests(interval, [(start, end)], contract_start=contract_start, contract_end=contract_end, exchange=exchange, now=now))
+            continue
+        # the ranges come from the session grid, so they are sent as they are: an evening run (e.g. Sunday)
+        # belongs to the next trade date and would be dropped by the weekday windows of plan_requests
+        num_days = max(int(np.busday_count(np.datetime64(start.date(), 'D'), np.datetime64(end.date(), 'D') + 1)), 1)
+        requests.append({'start': start, 'end': end, 'endDate': end, 'lookback': '%s D' % num_days})
+    return requests
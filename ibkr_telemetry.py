@@ -0,0 +1,188 @@
+"""
+Timing telemetry for IBKR runs.
+
+Every request that goes through interface_ibkr._request_with_resume is recorded with
+    queue_wait      waiting for a usable session (reconnects, 1100 outages)
+    pacing_sleep    sleeping in _paceIbkrRequest
+    round_trip      the request itself
+    bars, bytes     bars returned, bytes received on the socket (live sessions only)
+and the local stages around it (_formatContractHistory, saveHistoryToDB) are recorded as
+stage events with their duration and row count.
+
+Events are appended as one JSON object per line to config.telemetry_path, tagged with a run id
+per process, so overnight runs can be compared after the fact.
+
+Usage:
+    python ibkr_telemetry.py            summary of every run in the file
+    python ibkr_telemetry.py last       summary of the most recent run, with per-request latencies
+"""
+from rich import print
+from sys import argv
+
+import contextlib
+import datetime
+import json
+import os
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+import config
+
+_run_id = '%s-%s' % (datetime.datetime.now().strftime('%Y%m%d-%H%M%S'), os.getpid())
+_write_lock = threading.Lock()
+
+def is_enabled():
+    return bool(getattr(config, 'telemetry_enabled', False))
+
+def get_path():
+    return os.environ.get('IBKR_TELEMETRY_PATH') or config.telemetry_path
+
+def get_run_id():
+    return _run_id
+
+def _write(event):
+    if not is_enabled():
+        return
+    event['run_id'] = _run_id
+    event['ts'] = datetime.datetime.now().isoformat(timespec='milliseconds')
+    line = json.dumps(event, default=str)
+    try:
+        with _write_lock:
+            with open(get_path(), 'a') as f:
+                f.write(line + '\n')
+    except OSError:
+        # telemetry must never stop a data run
+        pass
+
+def bytes_received(ibkr):
+    """
+        Returns the bytes received so far on the session's socket, None when the session does not track it
+    """
+    client = getattr(ibkr, 'client', None)
+    return getattr(client, '_numBytesRecv', None)
+
+def record_request(request_name, context, queue_wait, pacing_sleep, round_trip, result=None, bytes_recv=None, attempt=0, error=None):
+    """
+        Records one IBKR request
+    """
+    try:
+        bars = len(result) if request_name == 'reqHistoricalData' and result is not None else None
+    except TypeError:
+        bars = None
+    _write({
+        'event': 'request',
+        'request': request_name,
+        'context': context,
+        'queue_wait': round(queue_wait, 4),
+        'pacing_sleep': round(pacing_sleep, 4),
+        'round_trip': round(round_trip, 4),
+        'bars': bars,
+        'bytes': bytes_recv,
+        'attempt': attempt,
+        'error': error,
+    })
+
+@contextlib.contextmanager
+def timed(stage, rows=None, **fields):
+    """
+        Records the duration of a local stage (format, save, ...)
+    """
+    if not is_enabled():
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        _write(dict(fields, event='stage', stage=stage, seconds=round(time.perf_counter() - started, 4), rows=rows))
+
+##################### report
+def load(path=None):
+    """
+        Returns the telemetry file as a dataframe, one row per event
+    """
+    path = get_path() if path is None else path
+    if not os.path.exists(path):
+        return pd.DataFrame()
+    events = pd.read_json(path, lines=True, convert_dates=False)
+    if events.empty:
+        return events
+    events['ts'] = pd.to_datetime(events['ts'], errors='coerce')
+    return events
+
+def _percentiles(values, prefix):
+    values = values.dropna().to_numpy(dtype=float)
+    if values.size == 0:
+        return {'%s_p50' % prefix: np.nan, '%s_p90' % prefix: np.nan, '%s_p99' % prefix: np.nan}
+    p50, p90, p99 = np.percentile(values, [50, 90, 99])
+    return {'%s_p50' % prefix: p50, '%s_p90' % prefix: p90, '%s_p99' % prefix: p99}
+
+def summarize(events):
+    """
+        Returns one row per run: throughput in bars per second, where the wall time went, and
+        round trip / pacing percentiles
+    """
+    if events.empty:
+        return pd.DataFrame()
+
+    summary = []
+    for run_id, run in events.groupby('run_id', sort=False):
+        requests = run.loc[run['event'] == 'request']
+        stages = run.loc[run['event'] == 'stage'] if 'stage' in run.columns else run.iloc[0:0]
+        wall = (run['ts'].max() - run['ts'].min()).total_seconds()
+        bars = requests['bars'].fillna(0).sum() if 'bars' in requests.columns else 0
+
+        row = {
+            'run_id': run_id,
+            'started': run['ts'].min(),
+            'wall_seconds': wall,
+            'requests': len(requests),
+            'errors': int(requests['error'].notna().sum()) if 'error' in requests.columns else 0,
+            'bars': int(bars),
+            'bars_per_second': bars / wall if wall > 0 else np.nan,
+            'mbytes': requests['bytes'].fillna(0).sum() / 1e6 if 'bytes' in requests.columns else np.nan,
+            'queue_wait_seconds': requests['queue_wait'].sum(),
+            'pacing_seconds': requests['pacing_sleep'].sum(),
+            'round_trip_seconds': requests['round_trip'].sum(),
+        }
+        for stage, group in stages.groupby('stage'):
+            row['%s_seconds' % stage] = group['seconds'].sum()
+        row.update(_percentiles(requests['round_trip'], 'round_trip'))
+        row.update(_percentiles(requests['pacing_sleep'], 'pacing'))
+        summary.append(row)
+
+    return pd.DataFrame(summary)
+
+def summarize_requests(events):
+    """
+        Returns latency percentiles per request type
+    """
+    requests = events.loc[events['event'] == 'request']
+    if requests.empty:
+        return pd.DataFrame()
+    rows = []
+    for request_name, group in requests.groupby('request'):
+        row = {'request': request_name, 'count': len(group), 'bars': int(group['bars'].fillna(0).sum())}
+        row.update(_percentiles(group['round_trip'], 'round_trip'))
+        row.update(_percentiles(group['queue_wait'], 'queue_wait'))
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+def report(path=None, last_run_only=False):
+    events = load(path)
+    if events.empty:
+        print('[yellow]No telemetry recorded at %s[/yellow]' % (get_path() if path is None else path))
+        return
+    if last_run_only:
+        events = events.loc[events['run_id'] == events['run_id'].iloc[-1]]
+
+    with pd.option_context('display.max_columns', None, 'display.width', 200, 'display.float_format', '{:.2f}'.format):
+        print(summarize(events).set_index('run_id').T)
+        if last_run_only:
+            print(summarize_requests(events).set_index('request'))
+
+if __name__ == '__main__':
+    report(last_run_only=len(argv) > 1 and argv[1] == 'last')
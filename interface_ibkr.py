@@ -2,6 +2,7 @@ from symtable import Symbol
 from ib_insync import *
 from rich import print
 
+import numpy as np
 import pandas as pd
 
 import ib_insync.wrapper
@@ -11,8 +12,13 @@ import sys
 import time
 import threading
 from collections import deque
+from operator import attrgetter
 import config
 import re 
+import ibkr_cassette
+import ibkr_circuit_breaker
+import ibkr_connection_pool
+import ibkr_telemetry
 
 #global list of index symbols
 _index = config._index
@@ -43,9 +49,14 @@ def _paceIbkrRequest(ibkr, request_name='general', min_interval_seconds=None):
     """
         Pacing detail: https://www.interactivebrokers.com/campus/ibkr-api-page/twsapi-doc/#historical-pacing-limitations
     """
+    # replayed sessions reproduce recorded pacing waits themselves
+    if not getattr(ibkr, 'requires_pacing', True):
+        return 0.0
+
     if min_interval_seconds is None:
         min_interval_seconds = _IBKR_MIN_INTERVAL_BY_REQUEST.get(request_name, _IBKR_DEFAULT_MIN_INTERVAL_SECONDS)
 
+    slept = 0.0
     # with _IBKR_REQUEST_LOCK:
     while True:
         # print(f'{datetime.datetime.now().strftime("%H:%M:%S")}: [yellow]Pacing check: Number of IBKR requests in the last 10 minutes: {len(_IBKR_REQUEST_TIMESTAMPS)}[/yellow]')
@@ -74,77 +85,285 @@ def _paceIbkrRequest(ibkr, request_name='general', min_interval_seconds=None):
         print(f'{datetime.datetime.now().strftime("%H:%M:%S")}: [yellow]Pacing IBKR request "{request_name}", sleeping for {sleep_for:.2f}[/yellow]')
         # time.sleep(sleep_for)
         ibkr.sleep(sleep_for)
+        slept += sleep_for
 
     stamped_now = time.monotonic()
     _IBKR_LAST_REQUEST_TIMES[request_name] = stamped_now
     _IBKR_LAST_REQUEST_TIMES['__global__'] = stamped_now
     _IBKR_REQUEST_TIMESTAMPS.append(stamped_now)
+    return slept
 
-def _exit_if_disconnected(ibkr, context):
-    if ibkr is None or (hasattr(ibkr, "isConnected") and not ibkr.isConnected()):
-        print(f"{datetime.datetime.now():%H:%M:%S}: [red]IBKR disconnected during {context}. Exiting.[/red]")
-        exit() 
+def get_pacing_budget():
+    """
+        Returns the number of requests left in the current rolling pacing window, shared by every caller in the process
+    """
+    now = time.monotonic()
+    recent = sum(1 for ts in _IBKR_REQUEST_TIMESTAMPS if (now - ts) < _IBKR_WINDOW_SECONDS)
+    return max(_IBKR_MAX_REQUESTS_PER_WINDOW - recent, 0)
+
+class IbkrDisconnectedError(ConnectionError):
+    """
+        Raised when the IBKR session dropped and could not be re-established
+    """
+    pass
 
 def _is_connection_error(exc):
     msg = str(exc).lower()
     return any(x in msg for x in ["not connected", "socket", "connection", "504", "1100", "1101"])
 
+def _reconnect(ibkr, context):
+    """
+        Reconnects the session in place (same object, same client id) with exponential backoff
+    """
+    print(f"{datetime.datetime.now():%H:%M:%S}: [red]IBKR disconnected during {context}. Reconnecting...[/red]")
+    ibkr = ibkr_connection_pool.connect_with_backoff(ibkr.client.clientId, ibkr=ibkr, max_attempts=config.ibkr_resume_max_attempts)
+    if ibkr is None:
+        raise IbkrDisconnectedError('IBKR disconnected during %s' % context)
+    print(f"{datetime.datetime.now():%H:%M:%S}: [green]Reconnected, resuming {context}[/green]")
+    return ibkr
+
+def _ensure_connected(ibkr, context):
+    """
+        Makes sure the session can take a request: reconnects dropped sockets and
+        waits out a TWS -> IB connectivity loss (1100) until it is restored
+    """
+    if ibkr is None:
+        raise IbkrDisconnectedError('No IBKR session for %s' % context)
+    if hasattr(ibkr, "isConnected") and not ibkr.isConnected():
+        _reconnect(ibkr, context)
+    if not ibkr_connection_pool.wait_for_connectivity(ibkr):
+        raise IbkrDisconnectedError('IBKR connectivity not restored during %s' % context)
+
+def _requalify(ibkr, contract):
+    """
+        Re-resolves a contract after a reconnect, cached conIds may be stale for the new session
+    """
+    if contract is None:
+        return
+    try:
+        ibkr.qualifyContracts(contract)
+    except Exception as e:
+        print('%s: [yellow]Could not re-qualify %s: %s[/yellow]' % (datetime.datetime.now().strftime('%H:%M:%S'), contract, e))
+
+def _request_with_resume(ibkr, request_name, request, context, contract=None, series=None, scope=None):
+    """
+        Paces and runs request(), resuming it on the same session if the connection drops.
+        Requests that come back empty because the session dropped (504 / socket loss) or TWS lost
+        connectivity (1100) are retried once the session is restored.
+        Raises IbkrDisconnectedError if the session cannot be restored.
+
+        Requests for a contract go through ibkr_circuit_breaker: they are skipped (None) while the
+        contract's breaker is open, pacing violations / transient errors are retried while the global
+        retry budget lasts, and no data / no permission / invalid contract failures count against the breaker.
+        series: whatToShow of an extra series request, counted against that series' own breaker
+        scope: e.g. 'gap_fill', counted against a breaker of that kind of request (see ibkr_circuit_breaker.contract_key)
+        Each attempt is recorded by ibkr_telemetry.
+    """
+    if not ibkr_circuit_breaker.allow(contract, series, scope):
+        print('%s: [yellow]Skipping %s, circuit breaker open for %s[/yellow]' % (datetime.datetime.now().strftime('%H:%M:%S'), context, ibkr_circuit_breaker.contract_key(contract, series, scope)))
+        return None
+
+    max_reconnects = config.ibkr_request_max_reconnects
+    result = None
+    for attempt in range(max_reconnects + 1):
+        queued = time.perf_counter()
+        _ensure_connected(ibkr, context)
+        queue_wait = time.perf_counter() - queued
+        pacing_sleep = 0.0
+        sent = time.perf_counter()
+        try:
+            pacing_sleep = _paceIbkrRequest(ibkr, request_name)
+            bytes_before = ibkr_telemetry.bytes_received(ibkr)
+            sent = time.perf_counter()
+            with ibkr_circuit_breaker.ErrorCollector(ibkr) as errors:
+                result = request()
+        except Exception as e:
+            ibkr_telemetry.record_request(request_name, context, queue_wait, pacing_sleep, time.perf_counter() - sent, attempt=attempt, error=str(e))
+            if isinstance(e, ibkr_cassette.CassetteMissError):
+                # a replay that left the recording is not the contract's fault
+                raise
+            if not (isinstance(e, ConnectionError) or _is_connection_error(e)):
+                ibkr_circuit_breaker.record_failure(contract, 'transient', e, series, scope)
+                raise
+            if attempt == max_reconnects:
+                raise IbkrDisconnectedError('IBKR disconnected during %s' % context) from e
+            _reconnect(ibkr, context)
+            _requalify(ibkr, contract)
+            continue
+
+        round_trip = time.perf_counter() - sent
+        bytes_after = ibkr_telemetry.bytes_received(ibkr)
+        ibkr_telemetry.record_request(request_name, context, queue_wait, pacing_sleep, round_trip, result,
+            bytes_recv=None if bytes_before is None or bytes_after is None else bytes_after - bytes_before, attempt=attempt, error=errors.last_error)
+
+        if result:
+            ibkr_circuit_breaker.record_success(contract, series, scope)
+            return result
+
+        interrupted = not ibkr.isConnected() or ibkr_connection_pool.connectivity_lost(ibkr)
+        if interrupted and attempt < max_reconnects:
+            if not ibkr.isConnected():
+                _reconnect(ibkr, context)
+                _requalify(ibkr, contract)
+            continue
+
+        failure_class = ibkr_circuit_breaker.worst_class(errors.classes)
+        ibkr_circuit_breaker.record_failure(contract, failure_class, errors.last_error, series, scope)
+        if failure_class in ibkr_circuit_breaker.RETRYABLE and attempt < max_reconnects:
+            if not ibkr_circuit_breaker.take_retry():
+                print('%s: [yellow]Retry budget used up, not retrying %s[/yellow]' % (datetime.datetime.now().strftime('%H:%M:%S'), context))
+                return result
+            print('%s: [yellow]%s during %s (%s), retrying in %ss[/yellow]' % (datetime.datetime.now().strftime('%H:%M:%S'), failure_class, context, errors.last_error, config.ibkr_retry_backoff_seconds))
+            ibkr.sleep(config.ibkr_retry_backoff_seconds)
+            continue
+        return result
+    return result
+
 ##
 # IBKR API reference: https://interactivebrokers.github.io/tws-api/historical_bars.html
 ## add a space between num and alphabet
 def _addspace(myStr): 
     return re.sub("[A-Za-z]+", lambda elm: " "+elm[0],myStr )
 
-def setupConnection():
+def setupConnection(clientId=None):
     """
     Setup connection to ibkr
     ###
+    clientId: defaults to config.ibkr_client_id, use ibkr_connection_pool to run several sessions at once
     --
     Returns ibkr connection object 
     """
     ## connect with IBKR
-    try:
-        print('%s: [yellow]Connecting with IBKR...[/yellow]'%(datetime.datetime.now().strftime('%H:%M:%S')))
-        ibkr = IB() 
-        ibkr.connect('127.0.0.1', 7496, clientId = 10)
-        print('%s: [green]  Success![/green]'%(datetime.datetime.now().strftime('%H:%M:%S')))
-    except Exception as e:
+    print('%s: [yellow]Connecting with IBKR...[/yellow]'%(datetime.datetime.now().strftime('%H:%M:%S')))
+    ibkr = ibkr_connection_pool.connect_with_backoff(clientId, max_attempts=config.ibkr_resume_max_attempts)
+    if ibkr is None:
         print('[red]  Could not connect with IBKR![/red]\n')
-        print(e)
-        exit()
+        raise IbkrDisconnectedError('Could not connect with IBKR')
+    print('%s: [green]  Success![/green]'%(datetime.datetime.now().strftime('%H:%M:%S')))
     
     return ibkr
 
 def refreshConnection(ibkr):
     print('%s: [yellow]Refreshing IBKR connection...[/yellow]'%(datetime.datetime.now().strftime('%H:%M:%S')))
-    #if ibkr.isConnected():
+    # pooled sessions are refreshed by the pool so the lease stays valid
+    pool = ibkr_connection_pool.get_pool()
+    if pool.is_leased(ibkr):
+        ibkr = pool.refresh(ibkr)
+        if ibkr is None:
+            print('[red]  Could not reconnect with IBKR![/red]\n')
+            raise IbkrDisconnectedError('Could not reconnect pooled IBKR session')
+        print('%s:[green]Success![/green]'%(datetime.datetime.now().strftime('%H:%M:%S')))
+        return ibkr
+
     clientid = ibkr.client.clientId
     ibkr.disconnect()
     print('%s: [yellow] Connection terminated...[/yellow]'%(datetime.datetime.now().strftime('%H:%M:%S')))
     time.sleep(3) 
     print('%s: [yellow] Reconnecting...[/yellow]'%(datetime.datetime.now().strftime('%H:%M:%S')))
-    ibkr = ibkr.connect('127.0.0.1', 7496, clientId = clientid)
+    ibkr = ibkr_connection_pool.connect_with_backoff(clientid, ibkr=ibkr, max_attempts=config.ibkr_resume_max_attempts)
+    if ibkr is None:
+        print('[red]  Could not reconnect with IBKR![/red]\n')
+        raise IbkrDisconnectedError('Could not reconnect with IBKR')
     print('%s:[green]Success![/green]'%(datetime.datetime.now().strftime('%H:%M:%S')))
     return ibkr
 
 def _formatContractHistory(contractHistory_df):
     """ 
         Formats the contract history returned from ibkr 
+        (DataFrame input, see bars_to_frame for the fast path straight from a BarDataList)
     """
-    contractHistory_df.drop(['average', 'barCount'], inplace=True, axis=1)
-    # convert date column to datetime
-    contractHistory_df['date'] = pd.to_datetime(contractHistory_df['date'])
-    # trim the timezone info from the datetime
-    contractHistory_df['date'] = contractHistory_df['date'].dt.tz_localize(None)
+    with ibkr_telemetry.timed('format', rows=len(contractHistory_df)):
+        contractHistory_df.drop(['average', 'barCount'], inplace=True, axis=1)
+        # convert date column to datetime
+        contractHistory_df['date'] = pd.to_datetime(contractHistory_df['date'])
+        # trim the timezone info from the datetime
+        contractHistory_df['date'] = contractHistory_df['date'].dt.tz_localize(None)
     return contractHistory_df
 
+_BAR_PRICE_FIELDS = ['open', 'high', 'low', 'close', 'volume']
+_EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+def _bar_dates(bars, n):
+    """
+        Returns the bar dates as naive datetime64[ns] in the bars' own timezone (wall clock), same as _formatContractHistory
+    """
+    first = bars[0].date
+    # daily and longer bars come back as dates
+    if not isinstance(first, datetime.datetime):
+        days = np.fromiter((bar.date.toordinal() for bar in bars), np.int64, n) - _EPOCH_ORDINAL
+        return days.astype('datetime64[D]').astype('datetime64[ns]')
+    if first.tzinfo is None:
+        return np.fromiter((bar.date for bar in bars), 'datetime64[us]', n).astype('datetime64[ns]')
+    # epoch math is vectorized, converting each datetime to naive in python is the slow part of util.df
+    epoch_us = np.rint(np.fromiter((bar.date.timestamp() for bar in bars), np.float64, n) * 1e6).astype(np.int64)
+    return pd.to_datetime(epoch_us, unit='us', utc=True).tz_convert(first.tzinfo).tz_localize(None).as_unit('ns')
+
+def bars_to_frame(bars, keep_extra=False):
+    """
+        Converts a BarDataList (or any list of BarData) straight to our bar schema, one column array per field
+        ###
+        bars: result of reqHistoricalData / reqHistoricalDataAsync
+        keep_extra: also return the average and barCount columns
+        --
+        Returns [DataFrame] date | open | high | low | close | volume [| average | barCount], empty when there are no bars
+    """
+    n = len(bars) if bars is not None else 0
+    if n == 0:
+        return pd.DataFrame()
+
+    with ibkr_telemetry.timed('format', rows=n):
+        columns = {'date': _bar_dates(bars, n)}
+        for field in _BAR_PRICE_FIELDS:
+            columns[field] = np.fromiter(map(attrgetter(field), bars), np.float64, n)
+        if keep_extra:
+            columns['average'] = np.fromiter(map(attrgetter('average'), bars), np.float64, n)
+            columns['barCount'] = np.fromiter(map(attrgetter('barCount'), bars), np.int64, n)
+        contractHistory_df = pd.DataFrame(columns, copy=False)
+    return contractHistory_df
+
+_SERIES_FIELDS = ['open', 'high', 'low', 'close']
+
+def get_extra_series(contract):
+    """
+        Returns the whatToShow series fetched alongside TRADES for a contract (config.extra_series)
+    """
+    return config.extra_series.get(contract.secType, {}).get(contract.symbol, [])
+
+def series_column(series, field):
+    return '%s_%s' % (series.lower(), field)
+
+def _add_extra_series(ibkrObj, contract, history, endDate, lookback, interval, useRTH=False, breaker_scope=None):
+    """
+        Requests the contract's extra series for the window its TRADES bars were just fetched for and
+        adds them to history as <series>_open | _high | _low | _close columns.
+        The qualified contract and the planned window are shared with the TRADES request, the series
+        are stored in the TRADES table so they add no table, lookup row or head timestamp lookup of their own.
+    """
+    for series in get_extra_series(contract):
+        bars = _request_with_resume(ibkrObj, 'reqHistoricalData', lambda: ibkrObj.reqHistoricalData(
+            contract,
+            endDateTime = endDate,
+            durationStr=lookback,
+            barSizeSetting=interval,
+            whatToShow=series,
+            useRTH=useRTH,
+            formatDate=1),
+            'requesting %s bars for %s' % (series, contract.localSymbol or contract.symbol), contract, series=series, scope=breaker_scope)
+        if not bars:
+            print('%s: [yellow]No %s bars for %s, storing TRADES only[/yellow]' % (datetime.datetime.now().strftime('%H:%M:%S'), series, contract.symbol))
+            continue
+        series_df = bars_to_frame(bars)[['date'] + _SERIES_FIELDS]
+        series_df.columns = ['date'] + [series_column(series, field) for field in _SERIES_FIELDS]
+        history = history.merge(series_df, on='date', how='left')
+    return history
+
 def getBars(ibkr, symbol='SPY', currency='USD', endDate='', lookback='10 D', interval='15 mins', whatToShow='TRADES', **kwargs):
     """
     Returns [DataFrame] of historical data from IBKR with...
         inputs:
             ibkr connection object, ..,.., end date of lookup, nbr of days to look back, ..,..
         outputs:
-            [columns]: date | open | high | low | close | volume | symbol | interval 
+            [columns]: date | open | high | low | close | volume | symbol | interval [| <series>_open .. _close per config.extra_series]
     """
     keepUpToDate = kwargs.get('keepUpToDate', False)
     # check if symbol is in currency mapping
@@ -159,7 +378,6 @@ def _getHistoricalBars(ibkrObj, symbol, currency, endDate, lookback, interval, w
     Returns [DataFrame] of historical data for stocks and indexes from IBKR
 
     """
-    _exit_if_disconnected(ibkrObj, 'requesting historical bars for symbol %s, interval %s'%(symbol, interval))
     keepUpToDate = kwargs.get('keepUpToDate', False)
 
     # set exchange
@@ -186,8 +404,7 @@ def _getHistoricalBars(ibkrObj, symbol, currency, endDate, lookback, interval, w
         datetime.datetime.now().strftime('%H:%M:%S'), symbol, endDate, lookback, interval))
     
     # request history from ibkr 
-    _paceIbkrRequest(ibkrObj, 'reqHistoricalData')
-    contractHistory = ibkrObj.reqHistoricalData(
+    contractHistory = _request_with_resume(ibkrObj, 'reqHistoricalData', lambda: ibkrObj.reqHistoricalData(
             contract, 
             endDateTime = endDate,
             durationStr=lookback,
@@ -195,35 +412,37 @@ def _getHistoricalBars(ibkrObj, symbol, currency, endDate, lookback, interval, w
             whatToShow=whatToShow,
             useRTH=False,
             formatDate=1, 
-            keepUpToDate=keepUpToDate)
+            keepUpToDate=keepUpToDate),
+        'requesting historical bars for symbol %s, interval %s'%(symbol, interval), contract)
 
     # convert retrieved data to dataframe    
     contractHistory_df = pd.DataFrame()
     if contractHistory: 
         # convert to dataframe & format for usage
-        contractHistory_df = _formatContractHistory(util.df(contractHistory))
+        contractHistory_df = bars_to_frame(contractHistory)
+        if whatToShow == 'TRADES' and not keepUpToDate:
+            contractHistory_df = _add_extra_series(ibkrObj, contract, contractHistory_df, endDate, lookback, interval)
     
     else: 
         print('%s: No history found for...%s!'%(datetime.datetime.now().strftime("%H:%M:%S"), symbol))
 
     return contractHistory_df
 
-def getBars_futures(ibkr, contract, lookback, interval, endDate='', whatToShow='TRADES', useRTH=False):
+def getBars_futures(ibkr, contract, lookback, interval, endDate='', whatToShow='TRADES', useRTH=False, breaker_scope=None):
     """
     Returns dataframe of historical data for futures
         by default, returns data for NG futures
+    breaker_scope: e.g. 'gap_fill', failures count against a circuit breaker of their own instead of the contract's
     """
     # bars = _getHistoricalBars_futures(ibkr, symbol, exchange, lastTradeDate, currency, endDate, lookback, interval, whatToShow)
-    bars = _getHistoricalBars_futures(ibkr, contract, endDate, lookback, interval, whatToShow, useRTH)
+    bars = _getHistoricalBars_futures(ibkr, contract, endDate, lookback, interval, whatToShow, useRTH, breaker_scope)
     return bars
 
-def _getHistoricalBars_futures(ibkrObj, contract, endDate, lookback, interval, whatToShow, useRTH=False):
+def _getHistoricalBars_futures(ibkrObj, contract, endDate, lookback, interval, whatToShow, useRTH=False, breaker_scope=None):
     """
         Returns [DataFrame] of historical data for futures from IBKR
     """
     ## Future contract definition: https://ib-insync.readthedocs.io/api.html#ib_insync.contract.Future
-    _exit_if_disconnected(ibkrObj, 'requesting historical bars for futures contract %s'%contract)
-
     print('%s: [yellow]Requesting data for %s:%s-%s-%s, endDate: %s, lookback: %s[/yellow]'%(datetime.datetime.now().strftime('%H:%M:%S'), contract.exchange, contract.symbol, contract.lastTradeDateOrContractMonth, interval, endDate, lookback))
 
     # make sure endDate is tzaware
@@ -234,7 +453,7 @@ def _getHistoricalBars_futures(ibkrObj, contract, endDate, lookback, interval, w
     if ' ' not in interval:
         interval = _addspace(interval)
     # handle expired contracts 
-    if (contract.lastTradeDateOrContractMonth < datetime.datetime.now().strftime('%Y%m%d')) & (pd.to_datetime(endDate) > pd.to_datetime(contract.lastTradeDateOrContractMonth).tz_localize('US/Eastern')):
+    if (contract.lastTradeDateOrContractMonth < ibkr_cassette.now().strftime('%Y%m%d')) & (pd.to_datetime(endDate) > pd.to_datetime(contract.lastTradeDateOrContractMonth).tz_localize('US/Eastern')):
         print('%s: [yellow]Requesting invalid historical data for expired contract, resetting request end date...[/yellow]'%(datetime.datetime.now().strftime('%H:%M:%S')))
         # lastTradeDate = pd.to_datetime(lastTradeDate)
         lastTradeDate = pd.to_datetime(contract.lastTradeDateOrContractMonth)
@@ -246,16 +465,18 @@ def _getHistoricalBars_futures(ibkrObj, contract, endDate, lookback, interval, w
     try:
         
         ibkrObj.timeoutEvent += lambda x: print('%s: [red]Timeout event triggered![/red]'%(datetime.datetime.now().strftime('%H:%M:%S')))
-        _paceIbkrRequest(ibkrObj, 'reqHistoricalData')
-        contractHistory = ibkrObj.reqHistoricalData(
+        contractHistory = _request_with_resume(ibkrObj, 'reqHistoricalData', lambda: ibkrObj.reqHistoricalData(
             contract, 
             endDateTime = endDate,
             durationStr=lookback,
             barSizeSetting=interval,
             whatToShow=whatToShow,
             useRTH=useRTH,
-            formatDate=1)
+            formatDate=1),
+            'requesting historical bars for futures contract %s'%contract, contract, scope=breaker_scope)
         
+    except (IbkrDisconnectedError, ibkr_cassette.CassetteMissError):
+        raise
     except Exception as e:
         print(e)
         print('\nCould not retrieve history for...%s!'%(contract.symbol))
@@ -264,7 +485,9 @@ def _getHistoricalBars_futures(ibkrObj, contract, endDate, lookback, interval, w
     contractHistory_df = pd.DataFrame()
     if contractHistory: 
         # convert to dataframe & format for usage
-        contractHistory_df = _formatContractHistory(util.df(contractHistory))
+        contractHistory_df = bars_to_frame(contractHistory)
+        if whatToShow == 'TRADES':
+            contractHistory_df = _add_extra_series(ibkrObj, contract, contractHistory_df, endDate, lookback, interval, useRTH, breaker_scope)
     
     else:
         print('%s: [red]No history found for...%s![/red]'%(datetime.datetime.now().strftime("%H:%M:%S"), contract.symbol))
@@ -280,8 +503,6 @@ def _getHistoricalBars_futures_withContract(ibkrObj, contract, endDate, lookback
         returns dataframe of historical data
     """
     ## Future contract type definition: https://ib-insync.readthedocs.io/api.html#ib_insync.contract.Future
-    
-    _exit_if_disconnected(ibkrObj, 'requesting historical bars for futures with contract %s'%contract)
 
     # make sure endDate is tzaware
     if endDate:
@@ -290,15 +511,17 @@ def _getHistoricalBars_futures_withContract(ibkrObj, contract, endDate, lookback
         endDate = endDate.tz_localize('US/Eastern')
     try:
         # grab history from IBKR 
-        _paceIbkrRequest('reqHistoricalData')
-        contractHistory = ibkrObj.reqHistoricalData(
+        contractHistory = _request_with_resume(ibkrObj, 'reqHistoricalData', lambda: ibkrObj.reqHistoricalData(
             contract, 
             endDateTime = endDate,
             durationStr=lookback,
             barSizeSetting=interval,
             whatToShow=whatToShow,
             useRTH=False,
-            formatDate=1)
+            formatDate=1),
+            'requesting historical bars for futures with contract %s'%contract, contract)
+    except (IbkrDisconnectedError, ibkr_cassette.CassetteMissError):
+        raise
     except Exception as e:
         print(e)
         print('\nError42: Could not retrieve historys!')
@@ -307,7 +530,9 @@ def _getHistoricalBars_futures_withContract(ibkrObj, contract, endDate, lookback
     contractHistory_df = pd.DataFrame()
     if contractHistory: 
         # convert to dataframe & format for usage
-        contractHistory_df = _formatContractHistory(util.df(contractHistory))
+        contractHistory_df = bars_to_frame(contractHistory)
+        if whatToShow == 'TRADES':
+            contractHistory_df = _add_extra_series(ibkrObj, contract, contractHistory_df, endDate, lookback, interval)
     
     else:
         print('%s: [red]No history found for %s...%s![/red]'%(datetime.datetime.now().strftime("%H:%M:%S"), interval, contract))
@@ -320,8 +545,6 @@ def getEarliestTimeStamp_m(ibkr, symbol='SPY', currency='USD', lastTradeDate=Non
     """
     Returns [datetime] of earliest datapoint available for index and stock 
     """
-    _exit_if_disconnected(ibkr, 'getting earliest timestamp for symbol %s'%symbol)
-
     # set currency 
     if symbol in currency_mapping:
         currency = currency_mapping[symbol]
@@ -337,22 +560,20 @@ def getEarliestTimeStamp_m(ibkr, symbol='SPY', currency='USD', lastTradeDate=Non
         contract = Future(symbol=symbol, lastTradeDateOrContractMonth=lastTradeDate, exchange=exchange, currency=currency)
     else:
         contract = Stock(symbol, exchange, currency)
-    _paceIbkrRequest(ibkr, 'reqHeadTimeStamp')
-    earliestTS = ibkr.reqHeadTimeStamp(contract, useRTH=False, whatToShow='TRADES')
+    earliestTS = _request_with_resume(ibkr, 'reqHeadTimeStamp', lambda: ibkr.reqHeadTimeStamp(contract, useRTH=False, whatToShow='TRADES'),
+        'getting earliest timestamp for symbol %s'%symbol, contract)
     return pd.to_datetime(earliestTS)
 
 def getEarliestTimeStamp(ibkr, contract):
     """
     Returns [datetime] of earliest datapoint available for index and stock, requires Contract object as input
     """
-    _exit_if_disconnected(ibkr, 'getting earliest timestamp for contract %s'%contract)
-
     # check if symbol is in currency mapping
     if contract.symbol in currency_mapping:
         contract.currency = currency_mapping[contract.symbol]
     
-    _paceIbkrRequest(ibkr, 'reqHeadTimeStamp')
-    earliestTS = ibkr.reqHeadTimeStamp(contract, useRTH=False, whatToShow='TRADES')
+    earliestTS = _request_with_resume(ibkr, 'reqHeadTimeStamp', lambda: ibkr.reqHeadTimeStamp(contract, useRTH=False, whatToShow='TRADES'),
+        'getting earliest timestamp for contract %s'%contract, contract)
 
     if not earliestTS:
         print('%s: [red]Earliest timestamp returned empty for contract...%s![/red]'%(datetime.datetime.now().strftime("%H:%M:%S"), contract))
@@ -389,7 +610,7 @@ def getContractDetails(ibkr, symbol, type = 'stock', currency='USD', exchange=''
             type = 'stock' | 'future' | 'index'
             currency = 'USD' | 'CAD'
     """
-    _exit_if_disconnected(ibkr, 'getting contract details for %s %s'%(exchange, symbol))
+    context = 'getting contract details for %s %s'%(exchange, symbol)
     # set currency 
     if symbol in currency_mapping:
         currency = currency_mapping[symbol]
@@ -402,14 +623,14 @@ def getContractDetails(ibkr, symbol, type = 'stock', currency='USD', exchange=''
         if type == 'future':
             if not exchange:
                 exchange = exchange_mapping.get(symbol, '')
-            _paceIbkrRequest(ibkr, 'reqContractDetails')
-            contracts = ibkr.reqContractDetails(Future(symbol=symbol, exchange=exchange, currency=currency, includeExpired=True))
+            contract = Future(symbol=symbol, exchange=exchange, currency=currency, includeExpired=True)
         elif type == 'index':
-            _paceIbkrRequest(ibkr, 'reqContractDetails')
-            contracts = ibkr.reqContractDetails(Index(symbol, currency=currency))
+            contract = Index(symbol, currency=currency)
         else: 
-            _paceIbkrRequest(ibkr, 'reqContractDetails')
-            contracts = ibkr.reqContractDetails(Stock(symbol, currency=currency))
+            contract = Stock(symbol, currency=currency)
+        contracts = _request_with_resume(ibkr, 'reqContractDetails', lambda: ibkr.reqContractDetails(contract), context)
+    except (IbkrDisconnectedError, ibkr_cassette.CassetteMissError):
+        raise
     except Exception as e:
         print('\nCould not retrieve contract details for...%s!'%(symbol))
         return pd.DataFrame() 
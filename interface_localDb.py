@@ -14,6 +14,8 @@ import sqlite3
 import sys
 import config
 import datetime 
+import ibkr_cassette
+import ibkr_telemetry
 import re
 import pandas as pd
 import numpy as np
@@ -106,7 +108,7 @@ def _getDaysSinceLastUpdated(row, conn):
     maxtime = pd.read_sql('SELECT MAX(date) FROM '+ row['name'], conn)
     mytime = datetime.datetime.strptime(maxtime['MAX(date)'][0][:10], '%Y-%m-%d')
     ## calculate business days since last update
-    numDays = len( pd.bdate_range(mytime, datetime.datetime.now())) - 1
+    numDays = len( pd.bdate_range(mytime, ibkr_cassette.now())) - 1
 
     return numDays
 
@@ -428,9 +430,10 @@ def _formatpxHistory(pxHistory, type=None):
         type: {ohlc i.e. None, termstructure}
     """
     pxHistory.reset_index(drop=True, inplace=True) # reset index
+    interval = pxHistory['interval'].iloc[0] if not pxHistory.empty else None
 
     # if interval is 1day, make sure sure the date column only has 10chars 
-    if pxHistory['interval'][1] == '1day':
+    if interval == '1day':
         pxHistory['date'] = pxHistory['date'].str[:10]
     
     ##### Remove any errant timezone info:
@@ -445,7 +448,7 @@ def _formatpxHistory(pxHistory, type=None):
         pxHistory.update(pxHistory_hasTimezone)
 
     # final formatting ... 
-    if pxHistory['interval'][1] == '1day':
+    if interval == '1day':
         pxHistory['date'] = pd.to_datetime(pxHistory['date'], format='%Y-%m-%d')
     else:
         pxHistory['date'] = pd.to_datetime(pxHistory['date'], format='%Y-%m-%d %H:%M:%S')
@@ -544,7 +547,7 @@ def _batch_fetch_metadata(conn, table_names: list) -> pd.DataFrame:
             # 'daysSinceLastUpdate': (current_date - results['last_update'].datetime.date).dt.days
         })
         metadata_df['daysSinceLastUpdate'] = results['last_update'].apply(
-            lambda x: len(pd.bdate_range(x, datetime.datetime.now())) - 1
+            lambda x: len(pd.bdate_range(x, ibkr_cassette.now())) - 1
         )
 
         return metadata_df
@@ -553,6 +556,62 @@ def _batch_fetch_metadata(conn, table_names: list) -> pd.DataFrame:
         print(f'Error fetching metadata: {e}')
         return pd.DataFrame()
     
+def _get_history_tablename(history):
+    """
+        Returns the pxhistory table a history frame belongs to: symbol_type_interval or symbol_expiry_interval
+    """
+    if 'lastTradeDate' in history.columns:
+        return history['symbol'].iloc[0]+'_'+history['lastTradeDate'].iloc[0]+'_'+history['interval'].iloc[0]
+    if history['symbol'].iloc[0] in index_list:
+        type = 'index'
+    else: 
+        type='stock'
+    return history['symbol'].iloc[0]+'_'+type+'_'+history['interval'].iloc[0]
+
+def _add_missing_columns(conn, tablename, history):
+    """
+        Adds columns of history the pxhistory table does not have yet (extra bar series, see config.extra_series)
+    """
+    existing = pd.read_sql('PRAGMA table_info(\'%s\')' % tablename, conn)
+    if existing.empty:
+        # new table, to_sql creates it with every column
+        return
+    cursor = conn.cursor()
+    for column in history.columns.difference(existing['name'], sort=False):
+        cursor.execute('ALTER TABLE \'%s\' ADD COLUMN "%s" REAL' % (tablename, column))
+
+def _get_series_columns(columns):
+    """
+        Returns the extra bar series columns (<series>_open .. _close, see config.extra_series) among columns
+    """
+    prefixes = tuple('%s_' % series.lower() for by_symbol in config.extra_series.values() for series_list in by_symbol.values() for series in series_list)
+    return [col for col in columns if prefixes and col.startswith(prefixes)]
+
+def _fill_series_columns(conn, tablename, history):
+    """
+        Writes the extra series values of history onto the stored rows of the same dates.
+        Appending keeps the row stored first, so without this a date saved before its series were fetched
+        (earlier history, the overlap of a forward fill window, TRADES-only live bars) would keep NULL in them.
+    """
+    columns = _get_series_columns(history.columns)
+    if not columns:
+        return
+    series = history[['date'] + columns].dropna(subset=columns, how='all')
+    if series.empty:
+        return
+
+    cursor = conn.cursor()
+    cursor.execute('DROP TABLE IF EXISTS temp.series_fill')
+    cursor.execute('CREATE TEMP TABLE series_fill (date TEXT PRIMARY KEY, %s)' % ', '.join('"%s" REAL' % col for col in columns))
+    cursor.executemany(
+        'INSERT OR REPLACE INTO temp.series_fill (date, %s) VALUES (%s)' % (', '.join('"%s"' % col for col in columns), ', '.join('?' * (len(columns) + 1))),
+        [tuple(_to_sql_value(value) for value in row) for row in series.itertuples(index=False)])
+    # a series value we did not get this time leaves the stored one in place
+    cursor.execute('UPDATE \'%s\' SET %s WHERE date IN (SELECT date FROM temp.series_fill)' % (
+        tablename,
+        ', '.join('"%s" = COALESCE((SELECT s."%s" FROM temp.series_fill s WHERE s.date = \'%s\'.date), "%s")' % (col, col, tablename, col) for col in columns)))
+    cursor.execute('DROP TABLE temp.series_fill')
+
 def saveHistoryToDB(history, conn, earliestTimestamp=None, type=''):
     """
     Save history to a sqlite3 database
@@ -569,19 +628,65 @@ def saveHistoryToDB(history, conn, earliestTimestamp=None, type=''):
         history['interval'] = history['interval'].apply(lambda x: x.replace(' ', ''))
 
     ## set type to index if the symbol is in the index list 
-    if 'lastTradeDate' in history.columns:
-        type = 'future'
-        tableName = history['symbol'][0]+'_'+history['lastTradeDate'][0]+'_'+history['interval'][0]
-    else:
-        if history['symbol'][0] in index_list:
-            type = 'index'
-        else: 
-            type='stock'
-        tableName = history['symbol'][0]+'_'+type+'_'+history['interval'][0]
+    tableName = _get_history_tablename(history)
     print('%s: Saving %s to db, Range: %s - %s...'%(datetime.datetime.now().strftime("%H:%M:%S"), tableName, history['date'].min(), history['date'].max()))
-    history.to_sql(f"{tableName}", conn, index=False, if_exists='append')
-    _removeDuplicates(tableName, conn)
-    _update_symbol_metadata(conn, tableName, earliestTimestamp=earliestTimestamp)
+    with ibkr_telemetry.timed('save', rows=len(history), table=tableName):
+        _add_missing_columns(conn, tableName, history)
+        history.to_sql(f"{tableName}", conn, index=False, if_exists='append')
+        _removeDuplicates(tableName, conn)
+        _fill_series_columns(conn, tableName, history)
+        # only the days this chunk touched need their session stats recomputed
+        refresh_daily_session_stats(conn, tableName, history['date'].min(), history['date'].max(), config.table_name_daily_session_stats)
+        _update_symbol_metadata(conn, tableName, earliestTimestamp=earliestTimestamp)
+
+def save_history_batch(histories, conn, earliestTimestamps=None):
+    """
+    Batched writer: saves many small history frames with one write and metadata update per table.
+    Tables that already hold bars only get the bars newer than their last stored one appended (live bars),
+    new tables go through saveHistoryToDB
+    ###
+
+    Params
+    ------------
+    histories: [list of DataFrame]
+        frames in saveHistoryToDB format, any mix of tables
+    conn: [Sqlite connection object]
+    earliestTimestamps: [dict] optional
+        tablename -> earliest available timestamp, passed through to the lookup table update
+    """
+    earliestTimestamps = earliestTimestamps or {}
+    by_table = {}
+    for history in histories:
+        if history is None or history.empty:
+            continue
+        history = history.copy()
+        if 'interval' in history.columns:
+            history['interval'] = history['interval'].str.replace(' ', '')
+        by_table.setdefault(_get_history_tablename(history), []).append(history)
+
+    for tableName, frames in by_table.items():
+        history = pd.concat(frames, ignore_index=True).drop_duplicates(subset='date', keep='last').reset_index(drop=True)
+        try:
+            last_date = conn.execute('SELECT MAX(date) FROM \'%s\'' % tableName).fetchone()[0]
+        except sqlite3.OperationalError:
+            # new table, the full path creates it
+            last_date = None
+        if last_date is None:
+            saveHistoryToDB(history, conn, earliestTimestamp=earliestTimestamps.get(tableName))
+            continue
+
+        # only bars past the last stored one are appended, so no full-table dedupe is needed
+        _add_missing_columns(conn, tableName, history)
+        _fill_series_columns(conn, tableName, history)
+        history = history.loc[pd.to_datetime(history['date']) > pd.Timestamp(last_date)]
+        if history.empty:
+            conn.commit()
+            continue
+        with ibkr_telemetry.timed('save', rows=len(history), table=tableName):
+            history.to_sql(f"{tableName}", conn, index=False, if_exists='append')
+            refresh_daily_session_stats(conn, tableName, history['date'].min(), history['date'].max(), config.table_name_daily_session_stats)
+            _update_symbol_metadata(conn, tableName, earliestTimestamp=earliestTimestamps.get(tableName))
+    return list(by_table.keys())
 
 def save_table_to_db(conn, tablename, metadata_df, if_exists='append'):
     """
@@ -625,9 +730,16 @@ def getPriceHistoryWithTablename(conn, tablename):
     return pxHistory
 
 
-def getTable(conn, tablename, is_pxhistory=False):
+def getTable(conn, tablename, is_pxhistory=False, start_date=None):
+    """
+    Returns the table as a df, only the rows dated on or after the day of <start_date> when given
+    """
     sqlStatement = 'SELECT * FROM \'%s\''%(tablename)
-    table_data = pd.read_sql(sqlStatement, conn)
+    if start_date is None:
+        table_data = pd.read_sql(sqlStatement, conn)
+    else:
+        sqlStatement += ' WHERE date >= ?'
+        table_data = pd.read_sql(sqlStatement, conn, params=(pd.Timestamp(start_date).strftime('%Y-%m-%d'),))
 
     # handle termstrcuture case by adding interval and symbol to the df. first splot tablename by _ 
     if is_pxhistory:
@@ -642,6 +754,7 @@ def update_gap_metadata(conn, tablename, last_polled_date):
     """
     Update the pxhistory gaps metadata table with the latest update date for a given table
     """
+    create_pxhistory_gap_metadata_table(conn, config.table_name_futures_pxhistory_metadata)
     sqlStatement = 'INSERT INTO \'%s\' (tablename, date_of_last_gap_date_polled, update_date) VALUES (\'%s\', \'%s\', \'%s\') ON CONFLICT(tablename) DO UPDATE SET date_of_last_gap_date_polled=excluded.date_of_last_gap_date_polled, update_date=excluded.update_date'%(config.table_name_futures_pxhistory_metadata, tablename, last_polled_date, datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
     cursor = conn.cursor()
     cursor.execute(sqlStatement)
@@ -835,4 +948,469 @@ def update_progress_tracker_fields(conn, tablename_key, updates, tablename='00-p
     values = list(sanitized.values()) + [tablename_key]
     cursor = conn.cursor()
     cursor.execute(sql, values)
-    conn.commit()
\ No newline at end of file
+    conn.commit()
+
+def create_fetch_jobs_table(conn, tablename='00-fetch_jobs'):
+    """
+    Ensure the fetch scheduler job table exists.
+    """
+    sql = (
+        "CREATE TABLE IF NOT EXISTS '%s' ("
+        "job_id TEXT PRIMARY KEY, "
+        "kind TEXT NOT NULL, "
+        "asset TEXT NOT NULL, "
+        "symbol TEXT NOT NULL, "
+        "interval TEXT NOT NULL, "
+        "expiry TEXT, "
+        "tablename TEXT NOT NULL, "
+        "score REAL NOT NULL, "
+        "status TEXT NOT NULL, "
+        "attempts INTEGER NOT NULL DEFAULT 0, "
+        "enqueued_at TEXT NOT NULL, "
+        "updated_at TEXT NOT NULL, "
+        "last_error TEXT"
+        ")"
+    ) % tablename
+    cursor = conn.cursor()
+    cursor.execute(sql)
+    conn.commit()
+
+
+def get_fetch_jobs(conn, status=None, tablename='00-fetch_jobs'):
+    """
+    Return fetch jobs as a dataframe, highest score first.
+    """
+    sql = "SELECT * FROM '%s'" % tablename
+    params = ()
+    if status is not None:
+        sql += " WHERE status = ?"
+        params = (status,)
+    sql += " ORDER BY score DESC, enqueued_at ASC"
+    try:
+        data = pd.read_sql(sql, conn, params=params)
+    except Exception:
+        return pd.DataFrame()
+
+    for col in ['enqueued_at', 'updated_at']:
+        if col in data.columns:
+            data[col] = pd.to_datetime(data[col], errors='coerce')
+    return data
+
+
+def upsert_fetch_job(conn, job, tablename='00-fetch_jobs'):
+    """
+    Enqueue a fetch job, or refresh the score of one already queued.
+    Running and failed jobs keep their status (failed ones also their last attempt time), finished ones are queued again.
+    """
+    now = _normalize_timestamp_scalar(pd.Timestamp.now().floor('s'))
+    sql = (
+        "INSERT INTO '%s' ("
+        "job_id, kind, asset, symbol, interval, expiry, tablename, "
+        "score, status, attempts, enqueued_at, updated_at, last_error"
+        ") VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'pending', 0, ?, ?, NULL) "
+        "ON CONFLICT(job_id) DO UPDATE SET "
+        "score=excluded.score, "
+        "updated_at=CASE WHEN status = 'failed' THEN updated_at ELSE excluded.updated_at END, "
+        "attempts=CASE WHEN status = 'done' THEN 0 ELSE attempts END, "
+        "status=CASE WHEN status IN ('running', 'failed') THEN status ELSE 'pending' END"
+    ) % tablename
+    cursor = conn.cursor()
+    cursor.execute(
+        sql,
+        (
+            job['job_id'],
+            job['kind'],
+            job['asset'],
+            job['symbol'],
+            job['interval'],
+            job.get('expiry'),
+            job['tablename'],
+            float(job['score']),
+            now,
+            now,
+        ),
+    )
+    conn.commit()
+
+
+def update_fetch_job_fields(conn, job_id, updates, tablename='00-fetch_jobs'):
+    """
+    Update selected fields for a fetch job.
+    """
+    sanitized = {k: v for k, v in updates.items() if k not in ['job_id', 'enqueued_at']}
+    if not sanitized:
+        return
+    sanitized['updated_at'] = _normalize_timestamp_scalar(pd.Timestamp.now().floor('s'))
+
+    assignments = ', '.join([f"{col} = ?" for col in sanitized.keys()])
+    sql = "UPDATE '%s' SET %s WHERE job_id = ?" % (tablename, assignments)
+    cursor = conn.cursor()
+    cursor.execute(sql, list(sanitized.values()) + [job_id])
+    conn.commit()
+
+
+def reset_fetch_jobs(conn, tablename='00-fetch_jobs', failed_cooldown_days=None):
+    """
+    Returns jobs left running by an interrupted run to the queue. Failed jobs stay failed; with
+    failed_cooldown_days set, those whose last attempt is older than that are queued again. They keep
+    their attempt count, so one more failure retires them for another cool-down.
+    """
+    cursor = conn.cursor()
+    cursor.execute("UPDATE '%s' SET status = 'pending' WHERE status = 'running'" % tablename)
+    if failed_cooldown_days is not None:
+        cutoff = _normalize_timestamp_scalar(pd.Timestamp.now().floor('s') - pd.Timedelta(days=failed_cooldown_days))
+        cursor.execute("UPDATE '%s' SET status = 'pending' WHERE status = 'failed' AND updated_at < ?" % tablename, (cutoff,))
+    conn.commit()
+
+
+def prune_fetch_jobs(conn, job_ids, tablename='00-fetch_jobs'):
+    """
+    Deletes pending jobs whose id is not in job_ids, i.e. work discovery no longer reports.
+    Returns the number of jobs deleted.
+    """
+    job_ids = set(job_ids)
+    cursor = conn.cursor()
+    pending = [job_id for (job_id,) in cursor.execute("SELECT job_id FROM '%s' WHERE status = 'pending'" % tablename)]
+    stale = [(job_id,) for job_id in pending if job_id not in job_ids]
+    cursor.executemany("DELETE FROM '%s' WHERE job_id = ?" % tablename, stale)
+    conn.commit()
+    return len(stale)
+
+
+def create_unfilled_gaps_table(conn, tablename='00-lookup_unfilled_gaps'):
+    """
+    Ensure the table of gap dates that survived a fill attempt exists.
+    """
+    sql = (
+        "CREATE TABLE IF NOT EXISTS '%s' ("
+        "tablename TEXT NOT NULL, "
+        "gap_date TEXT NOT NULL, "
+        "attempts INTEGER NOT NULL, "
+        "last_attempt TEXT NOT NULL, "
+        "PRIMARY KEY (tablename, gap_date)"
+        ")"
+    ) % tablename
+    cursor = conn.cursor()
+    cursor.execute(sql)
+    conn.commit()
+
+
+def get_unfilled_gaps(conn, pxhistory_tablename, tablename='00-lookup_unfilled_gaps'):
+    """
+    Return {gap_date (pd.Timestamp): attempts} for a pxhistory table.
+    """
+    create_unfilled_gaps_table(conn, tablename)
+    rows = conn.execute(
+        "SELECT gap_date, attempts FROM '%s' WHERE tablename = ?" % tablename, (pxhistory_tablename,)
+    ).fetchall()
+    return {pd.Timestamp(gap_date): attempts for gap_date, attempts in rows}
+
+
+def record_gap_fill_attempt(conn, pxhistory_tablename, attempted_dates, remaining_dates, tablename='00-lookup_unfilled_gaps'):
+    """
+    Records the outcome of a gap fill pass: attempted dates still missing get their attempt count
+    bumped, attempted dates that were filled are cleared.
+    """
+    create_unfilled_gaps_table(conn, tablename)
+    attempted = {pd.Timestamp(d).strftime('%Y-%m-%d') for d in attempted_dates}
+    remaining = {pd.Timestamp(d).strftime('%Y-%m-%d') for d in remaining_dates}
+    now = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+    cursor = conn.cursor()
+    cursor.executemany(
+        "INSERT INTO '%s' (tablename, gap_date, attempts, last_attempt) VALUES (?, ?, 1, ?) "
+        "ON CONFLICT(tablename, gap_date) DO UPDATE SET attempts = attempts + 1, last_attempt = excluded.last_attempt" % tablename,
+        [(pxhistory_tablename, d, now) for d in sorted(attempted & remaining)],
+    )
+    cursor.executemany(
+        "DELETE FROM '%s' WHERE tablename = ? AND gap_date = ?" % tablename,
+        [(pxhistory_tablename, d) for d in sorted(attempted - remaining)],
+    )
+    conn.commit()
+
+
+def create_pxhistory_gap_metadata_table(conn, tablename='00-lookup_pxhistory_metadata'):
+    """
+    Ensure the gap metadata table exists, one row per pxhistory table keyed by tablename.
+    A table from before the key (a row appended per pass) is migrated, keeping each table's latest row.
+    """
+    columns = conn.execute("PRAGMA table_info('%s')" % tablename).fetchall()
+    legacy = None
+    if columns and not any(name == 'tablename' and pk for _, name, _, _, _, pk in columns):
+        legacy = '%s_legacy' % tablename
+        conn.execute("ALTER TABLE '%s' RENAME TO '%s'" % (tablename, legacy))
+
+    sql = (
+        "CREATE TABLE IF NOT EXISTS '%s' ("
+        "tablename TEXT PRIMARY KEY, "
+        "num_unique_gaps INTEGER, "
+        "update_date TEXT, "
+        "date_of_last_gap_date_polled TEXT, "
+        "data_version TEXT"
+        ")"
+    ) % tablename
+    cursor = conn.cursor()
+    cursor.execute(sql)
+    if legacy is not None:
+        cursor.execute(
+            "INSERT OR REPLACE INTO '%s' (tablename, num_unique_gaps, update_date, date_of_last_gap_date_polled) "
+            "SELECT tablename, num_unique_gaps, update_date, date_of_last_gap_date_polled FROM '%s' ORDER BY update_date" % (tablename, legacy)
+        )
+        cursor.execute("DROP TABLE '%s'" % legacy)
+    conn.commit()
+
+
+def get_pxhistory_gap_metadata(conn, tablename='00-lookup_pxhistory_metadata'):
+    """
+    Return the gap metadata of every pxhistory table as a dataframe.
+    """
+    create_pxhistory_gap_metadata_table(conn, tablename)
+    return pd.read_sql("SELECT * FROM '%s'" % tablename, conn)
+
+
+def _to_sql_value(value):
+    if value is None or (not isinstance(value, str) and pd.isna(value)):
+        return None
+    if isinstance(value, (datetime.date, np.datetime64)):
+        return pd.Timestamp(value).strftime('%Y-%m-%d %H:%M:%S')
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def upsert_pxhistory_gap_metadata(conn, metadata_df, tablename='00-lookup_pxhistory_metadata'):
+    """
+    Insert or update gap metadata rows by tablename, writing the columns present in metadata_df.
+    Dates are stored as 'YYYY-MM-DD HH:MM:SS'.
+    """
+    create_pxhistory_gap_metadata_table(conn, tablename)
+    if metadata_df.empty:
+        return
+    columns = [col for col in ['tablename', 'num_unique_gaps', 'update_date', 'date_of_last_gap_date_polled', 'data_version'] if col in metadata_df.columns]
+    sql = "INSERT INTO '%s' (%s) VALUES (%s) ON CONFLICT(tablename) DO UPDATE SET %s" % (
+        tablename,
+        ', '.join(columns),
+        ', '.join('?' * len(columns)),
+        ', '.join('%s = excluded.%s' % (col, col) for col in columns if col != 'tablename'),
+    )
+    rows = [tuple(_to_sql_value(value) for value in row) for row in metadata_df[columns].itertuples(index=False)]
+    cursor = conn.cursor()
+    cursor.executemany(sql, rows)
+    conn.commit()
+
+
+def create_daily_session_stats_table(conn, tablename='00-daily_session_stats'):
+    """
+    Ensure the materialized per-day session stats table exists.
+    """
+    sql = (
+        "CREATE TABLE IF NOT EXISTS '%s' ("
+        "tablename TEXT NOT NULL, "
+        "trade_date TEXT NOT NULL, "
+        "daily_count INTEGER NOT NULL, "
+        "first_bar_time TEXT, "
+        "last_bar_time TEXT, "
+        "session_span_minutes INTEGER, "
+        "PRIMARY KEY (tablename, trade_date)"
+        ")"
+    ) % tablename
+    cursor = conn.cursor()
+    cursor.execute(sql)
+    conn.commit()
+
+
+def refresh_daily_session_stats(conn, pxhistory_tablename, start_date=None, end_date=None, tablename='00-daily_session_stats'):
+    """
+    Recompute the session stats of a pxhistory table for the trade dates from start_date to end_date
+    (inclusive), or for the whole table when no dates are given.
+    A table without stats yet is always computed whole, so stored stats cover every day of their table.
+    """
+    create_daily_session_stats_table(conn, tablename)
+    has_stats = conn.execute(
+        "SELECT 1 FROM '%s' WHERE tablename = ? LIMIT 1" % tablename, (pxhistory_tablename,)
+    ).fetchone()
+
+    cursor = conn.cursor()
+    params = [pxhistory_tablename]
+    where = ''
+    if start_date is None or end_date is None or has_stats is None:
+        cursor.execute("DELETE FROM '%s' WHERE tablename = ?" % tablename, (pxhistory_tablename,))
+    else:
+        where = 'WHERE DATE(date) BETWEEN ? AND ? '
+        params += [pd.Timestamp(start_date).strftime('%Y-%m-%d'), pd.Timestamp(end_date).strftime('%Y-%m-%d')]
+
+    sql = (
+        "INSERT OR REPLACE INTO '%s' "
+        "(tablename, trade_date, daily_count, first_bar_time, last_bar_time, session_span_minutes) "
+        "SELECT ?, DATE(date), COUNT(*), MIN(TIME(date)), MAX(TIME(date)), "
+        "CAST((JULIANDAY(MAX(date)) - JULIANDAY(MIN(date))) * 24 * 60 AS INTEGER) "
+        "FROM '%s' %s"
+        "GROUP BY DATE(date)"
+    ) % (tablename, pxhistory_tablename, where)
+    cursor.execute(sql, params)
+    conn.commit()
+
+
+def read_daily_session_stats(conn, pxhistory_tablename, start_date=None, end_date=None, tablename='00-daily_session_stats'):
+    """
+    Return the stored per-day session stats of a pxhistory table without creating or computing anything,
+    safe on a read-only connection; empty when the table has no stats yet.
+    Limited to the trade dates from start_date to end_date (inclusive) when both are given.
+    """
+    params = [pxhistory_tablename]
+    where = ''
+    if start_date is not None and end_date is not None:
+        where = 'AND trade_date BETWEEN ? AND ? '
+        params += [pd.Timestamp(start_date).strftime('%Y-%m-%d'), pd.Timestamp(end_date).strftime('%Y-%m-%d')]
+    sql = (
+        "SELECT trade_date, daily_count, first_bar_time, last_bar_time, session_span_minutes "
+        "FROM '%s' WHERE tablename = ? %sORDER BY trade_date"
+    ) % (tablename, where)
+    return pd.read_sql(sql, conn, params=params)
+
+
+def get_daily_session_stats(conn, pxhistory_tablename, start_date=None, end_date=None, tablename='00-daily_session_stats'):
+    """
+    Return the per-day session stats of a pxhistory table, computing them on first use:
+    trade_date | daily_count | first_bar_time | last_bar_time | session_span_minutes
+    Limited to the trade dates from start_date to end_date (inclusive) when both are given.
+    """
+    create_daily_session_stats_table(conn, tablename)
+    data = read_daily_session_stats(conn, pxhistory_tablename, start_date, end_date, tablename)
+    if data.empty and not conn.execute("SELECT 1 FROM '%s' WHERE tablename = ? LIMIT 1" % tablename, (pxhistory_tablename,)).fetchone():
+        refresh_daily_session_stats(conn, pxhistory_tablename, tablename=tablename)
+        data = read_daily_session_stats(conn, pxhistory_tablename, start_date, end_date, tablename)
+    return data
+
+
+def delete_daily_session_stats(conn, pxhistory_tablename, tablename='00-daily_session_stats'):
+    """
+    Drop the stored session stats of a pxhistory table, used when the table itself is dropped.
+    """
+    create_daily_session_stats_table(conn, tablename)
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM '%s' WHERE tablename = ?" % tablename, (pxhistory_tablename,))
+    conn.commit()
+
+
+def get_daily_session_stats_versions(conn, tablename='00-daily_session_stats'):
+    """
+    Return {pxhistory tablename: data version} from the stored session stats. The version (days, bars, last day)
+    changes whenever bars are added to a table, so it tells which tables need their gaps rescanned.
+    """
+    create_daily_session_stats_table(conn, tablename)
+    rows = conn.execute(
+        "SELECT tablename, COUNT(*), SUM(daily_count), MAX(trade_date) FROM '%s' GROUP BY tablename" % tablename
+    ).fetchall()
+    return {name: '%s:%s:%s' % (num_days, num_bars, last_day) for name, num_days, num_bars, last_day in rows}
+
+
+def materialize_daily_session_stats(conn, pxhistory_tablenames, tablename='00-daily_session_stats'):
+    """
+    Compute the session stats of every listed pxhistory table that has none stored yet.
+    """
+    create_daily_session_stats_table(conn, tablename)
+    stored = {name for (name,) in conn.execute("SELECT DISTINCT tablename FROM '%s'" % tablename)}
+    for pxhistory_tablename in pxhistory_tablenames:
+        if pxhistory_tablename in stored:
+            continue
+        try:
+            refresh_daily_session_stats(conn, pxhistory_tablename, tablename=tablename)
+        except sqlite3.OperationalError as e:
+            # listed in the lookup table but missing from the db
+            print('%s: [yellow]Could not compute session stats for %s: %s[/yellow]' % (datetime.datetime.now().strftime('%H:%M:%S'), pxhistory_tablename, e))
+
+
+def create_termstructure_metadata_table(conn, tablename='00-lookup_termstructure_metadata'):
+    """
+    Ensure the term structure metadata table exists, one row per term structure table with the
+    signature of the contracts it was last built from.
+    """
+    sql = (
+        "CREATE TABLE IF NOT EXISTS '%s' ("
+        "tablename TEXT PRIMARY KEY, "
+        "contracts TEXT NOT NULL, "
+        "update_date TEXT NOT NULL"
+        ")"
+    ) % tablename
+    cursor = conn.cursor()
+    cursor.execute(sql)
+    conn.commit()
+
+
+def get_termstructure_metadata(conn, termstructure_tablename, tablename='00-lookup_termstructure_metadata'):
+    """
+    Return the metadata of a term structure table as a dict, None when it has none.
+    """
+    create_termstructure_metadata_table(conn, tablename)
+    row = conn.execute(
+        "SELECT tablename, contracts, update_date FROM '%s' WHERE tablename = ?" % tablename, (termstructure_tablename,)
+    ).fetchone()
+    if row is None:
+        return None
+    return dict(zip(['tablename', 'contracts', 'update_date'], row))
+
+
+def upsert_termstructure_metadata(conn, termstructure_tablename, contracts, tablename='00-lookup_termstructure_metadata'):
+    """
+    Insert or update the contract signature of a term structure table.
+    """
+    create_termstructure_metadata_table(conn, tablename)
+    cursor = conn.cursor()
+    cursor.execute(
+        "INSERT INTO '%s' (tablename, contracts, update_date) VALUES (?, ?, ?) "
+        "ON CONFLICT(tablename) DO UPDATE SET contracts=excluded.contracts, update_date=excluded.update_date" % tablename,
+        (termstructure_tablename, contracts, datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')),
+    )
+    conn.commit()
+
+
+def get_last_date(conn, tablename):
+    """
+    Return the latest date stored in a table, None when the table is missing or empty.
+    """
+    try:
+        (last_date,) = conn.execute("SELECT MAX(date) FROM '%s'" % tablename).fetchone()
+    except sqlite3.OperationalError:
+        return None
+    return None if last_date is None else pd.Timestamp(last_date)
+
+
+def upsert_termstructure(conn, termstructure, tablename, overwrite_from=None):
+    """
+    Write term structure rows keyed by date, creating the table on first use.
+    Rows dated on or after <overwrite_from> replace stored rows that differ, earlier rows are only
+    inserted when their date is not stored yet. Returns the number of rows written.
+    """
+    if termstructure.empty:
+        return 0
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (tablename,)).fetchone() is None:
+        termstructure.head(0).to_sql(tablename, conn, index=False)
+
+    # the unique date index is the upsert's conflict target, tables written before it may still hold duplicates
+    index_name = '%s_date' % tablename
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type='index' AND name=?", (index_name,)).fetchone() is None:
+        _removeDuplicates(tablename, conn)
+        conn.execute("CREATE UNIQUE INDEX '%s' ON '%s' (date)" % (index_name, tablename))
+
+    columns = list(termstructure.columns)
+    values = [col for col in columns if col != 'date']
+    insert = "INSERT INTO '%s' (%s) VALUES (%s) ON CONFLICT(date) DO " % (
+        tablename, ', '.join('"%s"' % col for col in columns), ', '.join('?' * len(columns)))
+    statements = {
+        False: insert + 'NOTHING',
+        True: insert + 'UPDATE SET %s WHERE %s' % (
+            ', '.join('"%s" = excluded."%s"' % (col, col) for col in values),
+            ' OR '.join('"%s" IS NOT excluded."%s"' % (col, col) for col in values)),
+    }
+    overwrite = np.zeros(len(termstructure), dtype=bool) if overwrite_from is None else (termstructure['date'] >= pd.Timestamp(overwrite_from)).to_numpy()
+
+    cursor = conn.cursor()
+    written = 0
+    for replace in [False, True]:
+        rows = [tuple(_to_sql_value(value) for value in row) for row in termstructure.loc[overwrite == replace, columns].itertuples(index=False)]
+        if rows:
+            cursor.executemany(statements[replace], rows)
+            written += cursor.rowcount
+    conn.commit()
+    return written
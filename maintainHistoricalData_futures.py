@@ -10,7 +10,9 @@ General logic:
 """
 from locale import currency
 import time
+import os
 import re 
+import sqlite3
 import config
 import math
 
@@ -22,10 +24,16 @@ import pandas_market_calendars as xcals
 # import interface_localDb_old as db
 import interface_localDB as db
 import interface_ibkr as ibkr
+import ibkr_cassette
+import ibkr_request_planner as planner
 import checkDataIntegrity as cdi
+import exchange_calendar_cache
 
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
+from itertools import repeat
+from urllib.request import pathname2url
 from rich import print
 
 # set pands to print all rows in df 
@@ -37,6 +45,7 @@ pd.set_option('display.max_colwidth', None)
 Config vars 
 """
 _defaultSleepTime = 30 #seconds, wait time between ibkr api calls 
+_maxPreHistoryRequestsPerRecord = 5 # max ibkr calls per record in a single pre-history pass 
 
 """
     global variables
@@ -45,7 +54,8 @@ filename_futuresWatchlist = 'futuresWatchlist.csv'
 dbName_futures = config.dbname_futures
 trackedIntervals = config.intervals
 numExpiryMonths = 14 # number of future expiries we want to track at any given time 
-_calendar_cache = {}
+_gap_scan_conn = None # read-only connection of a gap scan worker process
+_noGapsDate = pd.to_datetime('1989-12-30') # date_of_last_gap_date_polled of a table with every gap attempted
 
 def _addspace(myStr): 
     """
@@ -58,16 +68,9 @@ def _addspace(myStr):
 
 def _setLookback(interval):
     """
-        lambda function to set lookback based on interval
+        lambda function to set lookback based on interval, delegates to the request planner
     """
-    lookback = '10 D'
-    if interval in ['1 day']:
-        lookback = '300 D'
-    elif interval in ['30 mins', '5 mins']:
-        lookback = '20 D'
-    elif interval in ['1 min']:
-        lookback = '5 D'
-    return lookback
+    return planner.get_max_lookback(_addspace(interval))
 
 def _getWatchlist(filename):
     """
@@ -134,29 +137,24 @@ def _updateSingleRecord(ib, symbol, expiry, interval, lookback, endDate='', curr
         contract = Future(symbol=symbol, lastTradeDateOrContractMonth=expiry, exchange=exchange, currency=currency, includeExpired=True)
     
     # Get futures history from ibkr
-    # Split into multiple calls for shorter intervals so we can get more data in 1 go   
-    if (interval in ['1 min', '5 mins', '1min', '5mins']) and int(lookback.strip(' D')) > 3:
-        # calculate number of calls needed
-        numCalls = math.ceil(int(lookback.strip(' D'))/3)
-        record=pd.DataFrame()
-        # loop for numCalls appending records and reducing endDate by lookback each time
-        for i in range(0, numCalls):
-            # bars = ibkr.getBars_futures(ib, symbol=symbol, lastTradeDate=expiry, interval=interval, endDate=endDate, lookback='3 D', exchange=exchange)
-            bars = ibkr.getBars_futures(ib, contract, interval=interval, endDate=endDate, lookback='3 D')
-            # drop the last bar as its likely incomplete 
-            if (bars is None) or (bars.empty):
-                break
-            else:
-                # bars = bars.iloc[:-1,:]
-                record = record._append(bars)   
-                endDate = record['date'].min() # update endDate for next loop 
-                if i < numCalls-1:
-                    print('%s: [orange]sleeping for %ss...[/orange]'%(datetime.now().strftime('%H:%M:%S'), _defaultSleepTime/30))
-                    time.sleep(_defaultSleepTime/30)
-        record.reset_index(drop=True, inplace=True)
-    else:
-        # query ibkr for futures history 
-        record = ibkr.getBars_futures(ib, contract, interval=interval, endDate=endDate, lookback=lookback)
+    # let the planner split the lookback window into the fewest valid requests
+    windowEnd = pd.to_datetime(endDate) if endDate else ibkr_cassette.now().floor('s')
+    requests = planner.plan_requests(
+        interval,
+        [(planner.lookback_start(windowEnd, lookback), windowEnd)],
+        contract_end=expiry,
+        exchange=exchange)
+    record = pd.DataFrame()
+    for i, request in enumerate(requests):
+        bars = ibkr.getBars_futures(ib, contract, interval=_addspace(interval), endDate=request['endDate'], lookback=request['lookback'])
+        if (bars is None) or (bars.empty):
+            break
+        record = record._append(bars)
+        if i < len(requests)-1:
+            print('%s: [orange]sleeping for %ss...[/orange]'%(datetime.now().strftime('%H:%M:%S'), _defaultSleepTime/30))
+            time.sleep(_defaultSleepTime/30)
+    if not record.empty:
+        record = record.drop_duplicates(subset=['date']).sort_values(by='date').reset_index(drop=True)
     
     # print(record)
     # exit() 
@@ -386,41 +384,19 @@ def _quote_sqlite_identifier(identifier: str) -> str:
     """
     return '"%s"' % str(identifier).replace('"', '""')
 
-def _get_exchange_calendar(exchange):
+def _get_calendar_schedule(exchange, start_date, end_date):
     """
-        Returns (calendar_code, exchange_calendars calendar) for an IBKR-style exchange code.
-        Returns (None, None) and logs a warning when mapping is unavailable.
+        Returns schedule dataframe for [start_date, end_date] and calendar code.
+        Sliced from the precomputed session table of the calendar (exchange_calendar_cache).
     """
     exchange = str(exchange or '').upper()
     calendar_code = config.exchange_calendar_mapping.get(exchange)
     if not calendar_code:
         print('%s: [red]No exchange_calendars mapping found for exchange %s[/red]' % (datetime.now().strftime('%H:%M:%S'), exchange))
-        return None, None
-
-    if calendar_code in _calendar_cache:
-        return calendar_code, _calendar_cache[calendar_code]
-
-    try:
-        calendar = xcals.get_calendar(calendar_code)
-    except Exception as ex:
-        print('%s: [red]Unable to load exchange calendar %s for %s: %s[/red]' % (datetime.now().strftime('%H:%M:%S'), calendar_code, exchange, str(ex)))
-        return calendar_code, None
-
-    _calendar_cache[calendar_code] = calendar
-    return calendar_code, calendar
-
-def _get_calendar_schedule(exchange, start_date, end_date):
-    """
-        Returns schedule dataframe for [start_date, end_date] and calendar code.
-    """
-    calendar_code, calendar = _get_exchange_calendar(exchange)
-    
-    if calendar is None:
-        return pd.DataFrame(), calendar_code
+        return pd.DataFrame(), None
 
     try:
-        # schedule = calendar.schedule.loc[pd.Timestamp(start_date):pd.Timestamp(end_date)].copy()
-        schedule = calendar.schedule(pd.Timestamp(start_date), pd.Timestamp(end_date))
+        schedule = exchange_calendar_cache.get_schedule(calendar_code, start_date, end_date)
     except Exception as ex:
         print('%s: [red]Unable to fetch schedule for %s (%s): %s[/red]' % (datetime.now().strftime('%H:%M:%S'), exchange, calendar_code, str(ex)))
         return pd.DataFrame(), calendar_code
@@ -448,6 +424,11 @@ def _build_schedule_day_type_map(schedule):
     if schedule.empty:
         return {}
 
+    # cached schedules come classified
+    if 'day_type' in schedule.columns:
+        reduced = schedule.index[schedule['day_type'].to_numpy() == 'holiday_reduced_hours']
+        return dict.fromkeys(reduced.date, 'holiday_reduced_hours')
+
     open_col, close_col = _get_schedule_open_close_columns(schedule)
     if (open_col is None) or (close_col is None):
         return {}
@@ -473,36 +454,10 @@ def _build_schedule_day_type_map(schedule):
 
     regular_baseline_minutes = float(np.nanmedian(weekday_minutes.to_numpy()))
     short_ratio = float(getattr(config, 'exchange_calendar_short_session_ratio', 0.85))
-    day_type_map = {}
-
-    for row in session_df.itertuples(index=False):
-        if pd.isna(row.session_minutes):
-            continue
-
-        is_short = float(row.session_minutes) < (regular_baseline_minutes * short_ratio)
-        if not is_short:
-            continue
 
-        day_type_map[row.trade_date] = 'holiday_reduced_hours'
-    
-    return day_type_map
-
-def _time_to_minutes(value):
-    """
-        Converts HH:MM[:SS] or datetime-like value to minutes from midnight.
-    """
-    if pd.isna(value):
-        return None
-    value = str(value)
-    if ' ' in value:
-        value = value.split(' ')[-1]
-    parts = value.split(':')
-    if len(parts) < 2:
-        return None
-    try:
-        return (int(parts[0]) * 60) + int(parts[1])
-    except Exception:
-        return None
+    # NaN session lengths compare False and stay unclassified
+    is_short = (session_df['session_minutes'] < (regular_baseline_minutes * short_ratio)).to_numpy()
+    return dict.fromkeys(session_df['trade_date'].to_numpy()[is_short], 'holiday_reduced_hours')
 
 def _build_expected_trading_days(start_date, end_date, last_trade_date, exchange, country='US'):
     """
@@ -525,11 +480,8 @@ def _build_expected_trading_days(start_date, end_date, last_trade_date, exchange
         print('%s: [red]No schedule rows returned for exchange %s (%s). Failing closed.[/red]' % (datetime.now().strftime('%H:%M:%S'), exchange, calendar_code))
         return []
 
-    schedule_dates = pd.to_datetime(schedule.index).date
-    return [
-        pd.to_datetime(d).strftime('%Y-%m-%d') for d in schedule_dates
-        if d < last_trade_date
-    ]
+    schedule_dates = pd.DatetimeIndex(schedule.index)
+    return schedule_dates[schedule_dates < pd.Timestamp(last_trade_date)].strftime('%Y-%m-%d').tolist()
 
 def _is_intraday_interval(interval_value):
     """
@@ -555,21 +507,81 @@ def _extract_last_trade_date_from_tablename(tablename, fallback_date=None):
         return None
     return pd.to_datetime(fallback_date).date()
 
-def _get_intraday_daily_session_stats(conn, quoted_tablename):
+def _get_intraday_daily_session_stats(conn, tablename, start_date=None, end_date=None):
     """
         Returns daily intraday session stats needed for day-type classification.
+        Read from the materialized stats table (config.table_name_daily_session_stats) that saveHistoryToDB
+        keeps current, a few hundred rows per table instead of a GROUP BY over every bar.
+    """
+    return db.get_daily_session_stats(conn, tablename, start_date, end_date, tablename=config.table_name_daily_session_stats)
+
+# intraday day types; a session's type is the first that applies, in order of precedence:
+# last_trade_date, holiday_evening_only, the schedule's type (holiday_reduced_hours), friday, regular_weekday
+INTRADAY_DAY_TYPES = ['regular_weekday', 'friday', 'holiday_reduced_hours', 'holiday_evening_only', 'last_trade_date']
+
+# day type -> (allowed shortfall ratio, minimum allowed shortfall in bars), other types use the first
+_INTRADAY_TOLERANCE_BY_TYPE = {
+    'regular_weekday': (0.10, 2),
+    'friday': (0.15, 2),
+    'holiday_reduced_hours': (0.20, 2),
+    'holiday_evening_only': (0.25, 2),
+    'last_trade_date': (0.25, 2),
+}
+
+def _classify_intraday_days(daily_counts: pd.DataFrame, schedule_day_type_map, last_trade_date):
     """
-    return pd.read_sql(
-        'SELECT '
-        'DATE(date) AS trade_date, '
-        'COUNT(*) AS daily_count, '
-        'MIN(TIME(date)) AS first_bar_time, '
-        'MAX(TIME(date)) AS last_bar_time, '
-        'CAST((JULIANDAY(MAX(date)) - JULIANDAY(MIN(date))) * 24 * 60 AS INTEGER) AS session_span_minutes '
-        'FROM %s '
-        'GROUP BY DATE(date)' % quoted_tablename,
-        conn
+        Classifies the weekday sessions of daily_counts in one pass.
+        Returns (weekday row mask, session dates as datetime64[D], day type codes into categories, categories).
+    """
+    try:
+        # ISO date strings (stats table) and date objects convert directly
+        dates = daily_counts['trade_date'].to_numpy().astype('datetime64[D]')
+    except (TypeError, ValueError):
+        dates = pd.to_datetime(daily_counts['trade_date']).to_numpy().astype('datetime64[D]')
+    # 1970-01-01 was a thursday
+    weekday = (dates.astype(np.int64) + 3) % 7
+    is_weekday = weekday < 5
+    dates, weekday = dates[is_weekday], weekday[is_weekday]
+
+    categories = list(INTRADAY_DAY_TYPES)
+    scheduled = np.full(len(dates), -1, dtype=np.int64)
+    if schedule_day_type_map:
+        for day_type in dict.fromkeys(schedule_day_type_map.values()):
+            if day_type not in categories:
+                categories.append(day_type)
+        keys = np.array(list(schedule_day_type_map.keys()), dtype='datetime64[D]')
+        key_codes = np.array([categories.index(t) for t in schedule_day_type_map.values()], dtype=np.int64)
+        order = np.argsort(keys, kind='stable')
+        keys, key_codes = keys[order], key_codes[order]
+        position = np.searchsorted(keys, dates).clip(max=len(keys) - 1)
+        scheduled = np.where(keys[position] == dates, key_codes[position], -1)
+
+    if 'first_bar_time' in daily_counts.columns:
+        # HH:MM[:SS] (SQLite TIME()) or datetime-like, as minutes from midnight
+        first_times = pd.Series(daily_counts['first_bar_time'].to_numpy()[is_weekday], dtype='string').str.split(' ').str[-1].str.split(':')
+        first_minutes = (pd.to_numeric(first_times.str[0], errors='coerce') * 60 + pd.to_numeric(first_times.str[1], errors='coerce')).to_numpy(dtype=np.float64, na_value=np.nan)
+    else:
+        first_minutes = np.full(len(dates), np.nan)
+    # exchange_calendars defines regular-hours sessions only; infer evening-only
+    # from observed all-hours bars when a shortened RTH day starts in evening.
+    evening_open_minute = int(getattr(config, 'exchange_calendar_evening_open_minute_utc', 15 * 60))
+
+    if last_trade_date is not None:
+        is_last_trade_date = dates == np.datetime64(pd.Timestamp(last_trade_date).date(), 'D')
+    else:
+        is_last_trade_date = np.zeros(len(dates), dtype=bool)
+
+    codes = np.select(
+        [
+            is_last_trade_date,
+            (scheduled == categories.index('holiday_reduced_hours')) & (first_minutes >= evening_open_minute),
+            scheduled >= 0,
+            weekday == 4,
+        ],
+        [categories.index('last_trade_date'), categories.index('holiday_evening_only'), scheduled, categories.index('friday')],
+        default=categories.index('regular_weekday'),
     )
+    return is_weekday, dates, codes, categories
 
 def _build_intraday_day_type_counts(daily_counts: pd.DataFrame, schedule_day_type_map, last_trade_date):
     """
@@ -580,11 +592,9 @@ def _build_intraday_day_type_counts(daily_counts: pd.DataFrame, schedule_day_typ
     if daily_counts.empty:
         return pd.DataFrame(columns=['trade_date', 'daily_count', 'first_bar_time', 'last_bar_time', 'session_span_minutes', 'day_type'])
 
-    typed = daily_counts.copy()
-    typed['trade_date'] = pd.to_datetime(typed['trade_date']).dt.date
-    typed = typed.loc[pd.to_datetime(typed['trade_date']).dt.weekday < 5].copy()
-    if typed.empty:
-        return typed.assign(day_type=pd.Series(dtype='object'))
+    is_weekday, dates, codes, categories = _classify_intraday_days(daily_counts, schedule_day_type_map, last_trade_date)
+    typed = daily_counts.loc[is_weekday].copy()
+    typed['trade_date'] = dates.astype(object)
 
     if 'first_bar_time' not in typed.columns:
         typed['first_bar_time'] = None
@@ -593,71 +603,46 @@ def _build_intraday_day_type_counts(daily_counts: pd.DataFrame, schedule_day_typ
     if 'session_span_minutes' not in typed.columns:
         typed['session_span_minutes'] = np.nan
 
-    typed['day_type'] = 'regular_weekday'
-    typed.loc[pd.to_datetime(typed['trade_date']).dt.weekday == 4, 'day_type'] = 'friday'
-
-    typed['day_type'] = typed.apply(
-        lambda row: schedule_day_type_map.get(row['trade_date'], row['day_type']),
-        axis=1
-    )
-
-    # exchange_calendars defines regular-hours sessions only; infer evening-only
-    # from observed all-hours bars when a shortened RTH day starts in evening.
-    evening_open_minute = int(getattr(config, 'exchange_calendar_evening_open_minute_utc', 15 * 60))
-    first_minutes = typed['first_bar_time'].apply(_time_to_minutes)
-    evening_only_mask = (
-        (typed['day_type'] == 'holiday_reduced_hours')
-        & first_minutes.notnull()
-        & (first_minutes >= evening_open_minute)
-    )
-    typed.loc[evening_only_mask, 'day_type'] = 'holiday_evening_only'
-
-    if last_trade_date is not None:
-        typed.loc[typed['trade_date'] == last_trade_date, 'day_type'] = 'last_trade_date'
+    typed['day_type'] = pd.Categorical.from_codes(codes, categories=categories)
     return typed
 
-def _compute_intraday_expected_counts_by_day_type(typed_counts: pd.DataFrame, min_samples=3):
+def _round_count(value):
+    return int(round(float(value)))
+
+def _expected_counts_by_code(codes, counts, categories, min_samples=3):
     """
-        Builds robust expected bar-count baselines per day type.
+        Returns (expected bar count per category code, weekday baseline) from per-type p80 and median baselines
     """
-    if typed_counts.empty:
-        return {}, 0
-
-    def _p80(series):
-        if series.empty:
-            return 0
-        return int(round(float(np.percentile(series.to_numpy(), 80))))
+    num_groups = len(categories)
+    weekday_baseline = _round_count(np.percentile(counts, 80))
 
-    weekday_counts = typed_counts['daily_count']
-    weekday_baseline = _p80(weekday_counts)
+    sizes = np.bincount(codes, minlength=num_groups)
+    by_code = pd.Series(counts).groupby(codes)
+    p80 = by_code.quantile(0.8).reindex(range(num_groups)).to_numpy()
+    median = by_code.quantile(0.5).reindex(range(num_groups)).to_numpy()
 
-    holiday_counts_reduced = typed_counts.loc[
-        typed_counts['day_type'].isin(['holiday_reduced_hours']),
-        'daily_count'
-    ]
+    def _p80(day_type):
+        code = categories.index(day_type)
+        return _round_count(p80[code]) if sizes[code] > 0 else 0
 
-    holiday_counts_evenings = typed_counts.loc[
-        typed_counts['day_type'].isin(['holiday_evening_only']),
-        'daily_count'
-    ]
+    holiday_baseline_reduced = _p80('holiday_reduced_hours')
+    holiday_baseline_evening = _p80('holiday_evening_only')
 
-    holiday_baseline_reduced = _p80(holiday_counts_reduced) if not holiday_counts_reduced.empty else 0
-    holiday_baseline_evening = _p80(holiday_counts_evenings) if not holiday_counts_evenings.empty else 0
-
-    expected_by_type = {}
-    for day_type in ['regular_weekday', 'friday', 'holiday_reduced_hours', 'holiday_evening_only', 'last_trade_date']:
-        series = typed_counts.loc[typed_counts['day_type'] == day_type, 'daily_count']
+    # types outside INTRADAY_DAY_TYPES are measured against the weekday baseline
+    expected = np.full(num_groups, weekday_baseline, dtype=np.int64)
+    for day_type in INTRADAY_DAY_TYPES:
+        code = categories.index(day_type)
         if day_type == 'holiday_evening_only':
             sparse_fallback = holiday_baseline_evening if holiday_baseline_evening > 0 else int(round(weekday_baseline * 0.25))
         elif day_type == 'holiday_reduced_hours':
             sparse_fallback = holiday_baseline_reduced if holiday_baseline_reduced > 0 else int(round(weekday_baseline * 0.75))
         else:
             sparse_fallback = weekday_baseline
-        
-        if len(series) >= min_samples:
-            baseline = _p80(series)
-        elif len(series) > 0:
-            median_count = int(round(float(series.median())))
+
+        if sizes[code] >= min_samples:
+            baseline = _round_count(p80[code])
+        elif sizes[code] > 0:
+            median_count = _round_count(median[code])
             if sparse_fallback > 0:
                 baseline = max(median_count, int(round(sparse_fallback * 0.9)))
             else:
@@ -665,29 +650,34 @@ def _compute_intraday_expected_counts_by_day_type(typed_counts: pd.DataFrame, mi
         else:
             baseline = sparse_fallback
 
-        if baseline < 0:
-            baseline = 0
-        expected_by_type[day_type] = baseline
+        expected[code] = max(baseline, 0)
 
-    return expected_by_type, weekday_baseline
+    return expected, weekday_baseline
+
+def _compute_intraday_expected_counts_by_day_type(typed_counts: pd.DataFrame, min_samples=3):
+    """
+        Builds robust expected bar-count baselines per day type.
+    """
+    if typed_counts.empty:
+        return {}, 0
+
+    day_types = pd.Categorical(typed_counts['day_type'])
+    categories = list(dict.fromkeys(INTRADAY_DAY_TYPES + [str(t) for t in day_types.categories]))
+    codes = pd.Categorical(day_types.astype(str), categories=categories).codes.astype(np.int64)
+    counts = typed_counts['daily_count'].to_numpy(dtype=np.float64)
+
+    expected, weekday_baseline = _expected_counts_by_code(codes, counts, categories, min_samples)
+    return {day_type: int(expected[categories.index(day_type)]) for day_type in INTRADAY_DAY_TYPES}, weekday_baseline
 
 def _intraday_min_acceptable_count(expected_count, day_type):
     """
         Returns minimum acceptable bar count before a day is treated as incomplete.
     """
-    tolerance_by_type = {
-        'regular_weekday': (0.10, 2),
-        'friday': (0.15, 2),
-        'holiday_reduced_hours': (0.20, 2),
-        'holiday_evening_only': (0.25, 2),
-        'last_trade_date': (0.25, 2),
-    }
-
     expected_count = int(expected_count)
     if expected_count <= 0:
         return 0
 
-    tolerance_ratio, min_abs_tolerance = tolerance_by_type.get(day_type, (0.10, 2))
+    tolerance_ratio, min_abs_tolerance = _INTRADAY_TOLERANCE_BY_TYPE.get(day_type, (0.10, 2))
     allowed_shortfall = max(int(np.ceil(expected_count * tolerance_ratio)), min_abs_tolerance)
     return max(0, expected_count - allowed_shortfall)
 
@@ -695,149 +685,273 @@ def _get_incomplete_intraday_dates(daily_counts: pd.DataFrame, schedule_day_type
     """
         Returns dates with materially low intraday bar counts by day type.
     """
-    typed_counts = _build_intraday_day_type_counts(daily_counts, schedule_day_type_map, last_trade_date)
-    if typed_counts.empty:
+    if daily_counts.empty:
+        return []
+
+    is_weekday, dates, codes, categories = _classify_intraday_days(daily_counts, schedule_day_type_map, last_trade_date)
+    if len(dates) == 0:
         return []
-    
 
-    expected_by_type, weekday_baseline = _compute_intraday_expected_counts_by_day_type(typed_counts)
+    observed = pd.to_numeric(daily_counts['daily_count'], errors='coerce').to_numpy(dtype=np.float64)[is_weekday]
+    expected_by_code, weekday_baseline = _expected_counts_by_code(codes, observed, categories)
 
     if weekday_baseline <= 0:
         return []
 
-    incomplete_dates = []
-    for row in typed_counts.itertuples(index=False):
-        expected = int(expected_by_type.get(row.day_type, weekday_baseline) or weekday_baseline)
-        if expected <= 0:
-            continue
-        min_acceptable = _intraday_min_acceptable_count(expected, row.day_type)
-        observed_count = pd.to_numeric(row.daily_count, errors='coerce')
-        if pd.isna(observed_count):
-            continue
-        if int(observed_count) < min_acceptable:
-            incomplete_dates.append(row.trade_date)
+    is_incomplete = _is_incomplete_session(observed, codes, categories, expected_by_code, weekday_baseline)
+    return np.unique(dates[is_incomplete]).astype(object).tolist()
 
-    return sorted(set(incomplete_dates))
+def _is_incomplete_session(observed, codes, categories, expected_by_code, weekday_baseline):
+    """
+        Flags sessions whose bar count falls below the tolerance of their day type's expected count
+    """
+    expected = expected_by_code[codes]
+    expected = np.where(expected > 0, expected, weekday_baseline)
 
-def generate_pxhistory_metadata_master_table(conn):
+    tolerance = [_INTRADAY_TOLERANCE_BY_TYPE.get(day_type, (0.10, 2)) for day_type in categories]
+    tolerance_ratio = np.array([ratio for ratio, _ in tolerance])[codes]
+    min_abs_tolerance = np.array([bars for _, bars in tolerance], dtype=np.int64)[codes]
+    allowed_shortfall = np.maximum(np.ceil(expected * tolerance_ratio).astype(np.int64), min_abs_tolerance)
+    min_acceptable = np.maximum(0, expected - allowed_shortfall)
+
+    return ~np.isnan(observed) & (np.trunc(observed) < min_acceptable)
+
+_BAR_SIZE_UNITS = {'sec': 's', 'min': 'min', 'hour': 'h', 'day': 'D'}
+_DAY_NS = 86400 * 10**9
+
+def _interval_to_ns(interval):
     """
-        Generates a master table of tablename, # of unique gap counts, and datetime recorded
-        Includes dates missing between current data and expiry date
+        Returns the bar size of an interval in ns e.g. 5mins -> 300e9, None when it cannot be parsed
     """
-    lookupTable = db.getLookup_symbolRecords(conn)
+    match = re.fullmatch(r'(\d+)\s*([a-z]+?)s?', str(interval).strip().lower())
+    if (match is None) or (match.group(2) not in _BAR_SIZE_UNITS):
+        return None
+    return int(pd.Timedelta(int(match.group(1)), unit=_BAR_SIZE_UNITS[match.group(2)]).value)
 
-    print('%s: [yellow]Generating pxhistory_metadata master table...[/yellow]'%(datetime.now().strftime('%H:%M:%S')))
+def _get_bar_times(conn, tablename, start=None, end=None):
+    """
+        Returns the stored bar timestamps of a table in [start, end) as sorted int64 ns (naive wall clock)
+    """
+    sql = 'SELECT date FROM %s' % _quote_sqlite_identifier(tablename)
+    params = []
+    if (start is not None) and (end is not None):
+        sql += ' WHERE date >= ? AND date < ?'
+        params = [pd.Timestamp(start).strftime('%Y-%m-%d %H:%M:%S'), pd.Timestamp(end).strftime('%Y-%m-%d %H:%M:%S')]
+    dates = pd.to_datetime(pd.read_sql(sql, conn, params=params)['date'], format='ISO8601', errors='coerce')
+    return np.unique(pd.DatetimeIndex(dates.dropna()).as_unit('ns').asi8)
 
-    futures_pxhistory_metadata_table = db.getTable(conn, config.table_name_futures_pxhistory_metadata)
-    metadata_rows = []
-    now_ts = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+def _get_expected_bar_times(calendar_code, start_date, end_date, step_ns):
+    """
+        Returns the session grid of bar start times as (int64 ns in config.pxhistory_timezone wall clock, session dates)
+    """
+    grid, sessions = exchange_calendar_cache.bar_grid(calendar_code, start_date, end_date, step_ns)
+    grid = pd.DatetimeIndex(pd.to_datetime(grid, utc=True)).tz_convert(config.pxhistory_timezone).tz_localize(None).as_unit('ns').asi8
+    return grid, sessions
 
-    conn.execute('DROP TABLE IF EXISTS temp_expected_trading_days')
-    conn.execute('CREATE TEMP TABLE temp_expected_trading_days (trade_date TEXT PRIMARY KEY)')
+def _get_traded_slots(grid, sessions, is_present, step_ns):
+    """
+        Returns the time-of-day slots (grid % day // step) that hold a bar on at least
+        config.bar_gap_min_slot_coverage of the sessions with any bars, as a boolean array per slot.
+        Slots the calendar opens but the contract does not trade (daily halts, dead overnight hours) drop out.
+    """
+    num_slots = -(-_DAY_NS // step_ns)
+    slots = (grid % _DAY_NS) // step_ns
+    has_bars = np.isin(sessions, np.unique(sessions[is_present]))
+    expected = np.bincount(slots[has_bars], minlength=num_slots)
+    observed = np.bincount(slots[is_present], minlength=num_slots)
+    return observed >= np.maximum(expected * config.bar_gap_min_slot_coverage, 1)
 
-    for row in lookupTable.itertuples(index=False):
-        print('%s: [yellow]Scanning gaps for %s...[/yellow]'%(datetime.now().strftime('%H:%M:%S'), row.name))
-        tablename = row.name
+def _find_missing_bar_runs(grid, sessions, bar_times, step_ns, traded_slots=None):
+    """
+        Anti-joins the expected bar grid with the stored bar times.
+        Returns (run start ns, run end ns, session date) arrays of the runs of at least
+        config.bar_gap_min_missing_bars consecutive missing bars, and the traded slots used.
+    """
+    position = np.searchsorted(bar_times, grid).clip(max=max(len(bar_times) - 1, 0))
+    is_present = (bar_times[position] == grid) if len(bar_times) else np.zeros(len(grid), dtype=bool)
+    if traded_slots is None:
+        traded_slots = _get_traded_slots(grid, sessions, is_present, step_ns)
 
-        # if lastTradeDate is empty, infer it from table name by scanning for YYYYMMDD token
-        inferred_last_trade_date = row.lastTradeDate
-        if pd.isna(inferred_last_trade_date):
-            inferred_date = _extract_last_trade_date_from_tablename(row.name)
-            if inferred_date is None:
-                print('%s: [red]Error inferring lastTradeDate for %s, skipping...[/red]'%(datetime.now().strftime('%H:%M:%S'), tablename))
-                continue
-            inferred_last_trade_date = inferred_date.strftime('%Y-%m-%d')
+    missing = np.flatnonzero(~is_present & traded_slots[(grid % _DAY_NS) // step_ns])
+    if missing.size == 0:
+        empty = np.array([], dtype=np.int64)
+        return empty, empty, np.array([], dtype='datetime64[D]'), traded_slots
 
-        quoted_tablename = _quote_sqlite_identifier(tablename)
-        try:
-            bounds = conn.execute(
-                'SELECT MIN(DATE(date)) AS min_date, MAX(DATE(date)) AS max_date FROM %s' % quoted_tablename
-            ).fetchone()
-        except Exception:
-            print('%s: [red]Error fetching data for %s, skipping...[/red]'%(datetime.now().strftime('%H:%M:%S'), tablename))
-            continue
+    # a run ends at a skipped grid point, a break or a session boundary
+    run_start = np.ones(len(missing), dtype=bool)
+    run_start[1:] = (
+        (np.diff(missing) != 1)
+        | (np.diff(grid[missing]) != step_ns)
+        | (sessions[missing][1:] != sessions[missing][:-1])
+    )
+    first = np.flatnonzero(run_start)
+    last = np.append(first[1:], len(missing)) - 1
+    keep = (last - first + 1) >= config.bar_gap_min_missing_bars
+    first, last = missing[first[keep]], missing[last[keep]]
+    return grid[first], grid[last] + step_ns, sessions[first], traded_slots
 
-        if (bounds is None) or (bounds[0] is None):
-            continue
+def _get_bar_grid_within(calendar_code, first_ns, last_ns, step_ns):
+    """
+        Returns the session grid clipped to the bars from first_ns to last_ns (inclusive)
+    """
+    # evening bars belong to the next day's session
+    grid, sessions = _get_expected_bar_times(calendar_code, pd.Timestamp(first_ns).date(), pd.Timestamp(last_ns).date() + pd.Timedelta(days=1), step_ns)
+    within = (grid >= first_ns) & (grid <= last_ns)
+    return grid[within], sessions[within]
 
-        min_date = pd.to_datetime(bounds[0]).date()
-        max_date = pd.to_datetime(bounds[1]).date() if bounds[1] is not None else min_date
-        last_trade_date = pd.to_datetime(inferred_last_trade_date).date()
-        end_date = max(max_date, last_trade_date)
+def _runs_by_session(starts, ends, sessions):
+    """
+        Groups missing bar runs by session date: {ISO date: [(start, end)]} as pd.Timestamps (naive wall clock)
+    """
+    runs = {}
+    for start, end, session in zip(starts, ends, sessions.astype(str)):
+        runs.setdefault(session, []).append((pd.Timestamp(start), pd.Timestamp(end)))
+    return runs
 
-        try:
-            exchange = _get_exchange_for_symbol(row.symbol)
-        except Exception:
-            print('%s: [red]Error resolving exchange for %s, skipping...[/red]'%(datetime.now().strftime('%H:%M:%S'), tablename))
-            continue
+def _scan_table_gap_metadata(conn, row, now_ts):
+    """
+        Scans one pxhistory table for its gap metadata row, None when the table cannot be scanned.
+        row: lookup table record with name, symbol, interval and lastTradeDate
 
-        schedule, calendar_code = _get_calendar_schedule(exchange, min_date, end_date)
-        if schedule.empty:
-            print('%s: [red]No calendar schedule for %s (%s), skipping table %s[/red]' % (datetime.now().strftime('%H:%M:%S'), exchange, calendar_code, tablename))
-            continue
+        Only reads the session stats the caller materialized beforehand, so it runs on the workers'
+        read-only connections; a table without stats (no bars) is skipped.
+    """
+    print('%s: [yellow]Scanning gaps for %s...[/yellow]'%(datetime.now().strftime('%H:%M:%S'), row['name']))
+    tablename = row['name']
 
-        expected_days = _build_expected_trading_days(min_date, end_date, last_trade_date, exchange=exchange)
-        conn.execute('DELETE FROM temp_expected_trading_days')
-        if expected_days:
-            conn.executemany(
-                'INSERT INTO temp_expected_trading_days(trade_date) VALUES (?)',
-                [(d,) for d in expected_days]
-            )
-
-        num_unique_gaps_row = conn.execute(
-            'SELECT COUNT(DISTINCT daily_count) FROM '
-            '(SELECT COUNT(*) AS daily_count FROM %s GROUP BY DATE(date))' % quoted_tablename
-        ).fetchone()
-        num_unique_gaps = int(num_unique_gaps_row[0]) if num_unique_gaps_row and num_unique_gaps_row[0] is not None else 0
-
-        last_missing_row = conn.execute(
-            'SELECT MAX(e.trade_date) '
-            'FROM temp_expected_trading_days e '
-            'LEFT JOIN (SELECT DISTINCT DATE(date) AS trade_date FROM %s) a '
-            'ON a.trade_date = e.trade_date '
-            'WHERE a.trade_date IS NULL' % quoted_tablename
-        ).fetchone()
-        last_missing_date = pd.to_datetime(last_missing_row[0]) if last_missing_row and last_missing_row[0] else pd.NaT
-
-        # For intraday tables, treat materially undersized sessions as gaps using day-type-aware thresholds.
-        last_incomplete_intraday_date = pd.NaT
-        if _is_intraday_interval(row.interval):
-            daily_counts = _get_intraday_daily_session_stats(conn, quoted_tablename)
-            schedule_day_type_map = _build_schedule_day_type_map(schedule)
-            incomplete_intraday_dates = _get_incomplete_intraday_dates(
-                daily_counts=daily_counts,
-                schedule_day_type_map=schedule_day_type_map,
-                last_trade_date=last_trade_date
-            )
-            if incomplete_intraday_dates:
-                last_incomplete_intraday_date = pd.to_datetime(max(incomplete_intraday_dates))
-
-        if pd.isna(last_missing_date):
-            last_gap_date = last_incomplete_intraday_date
-        elif pd.isna(last_incomplete_intraday_date):
-            last_gap_date = last_missing_date
-        else:
-            last_gap_date = max(last_missing_date, last_incomplete_intraday_date)
+    # if lastTradeDate is empty, infer it from table name by scanning for YYYYMMDD token
+    inferred_last_trade_date = row['lastTradeDate']
+    if pd.isna(inferred_last_trade_date):
+        inferred_date = _extract_last_trade_date_from_tablename(row['name'])
+        if inferred_date is None:
+            print('%s: [red]Error inferring lastTradeDate for %s, skipping...[/red]'%(datetime.now().strftime('%H:%M:%S'), tablename))
+            return None
+        inferred_last_trade_date = inferred_date.strftime('%Y-%m-%d')
+
+    try:
+        daily_counts = db.read_daily_session_stats(conn, tablename, tablename=config.table_name_daily_session_stats)
+    except Exception:
+        print('%s: [red]Error fetching data for %s, skipping...[/red]'%(datetime.now().strftime('%H:%M:%S'), tablename))
+        return None
+
+    if daily_counts.empty:
+        return None
 
-        latest_observed_date = pd.to_datetime(max_date)
+    min_date = pd.to_datetime(daily_counts['trade_date'].iloc[0]).date()
+    max_date = pd.to_datetime(daily_counts['trade_date'].iloc[-1]).date()
+    last_trade_date = pd.to_datetime(inferred_last_trade_date).date()
+    end_date = max(max_date, last_trade_date)
 
-        if pd.isna(last_gap_date):
-            date_of_last_gap = latest_observed_date
-        else:
-            date_of_last_gap = max(last_gap_date, latest_observed_date)
+    try:
+        exchange = _get_exchange_for_symbol(row['symbol'])
+    except Exception:
+        print('%s: [red]Error resolving exchange for %s, skipping...[/red]'%(datetime.now().strftime('%H:%M:%S'), tablename))
+        return None
+
+    schedule, calendar_code = _get_calendar_schedule(exchange, min_date, end_date)
+    if schedule.empty:
+        print('%s: [red]No calendar schedule for %s (%s), skipping table %s[/red]' % (datetime.now().strftime('%H:%M:%S'), exchange, calendar_code, tablename))
+        return None
+
+    expected_days = _build_expected_trading_days(min_date, end_date, last_trade_date, exchange=exchange)
+    num_unique_gaps = int(daily_counts['daily_count'].nunique())
+
+    missing_days = set(expected_days).difference(daily_counts['trade_date'])
+    last_missing_date = pd.to_datetime(max(missing_days)) if missing_days else pd.NaT
+
+    # For intraday tables, treat materially undersized sessions as gaps using day-type-aware thresholds.
+    last_incomplete_intraday_date = pd.NaT
+    if _is_intraday_interval(row['interval']):
+        schedule_day_type_map = _build_schedule_day_type_map(schedule)
+        incomplete_intraday_dates = _get_incomplete_intraday_dates(
+            daily_counts=daily_counts,
+            schedule_day_type_map=schedule_day_type_map,
+            last_trade_date=last_trade_date
+        )
+        if incomplete_intraday_dates:
+            last_incomplete_intraday_date = pd.to_datetime(max(incomplete_intraday_dates))
+
+    if pd.isna(last_missing_date):
+        last_gap_date = last_incomplete_intraday_date
+    elif pd.isna(last_incomplete_intraday_date):
+        last_gap_date = last_missing_date
+    else:
+        last_gap_date = max(last_missing_date, last_incomplete_intraday_date)
+
+    latest_observed_date = pd.to_datetime(max_date)
+
+    if pd.isna(last_gap_date):
+        date_of_last_gap = latest_observed_date
+    else:
+        date_of_last_gap = max(last_gap_date, latest_observed_date)
+
+    return {
+        'tablename': tablename,
+        'num_unique_gaps': num_unique_gaps,
+        'update_date': now_ts,
+        'date_of_last_gap_date_polled': date_of_last_gap,
+    }
+
+def _init_gap_scan_worker(db_path):
+    global _gap_scan_conn
+    _gap_scan_conn = sqlite3.connect('file:%s?mode=ro' % pathname2url(db_path), uri=True)
+
+def _scan_table_gap_metadata_task(row, now_ts):
+    """
+        Gap scan of one table in a worker process, on the worker's read-only connection
+    """
+    return _scan_table_gap_metadata(_gap_scan_conn, row, now_ts)
+
+def _get_db_path(conn):
+    """
+        Returns the file behind a connection, None for in-memory dbs
+    """
+    for _, name, path in conn.execute('PRAGMA database_list'):
+        if name == 'main':
+            return path or None
+    return None
 
-        metadata_rows.append({
-            'tablename': tablename,
-            'num_unique_gaps': num_unique_gaps,
-            'update_date': now_ts,
-            'date_of_last_gap_date_polled': date_of_last_gap,
-        })
+def generate_pxhistory_metadata_master_table(conn, names=None):
+    """
+        Generates a master table of tablename, # of unique gap counts, and datetime recorded
+        Includes dates missing between current data and expiry date
+        names: tables to scan, every table in the lookup table when None
+
+        Tables are scanned independently in a process pool (config.gap_scan_workers), each worker
+        on its own read-only connection; the rows are merged here and written once by the caller.
+    """
+    lookupTable = db.getLookup_symbolRecords(conn)
+    if names is not None:
+        lookupTable = lookupTable.loc[lookupTable['name'].isin(names)]
+
+    print('%s: [yellow]Generating pxhistory_metadata master table...[/yellow]'%(datetime.now().strftime('%H:%M:%S')))
+
+    futures_pxhistory_metadata_table = db.get_pxhistory_gap_metadata(conn, config.table_name_futures_pxhistory_metadata)
+    now_ts = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    rows = lookupTable[['name', 'symbol', 'interval', 'lastTradeDate']].to_dict('records')
+
+    # workers only read: session stats missing for any table are computed up front, and the
+    # calendar session tables are loaded before the workers fork
+    db.materialize_daily_session_stats(conn, [row['name'] for row in rows], config.table_name_daily_session_stats)
+    conn.commit()
+    for symbol in {row['symbol'] for row in rows}:
+        if symbol in config.exchange_mapping:
+            _get_calendar_schedule(config.exchange_mapping[symbol], datetime.today(), datetime.today())
+
+    db_path = _get_db_path(conn)
+    num_workers = min(config.gap_scan_workers or os.cpu_count() or 1, len(rows))
+    if db_path is None or num_workers <= 1:
+        results = [_scan_table_gap_metadata(conn, row, now_ts) for row in rows]
+    else:
+        print('%s: [yellow]Scanning %s tables with %s processes[/yellow]'%(datetime.now().strftime('%H:%M:%S'), len(rows), num_workers))
+        with ProcessPoolExecutor(max_workers=num_workers, initializer=_init_gap_scan_worker, initargs=(db_path,)) as pool:
+            results = list(pool.map(_scan_table_gap_metadata_task, rows, repeat(now_ts), chunksize=max(1, len(rows) // (num_workers * 4))))
+    metadata_rows = [result for result in results if result is not None]
 
     futures_pxhistory_metadata_current_db_snapshot = pd.DataFrame(
         metadata_rows,
         columns=['tablename', 'num_unique_gaps', 'update_date', 'date_of_last_gap_date_polled']
     )
-    conn.execute('DROP TABLE IF EXISTS temp_expected_trading_days')
     
     # create master dataframe of tablename, gap, datetime recorded 
     futures_pxhistory_metadata_current_db_snapshot['update_date'] = now_ts
@@ -848,9 +962,11 @@ def generate_pxhistory_metadata_master_table(conn):
     if futures_pxhistory_metadata_table.empty: # init metadata table with db snapshot 
         updated = futures_pxhistory_metadata_current_db_snapshot
     else:
-        updated = pd.merge(futures_pxhistory_metadata_current_db_snapshot, futures_pxhistory_metadata_table, on='tablename', how='inner', suffixes=('', '_metadata'))
-        # in updated, set date_of_last_gap_date_polled to metadata if it is not None 
-        updated.loc[updated['date_of_last_gap_date_polled_metadata'].notnull(), 'date_of_last_gap_date_polled'] = updated['date_of_last_gap_date_polled_metadata']
+        updated = pd.merge(futures_pxhistory_metadata_current_db_snapshot, futures_pxhistory_metadata_table[['tablename', 'date_of_last_gap_date_polled']], on='tablename', how='left', suffixes=('', '_metadata'))
+        # keep a gap poll in progress; tables whose gaps were all attempted restart from the new scan
+        polled = pd.to_datetime(updated['date_of_last_gap_date_polled_metadata'], errors='coerce')
+        in_progress = polled.notnull() & (polled != _noGapsDate)
+        updated.loc[in_progress, 'date_of_last_gap_date_polled'] = polled[in_progress]
         # drop _metadata columns
         updated.drop([col for col in updated.columns if '_metadata' in col], axis=1, inplace=True)
     
@@ -859,104 +975,298 @@ def generate_pxhistory_metadata_master_table(conn):
 def update_gaps_in_pxhistory_metadata(conn):
     """
         updates pxhistory_metadata table from db records 
-    """
-    if check_gaps_in_pxhistory_metadata_up_to_date(conn):
+        Only tables whose data version (db.get_daily_session_stats_versions) changed since their last
+        scan are rescanned, their rows are upserted by tablename.
+    """
+    names = db.getLookup_symbolRecords(conn)['name'].tolist()
+    # tables without stored session stats get them now so they have a version
+    db.materialize_daily_session_stats(conn, names, config.table_name_daily_session_stats)
+    versions = db.get_daily_session_stats_versions(conn, config.table_name_daily_session_stats)
+    metadata = db.get_pxhistory_gap_metadata(conn, config.table_name_futures_pxhistory_metadata)
+    scanned_versions = dict(zip(metadata['tablename'], metadata['data_version']))
+
+    changed = [name for name in names if (versions.get(name) is not None) and (versions[name] != scanned_versions.get(name))]
+    if not changed:
+        print('%s: [green]pxhistory_metadata is up to date![/green]'%(datetime.now().strftime('%H:%M:%S')))
         return
-    else: 
-        record_unique_datetime_count = generate_pxhistory_metadata_master_table(conn)
-        db.save_table_to_db(conn = conn, tablename=config.table_name_futures_pxhistory_metadata, metadata_df = record_unique_datetime_count, if_exists='replace')
+    print('%s: [yellow]%s of %s tables changed since their last gap scan[/yellow]'%(datetime.now().strftime('%H:%M:%S'), len(changed), len(names)))
+
+    record_unique_datetime_count = generate_pxhistory_metadata_master_table(conn, names=changed)
+    record_unique_datetime_count['data_version'] = record_unique_datetime_count['tablename'].map(versions)
+    db.upsert_pxhistory_gap_metadata(conn, record_unique_datetime_count, config.table_name_futures_pxhistory_metadata)
 
 def find_next_gap_date_in_table(conn, tablename, interval, exchange, start_after_date=None, country='US'):
     """
         Returns the newest candidate gap date (pd.Timestamp) in a table that is
+        strictly earlier than start_after_date (resume cursor), pd.NaT when there is none.
+        See find_gap_dates_in_table for the gap definitions.
+    """
+    gap_dates = find_gap_dates_in_table(conn, tablename, interval, exchange, start_after_date=start_after_date, country=country)
+    if not gap_dates:
+        return pd.NaT
+    return gap_dates[0]
+
+def find_gap_dates_in_table(conn, tablename, interval, exchange, start_after_date=None, country='US'):
+    """
+        Returns every candidate gap date (pd.Timestamp, newest first) in a table that is
         strictly earlier than start_after_date (resume cursor).
+        See TableGaps for the gap definitions. Returns [] when no gap is found.
+    """
+    return TableGaps(conn, tablename, interval, exchange, country=country).before(start_after_date)
+
+class TableGaps:
+    """
+        Gap dates of one table, computed once and kept current while they are filled
+        usage:
+            gaps = TableGaps(conn, tablename, interval, exchange)
+            gaps.before(cursor)                   gap dates below the cursor, newest first
+            gaps.day_gaps_before(cursor)          missing / incomplete session dates below the cursor
+            gaps.bar_ranges_before(cursor)        missing bar runs of the other sessions below the cursor
+            gaps.refresh(start_date, end_date)    after a fill, re-tests only the days it touched
 
-        If start_after_date is None, search starts from the newest candidate.
+        If the cursor is None, every gap is returned.
         Gap definitions:
         1) Missing expected trading session from exchange_calendars schedule
         2) Incomplete intraday session based on schedule-aware day-type baseline and tolerance
            - day types include regular weekdays, Fridays, holiday_reduced_hours,
              holiday_evening_only, and last_trade_date
+        3) Intraday session with a run of missing bars against the session grid, dated by the session it
+           belongs to; the runs themselves are kept so they can be requested as they are (bar_ranges_before)
+
+        The day-type baselines are measured when the set is built and refreshed days are tested
+        against them, so a fill costs a read of the days it covered instead of a rescan of the table.
+    """
+    def __init__(self, conn, tablename, interval, exchange, country='US'):
+        self.conn = conn
+        self.tablename = tablename
+        self.missing = set()
+        self.incomplete = set()
+        self.missing_bars = {}
+        self._expected_days = set()
+        self._schedule_day_type_map = {}
+        self._last_trade_date = None
+        self._baseline = None
+        self._bar_grid = None
+        self._build(interval, exchange, country)
+
+    def _build(self, interval, exchange, country):
+        try:
+            daily_counts = _get_intraday_daily_session_stats(self.conn, self.tablename)
+        except Exception:
+            return
 
-        Returns pd.NaT when no gap is found.
-    """
-    quoted_tablename = _quote_sqlite_identifier(tablename)
-
-    try:
-        bounds = conn.execute(
-            'SELECT MIN(DATE(date)) AS min_date, MAX(DATE(date)) AS max_date FROM %s' % quoted_tablename
-        ).fetchone()
-    except Exception:
-        return pd.NaT
-
-    if (bounds is None) or (bounds[0] is None):
-        return pd.NaT
-
-    min_date = pd.to_datetime(bounds[0]).date()
-    max_date = pd.to_datetime(bounds[1]).date()
-
-    if (start_after_date is None) or pd.isna(start_after_date):
-        cursor_date = max_date + pd.to_timedelta(1, unit='D')
-    else:
-        cursor_date = pd.to_datetime(start_after_date).date()
-
-    last_trade_date = _extract_last_trade_date_from_tablename(tablename, fallback_date=max_date)
-    if last_trade_date is None:
-        return pd.NaT
-
-    # get exchange calendar schedule for the date range in the table
-    schedule, calendar_code = _get_calendar_schedule(exchange=exchange, start_date=min_date, end_date=max_date)
-    if schedule.empty:
-        print('%s: [red]No calendar schedule for %s (%s), failing closed for %s[/red]' % (datetime.now().strftime('%H:%M:%S'), exchange, calendar_code, tablename))
-        return pd.NaT
-
-    # build schedule day type map for classifying intraday sessions later when checking for incomplete sessions
-    schedule_day_type_map = _build_schedule_day_type_map(schedule)
-    
-    expected_days = _build_expected_trading_days(min_date, max_date, last_trade_date, exchange=exchange, country=country)
-    if not expected_days:
-        return pd.NaT
+        if daily_counts.empty:
+            return
 
-    daily_counts = _get_intraday_daily_session_stats(conn, quoted_tablename)
-    if daily_counts.empty:
-        return pd.NaT
+        min_date = pd.to_datetime(daily_counts['trade_date'].iloc[0]).date()
+        max_date = pd.to_datetime(daily_counts['trade_date'].iloc[-1]).date()
 
-    daily_counts['trade_date'] = pd.to_datetime(daily_counts['trade_date']).dt.date
-    actual_dates = set(daily_counts['trade_date'].astype(str).tolist())
+        self._last_trade_date = _extract_last_trade_date_from_tablename(self.tablename, fallback_date=max_date)
+        if self._last_trade_date is None:
+            return
 
-    # Missing expected trading days
-    missing_dates = [
-        pd.to_datetime(d).date()
-        for d in expected_days
-        if d not in actual_dates
-    ]
+        # get exchange calendar schedule for the date range in the table
+        schedule, calendar_code = _get_calendar_schedule(exchange=exchange, start_date=min_date, end_date=max_date)
+        if schedule.empty:
+            print('%s: [red]No calendar schedule for %s (%s), failing closed for %s[/red]' % (datetime.now().strftime('%H:%M:%S'), exchange, calendar_code, self.tablename))
+            return
+
+        # build schedule day type map for classifying intraday sessions later when checking for incomplete sessions
+        self._schedule_day_type_map = _build_schedule_day_type_map(schedule)
+
+        expected_days = _build_expected_trading_days(min_date, max_date, self._last_trade_date, exchange=exchange, country=country)
+        if not expected_days:
+            return
+
+        # dates are kept as ISO strings, the stats table's format
+        self._expected_days = set(expected_days)
+        self.missing = self._expected_days.difference(daily_counts['trade_date'])
+
+        if not _is_intraday_interval(interval):
+            return
+        self._build_missing_bars(calendar_code, interval)
+
+        # Incomplete intraday weekdays by day type with tolerance.
+        is_weekday, dates, codes, categories = _classify_intraday_days(daily_counts, self._schedule_day_type_map, self._last_trade_date)
+        if len(dates) == 0:
+            return
+        observed = pd.to_numeric(daily_counts['daily_count'], errors='coerce').to_numpy(dtype=np.float64)[is_weekday]
+        expected_by_code, weekday_baseline = _expected_counts_by_code(codes, observed, categories)
+        if weekday_baseline <= 0:
+            return
+        self._baseline = (categories, expected_by_code, weekday_baseline)
+        self.incomplete = set(dates[_is_incomplete_session(observed, codes, *self._baseline)].astype(str))
+
+    def _build_missing_bars(self, calendar_code, interval):
+        step_ns = _interval_to_ns(interval)
+        if step_ns is None:
+            return
+        bar_times = _get_bar_times(self.conn, self.tablename)
+        if len(bar_times) == 0:
+            return
+        grid, sessions = _get_bar_grid_within(calendar_code, bar_times[0], bar_times[-1], step_ns)
+        starts, ends, run_sessions, traded_slots = _find_missing_bar_runs(grid, sessions, bar_times, step_ns)
+        # the traded slots stay as measured here, like the day-type baselines
+        self._bar_grid = (calendar_code, step_ns, bar_times[0], bar_times[-1], traded_slots)
+        self.missing_bars = _runs_by_session(starts, ends, run_sessions)
+
+    def _refresh_missing_bars(self, start_date, end_date):
+        calendar_code, step_ns, first_ns, last_ns, traded_slots = self._bar_grid
+        grid, sessions = _get_expected_bar_times(calendar_code, start_date, end_date, step_ns)
+        within = (grid >= first_ns) & (grid <= last_ns)
+        grid, sessions = grid[within], sessions[within]
+        if len(grid) == 0:
+            return
+        bar_times = _get_bar_times(self.conn, self.tablename, pd.Timestamp(grid[0]), pd.Timestamp(grid[-1] + step_ns))
+        starts, ends, run_sessions, _ = _find_missing_bar_runs(grid, sessions, bar_times, step_ns, traded_slots)
+        for session in np.unique(sessions).astype(str):
+            self.missing_bars.pop(session, None)
+        self.missing_bars.update(_runs_by_session(starts, ends, run_sessions))
+
+    def refresh(self, start_date, end_date):
+        """
+            Re-reads the session stats of the days from start_date to end_date (inclusive) and updates their gaps
+        """
+        if not self._expected_days:
+            return
+        if self._bar_grid is not None:
+            self._refresh_missing_bars(start_date, end_date)
+        refreshed = _get_intraday_daily_session_stats(self.conn, self.tablename, start_date, end_date)
+        if refreshed.empty:
+            return
+
+        self.missing.difference_update(refreshed['trade_date'])
+        if self._baseline is None:
+            return
+        self.incomplete.difference_update(refreshed['trade_date'])
+        is_weekday, dates, codes, _ = _classify_intraday_days(refreshed, self._schedule_day_type_map, self._last_trade_date)
+        if len(dates) == 0:
+            return
+        observed = pd.to_numeric(refreshed['daily_count'], errors='coerce').to_numpy(dtype=np.float64)[is_weekday]
+        self.incomplete.update(dates[_is_incomplete_session(observed, codes, *self._baseline)].astype(str))
+
+    @staticmethod
+    def _dates_before(dates, start_after_date):
+        gap_dates = sorted(dates, reverse=True)
+        if (start_after_date is not None) and not pd.isna(start_after_date):
+            cursor = pd.to_datetime(start_after_date).strftime('%Y-%m-%d')
+            gap_dates = [d for d in gap_dates if d < cursor]
+        return [pd.to_datetime(d) for d in gap_dates]
+
+    def before(self, start_after_date=None):
+        """
+            Returns the gap dates (pd.Timestamp) strictly earlier than start_after_date, newest first
+        """
+        return self._dates_before(self.missing | self.incomplete | self.missing_bars.keys(), start_after_date)
+
+    def day_gaps_before(self, start_after_date=None):
+        """
+            Returns the missing and incomplete session dates strictly earlier than start_after_date, newest first
+        """
+        return self._dates_before(self.missing | self.incomplete, start_after_date)
+
+    def bar_ranges_before(self, start_after_date=None):
+        """
+            Returns {session date (pd.Timestamp): [(start, end)]} of the missing bar runs in sessions strictly
+            earlier than start_after_date; sessions that are whole-day gaps are left to day_gaps_before
+        """
+        day_gaps = self.missing | self.incomplete
+        sessions = self._dates_before(self.missing_bars.keys() - day_gaps, start_after_date)
+        return {session: self.missing_bars[session.strftime('%Y-%m-%d')] for session in sessions}
+
+    def __iter__(self):
+        return iter(self.before())
+
+    def __len__(self):
+        return len(self.missing | self.incomplete | self.missing_bars.keys())
+
+def fill_gaps_in_table(conn, ib, contract, tablename, interval, exchange, start_after_date=None, earliestTimestamp=None, useRTH=False, on_request=None):
+    """
+        Fills every gap in a table below the resume cursor with the fewest requests.
+        Gap dates are coalesced by the request planner; dates still missing after
+        config.gap_fill_max_attempts passes are left out. on_request(oldest_date_covered)
+        is called after each request so callers can persist their cursor.
+        earliestTimestamp may be a callable, it is only called when there are gaps to fill.
+        ---
+        Returns the number of IBKR requests made
+    """
+    gaps = TableGaps(conn, tablename, interval, exchange)
+    gap_dates = gaps.before(start_after_date)
+    if not gap_dates:
+        return 0
 
-    # Incomplete intraday weekdays by day type with tolerance.
-    incomplete_intraday_dates = []
-    if _is_intraday_interval(interval):
-        incomplete_intraday_dates = _get_incomplete_intraday_dates(
-            daily_counts=daily_counts,
-            schedule_day_type_map=schedule_day_type_map,
-            last_trade_date=last_trade_date
+    unfilled = db.get_unfilled_gaps(conn, tablename, config.table_name_unfilled_gaps)
+    exhausted = {d for d, attempts in unfilled.items() if attempts >= config.gap_fill_max_attempts}
+    if exhausted:
+        print('%s: [yellow]Skipping %s gap dates in %s that stayed unfilled after %s attempts[/yellow]' % (datetime.now().strftime('%H:%M:%S'), len(exhausted & set(gap_dates)), tablename, config.gap_fill_max_attempts))
+    gap_dates = [d for d in gap_dates if d not in exhausted]
+    if not gap_dates:
+        return 0
+    if callable(earliestTimestamp):
+        earliestTimestamp = earliestTimestamp()
+
+    symbol, expiry, _ = tablename.split('_')
+    # missing / incomplete days are requested whole, runs of missing bars only for their own span
+    requests = planner.plan_gap_requests(
+        _addspace(interval),
+        [d for d in gaps.day_gaps_before(start_after_date) if d not in exhausted],
+        contract_start=earliestTimestamp,
+        contract_end=expiry,
+        exchange=exchange)
+    bar_ranges = {d: runs for d, runs in gaps.bar_ranges_before(start_after_date).items() if d not in exhausted}
+    range_requests = planner.plan_range_requests(
+        _addspace(interval),
+        [run for runs in bar_ranges.values() for run in runs],
+        contract_start=earliestTimestamp,
+        contract_end=expiry,
+        exchange=exchange)
+    for request in range_requests:
+        request['gap_dates'] = [d for d, runs in bar_ranges.items() if any(start < request['end'] and end > request['start'] for start, end in runs)]
+    # newest first, so the cursor passed to on_request only moves back
+    requests = sorted(requests + range_requests, key=lambda request: request['end'], reverse=True)
+    print('%s: [yellow]Filling %s gap dates in %s with %s requests[/yellow]' % (datetime.now().strftime('%H:%M:%S'), len(gap_dates), tablename, len(requests)))
+
+    call_count = 0
+    for request in requests:
+        bars = ibkr.getBars_futures(
+            ib,
+            contract,
+            interval=_addspace(interval),
+            endDate=request['endDate'],
+            lookback=request['lookback'],
+            useRTH=useRTH,
+            # IBKR answers some gap windows with no data (unrecorded sessions), that must not block the forward fill
+            breaker_scope='gap_fill',
         )
-    # print(incomplete_intraday_dates)
-    # exit() 
-
-    # print(missing_dates)
-    # print('\n')
-    gap_dates = sorted(set(missing_dates + incomplete_intraday_dates))
-    next_gaps = [d for d in gap_dates if d < cursor_date]
-    if not next_gaps:
-        return pd.NaT
-    return pd.to_datetime(next_gaps[-1])
-
-def update_gaps_in_pxhistory(conn, ib, ibkr_lookback_period = '5 D'): 
+        call_count += 1
+
+        if bars is not None and not bars.empty:
+            # bars from the session that runs past the end of the window belong to the next request
+            bars = bars.loc[bars['date'] < request['end']].sort_values('date').reset_index(drop=True)
+        if bars is not None and not bars.empty:
+            bars['symbol'] = symbol
+            bars['interval'] = interval.replace(' ', '')
+            bars['lastTradeDate'] = expiry
+            db.saveHistoryToDB(bars, conn, earliestTimestamp=earliestTimestamp, type='future')
+            # a run in a session's evening belongs to the next trade date, refresh through the dates filled
+            filled_dates = request['gap_dates'] or [request['start']]
+            gaps.refresh(min(request['start'], min(filled_dates)), max(request['end'], max(filled_dates)))
+
+        if on_request is not None:
+            on_request(min(request['gap_dates']) if request['gap_dates'] else request['start'])
+
+    # the refreshed gap set tells which of the attempted dates are still missing
+    remaining = gaps.before(start_after_date)
+    db.record_gap_fill_attempt(conn, tablename, gap_dates, remaining, config.table_name_unfilled_gaps)
+    return call_count
+
+def update_gaps_in_pxhistory(conn, ib): 
     """
         updates gaps in pxhistory, usees the pxhistory_metadata table to determine which tables need to be updated. 
     """
-    DEFAULT_DATE_IF_NO_GAPS = pd.to_datetime('1989-12-30')
+    DEFAULT_DATE_IF_NO_GAPS = _noGapsDate
     # get table metadata, and filter out tables that no longer have gaps 
-    pxhistory_metadata = db.getTable(conn, config.table_name_futures_pxhistory_metadata)
+    pxhistory_metadata = db.get_pxhistory_gap_metadata(conn, config.table_name_futures_pxhistory_metadata)
     pxhistory_metadata = pxhistory_metadata.loc[pxhistory_metadata['date_of_last_gap_date_polled'] != "1989-12-30 00:00:00"].reset_index(drop=True)
 
     # select where tablename contains VIX
@@ -983,60 +1293,37 @@ def update_gaps_in_pxhistory(conn, ib, ibkr_lookback_period = '5 D'):
             update_metadata(pxhistory_metadata, tablename, DEFAULT_DATE_IF_NO_GAPS, num_unique_gaps=0)
             continue
 
-        # Determine next candidate gap date strictly before the saved cursor.
-        date_with_missing_data = find_next_gap_date_in_table(
+        # only looked up once a gap is found
+        if expiry > datetime.today().strftime('%Y%m%d'):
+            earliestTimestamp = lambda symbol=symbol, expiry=expiry, exchange=exchange: ibkr.getEarliestTimeStamp_m(ib, symbol=symbol, lastTradeDate=expiry, exchange=exchange)
+        else:
+            earliestTimestamp = pd.to_datetime((datetime.today() - relativedelta(years=2)).strftime('%Y-%m-%d'))
+
+        # fill every gap below the saved cursor, nearby gap dates share a request
+        num_requests = fill_gaps_in_table(
             conn,
+            ib,
+            contract,
             tablename,
             interval,
             exchange,
-            start_after_date=row['date_of_last_gap_date_polled']
+            start_after_date=row['date_of_last_gap_date_polled'],
+            earliestTimestamp=earliestTimestamp,
+            on_request=lambda oldest_date, tablename=tablename: update_metadata(pxhistory_metadata, tablename, oldest_date),
         )
-        
-        # if return is pd.NatT, that means there are no more gaps to update. Update metadata to reflect this and continue
-        if pd.isna(date_with_missing_data):
-            update_metadata(pxhistory_metadata, tablename, DEFAULT_DATE_IF_NO_GAPS, num_unique_gaps=0)
-            continue
-
-        # get gap data from ibkr 
-        print('%s: [yellow]Updating gap history for %s, gap date: %s...[/yellow]'%(datetime.now().strftime('%H:%M:%S'), tablename, date_with_missing_data.strftime('%Y-%m-%d')))     
-        
 
-        # ibkr_pxhistory = ibkr.getBars_futures(ib, symbol=symbol, lastTradeDate=expiry, interval=_addspace(interval), endDate=date_with_missing_data + pd.to_timedelta(1, unit='D'), lookback=ibkr_lookback_period, exchange=exchange)
-        ibkr_pxhistory = ibkr.getBars_futures(ib, contract, interval=_addspace(interval), endDate=date_with_missing_data + pd.to_timedelta(1, unit='D'), lookback=ibkr_lookback_period)
-        # print(ibkr_pxhistory)
-        # exit() 
-        if ibkr_pxhistory is None:
-            print('%s: [green]No records found for %s, with endDate: %s [/green]'%(datetime.now().strftime('%H:%M:%S'), tablename, date_with_missing_data.strftime('%Y-%m-%d')))
-            # advance cursor even when no records are returned so resume continues backwards
-            update_metadata(pxhistory_metadata, tablename, date_with_missing_data)
-            continue        
-        ibkr_pxhistory['symbol'] = symbol
-        ibkr_pxhistory['interval'] = interval
-        ibkr_pxhistory['lastTradeDate'] = expiry                 
-
-        # save history to db 
-        if expiry > datetime.today().strftime('%Y%m%d'):
-            earliestTimestamp = ibkr.getEarliestTimeStamp_m(ib, symbol=symbol, lastTradeDate=expiry, exchange=exchange)
-        else:
-            earliestTimestamp = pd.to_datetime((datetime.today() - relativedelta(years=2)).strftime('%Y-%m-%d'))
-        db.saveHistoryToDB(ibkr_pxhistory, conn, earliestTimestamp=earliestTimestamp, type='future')
-        print('%s: [green]Record %s of %s updated for %s, sleeping for %ss...[/green]'%(datetime.now().strftime('%H:%M:%S'),idx+1,len(pxhistory_metadata), tablename, _defaultSleepTime/30))
-
-        # Update metadata cursor to the candidate date that was just scanned.
-        update_metadata(pxhistory_metadata, tablename, date_with_missing_data)
-
-        # sleep before next record 
-        time.sleep(_defaultSleepTime/30)
-        print('%s: [yellow]Sleeping for %ss[/yellow]\n'%(datetime.now().strftime('%H:%M:%S'), _defaultSleepTime/30))
-        
+        # all gaps were attempted, the ones that stay missing are tracked in the unfilled gaps table
+        update_metadata(pxhistory_metadata, tablename, DEFAULT_DATE_IF_NO_GAPS, num_unique_gaps=0)
+        if num_requests == 0:
+            continue
+        print('%s: [green]Record %s of %s updated for %s with %s requests[/green]'%(datetime.now().strftime('%H:%M:%S'),idx+1,len(pxhistory_metadata), tablename, num_requests))
 
     print('%s: [green]DONE! Completed updating gaps in pxhistory_metadata, cleaning up metadata[/green]\n'%(datetime.now().strftime('%H:%M:%S')))
     # make sure updatde_date and date_og_last_gap_date_polled are datetime 
     pxhistory_metadata['update_date'] = pd.to_datetime(pxhistory_metadata['update_date'])
     pxhistory_metadata['date_of_last_gap_date_polled'] = pd.to_datetime(pxhistory_metadata['date_of_last_gap_date_polled'])
 
-    db.save_table_to_db(conn = conn, tablename=config.table_name_futures_pxhistory_metadata, metadata_df = pxhistory_metadata)
-    db.remove_duplicates_from_pxhistory_gaps_metadata(conn, config.table_name_futures_pxhistory_metadata)
+    db.upsert_pxhistory_gap_metadata(conn, pxhistory_metadata, config.table_name_futures_pxhistory_metadata)
 
 def update_metadata(pxhistory_metadata: pd.DataFrame, tablename: str, date: pd.Timestamp, num_unique_gaps=None) -> None:
     """
@@ -1184,40 +1471,32 @@ def _updatePreHistory(lookupTable: pd.DataFrame, ib: 'IBKRConnection'):
         print('%s: [yellow]Record [/yellow]%s of %s: %s-%s-%s'%(datetime.now().strftime("%H:%M:%S"),index, len(lookupTable), record.symbol, record['lastTradeDate'], record['interval']))
         
         # set end date 
-        endDate = (record['firstRecordDate'] + relativedelta(days=1)).strftime('%Y%m%d %H:%M:%S')
+        endDate = record['firstRecordDate'] + relativedelta(days=1)
         
         # earleist possible timestamp is limited by api at 2 years 
         earliestAvailableTimestamp = (datetime.today() - relativedelta(years=2))#.strftime('%Y%m%d %H:%M:%S')
     
-        # set lookback
-        if lookback >= (record['firstRecordDate'] - earliestAvailableTimestamp).days:
-            lookback = (record['firstRecordDate'] - earliestAvailableTimestamp).days
-        elif record['interval'] in ['1 day', '1 month']:
-            lookback = 100
-        elif record['interval'] in ['1 min']:
-            lookback = 5
-        else:
-            lookback = 30
+        # plan requests between the earliest available date and the first record we hold
+        requests = planner.plan_requests(
+            record['interval'],
+            [(earliestAvailableTimestamp, endDate)],
+            contract_end=record['lastTradeDate'],
+            exchange=exchange)
 
         history = pd.DataFrame()
-        if lookback <= 0:
+        if not requests:
             print(' [green]No data left [/green]for %s %s %s!'%(record['symbol'], record['lastTradeDate'], record['interval']))
             with db.sqlite_connection(dbName_futures) as conn:
                 earliestAvailableTimestamp = db._getFirstRecordDate(record, conn)
                 db._update_symbol_metadata(conn, record['name'], earliestTimestamp=earliestAvailableTimestamp, numMissingDays=0, type='future')
             continue
         else: 
-            if record['interval'] in ['1 min', '5 mins']: # Make multiple calls for ltf data
-                for i in range(5): 
-                    currentIterationBars = ibkr.getBars_futures(ib, contract, interval=record['interval'], endDate=endDate, lookback=(str(lookback) + ' D'))
-                    if (currentIterationBars is None): 
-                        break
-                    else: 
-                        history = pd.concat([history, currentIterationBars], ignore_index=True)
-                        endDate = history['date'].min()
-                        
-            else:
-                history = ibkr.getBars_futures(ib, contract, interval=record['interval'], endDate=endDate, lookback=(str(lookback) + ' D'))
+            # cap calls per record so one contract cannot starve the rest of the pass
+            for request in requests[:_maxPreHistoryRequestsPerRecord]: 
+                currentIterationBars = ibkr.getBars_futures(ib, contract, interval=record['interval'], endDate=request['endDate'], lookback=request['lookback'])
+                if (currentIterationBars is None) or (currentIterationBars.empty): 
+                    break
+                history = pd.concat([history, currentIterationBars], ignore_index=True)
         
         # skip to next if no data is returned
         if history is None or history.empty:
@@ -1338,28 +1617,33 @@ def check_futures_data_integrity():
     active_contracts = latestData.loc[latestData['type/expiry'] > datetime.today().strftime('%Y%m%d')]
     active_contracts = active_contracts.loc[active_contracts['interval'] == '1 day']
 
-    for index, record in active_contracts.iterrows():
-        with db.sqlite_connection(dbName_futures) as conn:
-            data = db.getTable(conn, record['name'])
-        missingDates = cdi._check_for_missing_dates_in_timeseries(data)
+    with db.sqlite_connection(dbName_futures) as conn:
+        data = {name: db.getTable(conn, name) for name in active_contracts['name']}
+    # one session calendar for every table
+    missingDatesByTable = cdi.check_missing_dates_in_tables(data)
 
+    for name, missingDates in missingDatesByTable.items():
         if not missingDates.empty:
-            print('[yellow]Warning: Missing dates found in %s[/yellow]'%(record['name']))
+            print('[yellow]Warning: Missing dates found in %s[/yellow]'%(name))
             print('\n')
 
 if __name__ == '__main__':
     ib = ibkr.setupConnection()
     updateRecords(ib)       
     for i in range(15):
-        with db.sqlite_connection(dbName_futures) as conn:
-            lookupTable = db.getLookup_symbolRecords(conn)
-        _updatePreHistory(lookupTable, ib)
+        try:
+            with db.sqlite_connection(dbName_futures) as conn:
+                lookupTable = db.getLookup_symbolRecords(conn)
+            _updatePreHistory(lookupTable, ib)
 
-        with db.sqlite_connection(dbName_futures) as conn:
-            # generate_pxhistory_metadata_master_table(conn)
-            update_gaps_in_pxhistory_metadata(conn)
-            update_gaps_in_pxhistory(conn, ib)
-        # Refresh ib connection 
-        if i%3 == 0:
-            ib = ibkr.refreshConnection(ib)
+            with db.sqlite_connection(dbName_futures) as conn:
+                # generate_pxhistory_metadata_master_table(conn)
+                update_gaps_in_pxhistory_metadata(conn)
+                update_gaps_in_pxhistory(conn, ib)
+            # Refresh ib connection 
+            if i%3 == 0:
+                ib = ibkr.refreshConnection(ib)
+        except ibkr.IbkrDisconnectedError as e:
+            # lookup and gap metadata are saved as we go, the next pass picks up where this one stopped
+            print('%s: [red]IBKR unavailable (%s), resuming on next pass[/red]'%(datetime.now().strftime('%H:%M:%S'), e))
     
\ No newline at end of file
@@ -6,7 +6,7 @@ Key behavior:
 2) Fetches history forward in time (oldest to newest).
 3) Processes one contract at a time within each interval pass.
 4) Persists progress in 00-progress_tracker so reruns resume without repeating API calls.
-5) Verifies/fills contract gaps before moving to the next contract.
+5) Verifies/fills contract gaps before moving to the next contract, nearby gaps share a request.
 """
 
 import time
@@ -20,13 +20,14 @@ from rich import print
 import config
 import interface_ibkr as ibkr
 import interface_localDB as db
+import ibkr_cassette
+import ibkr_request_planner as planner
 
 from maintainHistoricalData_futures import (
     _getWatchlist,
     _get_exchange_for_symbol,
-    _setLookback,
     _addspace,
-    find_next_gap_date_in_table,
+    fill_gaps_in_table,
 )
 
 DB_NAME_FUTURES = config.dbname_futures
@@ -69,7 +70,7 @@ def _build_contract(symbol, expiry, currency='USD'):
 
 
 def _get_target_end_date(expiry):
-    now = pd.Timestamp.now().floor('s')
+    now = ibkr_cassette.now().floor('s')
     expiry_dt = _parse_expiry_to_datetime(expiry)
     if pd.isna(expiry_dt):
         return now
@@ -78,11 +79,6 @@ def _get_target_end_date(expiry):
     return now
 
 
-def _lookback_days(interval):
-    lookback = _setLookback(interval)
-    return int(str(lookback).split()[0])
-
-
 def _list_contracts_for_symbol(ib, symbol, lookahead_months=LOOKAHEAD_MONTHS):
     exchange = _get_exchange_for_symbol(symbol)
     details = ibkr.getContractDetails(ib, symbol, type='future', exchange=exchange)
@@ -303,20 +299,23 @@ def _forward_fetch_contract(conn, ib, row):
     if pd.isna(cursor):
         cursor = earliest_ts
 
-    chunk_days = _lookback_days(interval)
+    requests = planner.plan_requests(
+        interval,
+        [(cursor, target_end_date)],
+        contract_start=earliest_ts,
+        contract_end=expiry,
+        exchange=_get_exchange_for_symbol(symbol),
+        newest_first=False,
+    )
     call_count = 0
 
-    while cursor < target_end_date:
-        next_end = min(cursor + pd.Timedelta(days=chunk_days), target_end_date)
-        if next_end <= cursor:
-            break
-
+    for request in requests:
         bars = ibkr.getBars_futures(
             ib,
             contract,
             interval=interval,
-            endDate=next_end,
-            lookback='%s D' % chunk_days,
+            endDate=request['endDate'],
+            lookback=request['lookback'],
             useRTH = True if interval in ['1 day'] else False,
         )
         call_count += 1
@@ -338,13 +337,12 @@ def _forward_fetch_contract(conn, ib, row):
             tablename,
             {
                 'status': 'forward_fetch_in_progress',
-                'last_fetched_end_date': next_end,
+                'last_fetched_end_date': request['end'],
                 'updated_at': pd.Timestamp.now().floor('s'),
             },
             PROGRESS_TABLE,
         )
 
-        cursor = next_end
         time.sleep(DEFAULT_SLEEP_SECONDS)
 
     db.update_progress_tracker_fields(
@@ -369,64 +367,36 @@ def _verify_and_fill_gaps(conn, ib, row, date_of_last_gap_date_polled):
     contract = _build_contract(symbol, expiry)
 
     call_count = 0
-    while True:
-        gap_date = find_next_gap_date_in_table(
+    if date_of_last_gap_date_polled != DEFAULT_DATE_IF_NO_GAPS:
+        earliest_ts = pd.to_datetime(row['earliest_timestamp'], errors='coerce')
+        if pd.isna(earliest_ts):
+            earliest_ts = lambda: pd.to_datetime(ibkr.getEarliestTimeStamp(ib, contract), errors='coerce')
+
+        # all gaps below the cursor in as few requests as the planner allows; the cursor
+        # follows each request so an interrupted pass resumes where it stopped
+        call_count = fill_gaps_in_table(
             conn,
+            ib,
+            contract,
             tablename,
             interval.replace(' ', ''),
             exchange,
             start_after_date=date_of_last_gap_date_polled,
+            earliestTimestamp=earliest_ts,
+            useRTH=True if interval in ['1 day'] else False,
+            on_request=lambda oldest_date: db.update_gap_metadata(conn, tablename, oldest_date),
         )
 
-        if (pd.isna(gap_date) or 
-            date_of_last_gap_date_polled == DEFAULT_DATE_IF_NO_GAPS or 
-            (date_of_last_gap_date_polled is not None and date_of_last_gap_date_polled <= gap_date)
-        ):
-            db.update_progress_tracker_fields(
-                conn,
-                tablename,
-                {
-                    'status': 'complete',
-                    'updated_at': pd.Timestamp.now().floor('s'),
-                },
-                PROGRESS_TABLE,
-            )
-            return call_count
-
-        bars = ibkr.getBars_futures(
-            ib,
-            contract,
-            interval=_addspace(interval.replace(' ', '')),
-            endDate=pd.to_datetime(gap_date) + pd.to_timedelta(1, unit='D'),
-            lookback='5 D',
-            useRTH = True if interval in ['1 day'] else False,
-        )
-        call_count += 1
-
-        if bars is not None and not bars.empty:
-            bars = bars.sort_values('date').reset_index(drop=True)
-            if len(bars) > 1:
-                bars = bars.iloc[:-1, :]
-            if not bars.empty:
-                earliest_ts = pd.to_datetime(row['earliest_timestamp'], errors='coerce')
-                if pd.isna(earliest_ts):
-                    earliest_ts = pd.to_datetime(ibkr.getEarliestTimeStamp(ib, contract), errors='coerce')
-
-                bars['symbol'] = symbol
-                bars['interval'] = interval.replace(' ', '')
-                bars['lastTradeDate'] = expiry
-                db.saveHistoryToDB(bars, conn, earliestTimestamp=earliest_ts, type='future')
-
-                ### update last gap date polled 
-                date_of_last_gap_date_polled = bars['date'].min()
-                db.update_gap_metadata(conn, tablename, date_of_last_gap_date_polled)
-        else:
-            # If we fail to retrieve bars, we should still update the last polled gap date to avoid infinite loops on unresolvable gaps.
-            date_of_last_gap_date_polled = gap_date - pd.to_timedelta(4, unit='D')
-            db.update_gap_metadata(conn, tablename, date_of_last_gap_date_polled)
-                
-
-        # time.sleep(DEFAULT_SLEEP_SECONDS)
+    db.update_progress_tracker_fields(
+        conn,
+        tablename,
+        {
+            'status': 'complete',
+            'updated_at': pd.Timestamp.now().floor('s'),
+        },
+        PROGRESS_TABLE,
+    )
+    return call_count
 
 
 def main():
@@ -459,12 +429,19 @@ def main():
         # for interval in ['1 min']:
             print('%s: [yellow]Starting interval pass: %s[/yellow]' % (datetime.now().strftime('%H:%M:%S'), interval))
             
+            resume_tablename = None
+            consecutive_outages = 0
             while True:
                 queue = _get_work_queue(conn, interval)
+                # an item interrupted by an IBKR outage goes first, ahead of the recently-updated filter
+                resumed = queue.loc[queue['tablename'] == resume_tablename].reset_index(drop=True)
+                resume_tablename = None
                 
                 # remove rows updated within the last 5 mins to avoid potential race conditions
                 five_mins_ago = pd.Timestamp.now() - pd.Timedelta(minutes=5)
                 queue = queue.loc[queue['updated_at'] < five_mins_ago].reset_index(drop=True)
+                if not resumed.empty:
+                    queue = resumed
 
                 # print(queue)
                 # exit() 
@@ -483,29 +460,49 @@ def main():
                 )
 
 
-                ################## FORWARD FETCH
-                if row['status'] in ['not_started', 'forward_fetch_in_progress', 'active']:
-                    print('%s: [yellow]============================== Starting forward fetch for %s %s %s ==============================[/yellow]' % (datetime.now().strftime('%H:%M:%S'), row['symbol'], row['expiry'], row['interval']))
-                    api_calls_since_refresh += _forward_fetch_contract(conn, ib, row)
+                try:
+                    ################## FORWARD FETCH
+                    if row['status'] in ['not_started', 'forward_fetch_in_progress', 'active']:
+                        print('%s: [yellow]============================== Starting forward fetch for %s %s %s ==============================[/yellow]' % (datetime.now().strftime('%H:%M:%S'), row['symbol'], row['expiry'], row['interval']))
+                        api_calls_since_refresh += _forward_fetch_contract(conn, ib, row)
 
-                refreshed_row = _get_work_queue(conn, interval)
-                if not refreshed_row.empty:
-                    refreshed_row = refreshed_row.loc[
-                        refreshed_row['tablename'] == row['tablename']
-                    ]
+                    refreshed_row = _get_work_queue(conn, interval)
+                    if not refreshed_row.empty:
+                        refreshed_row = refreshed_row.loc[
+                            refreshed_row['tablename'] == row['tablename']
+                        ]
                 
 
-                ################## GAP FILL 
-                if not refreshed_row.empty and refreshed_row.iloc[0]['status'] == 'gap_fill_in_progress':
-                    print('%s: [yellow]============================== Starting gap fill for %s %s %s ==============================[/yellow]' % (datetime.now().strftime('%H:%M:%S'), refreshed_row.iloc[0]['symbol'], refreshed_row.iloc[0]['expiry'], refreshed_row.iloc[0]['interval']))
-
-
-                    date_of_last_gap_date_polled = gap_metadata.loc[
-                        (gap_metadata['tablename'] == refreshed_row.iloc[0]['tablename'])]['date_of_last_gap_date_polled'].iloc[0] if not gap_metadata.loc[
-                        (gap_metadata['tablename'] == refreshed_row.iloc[0]['tablename'])]['date_of_last_gap_date_polled'].empty else None
-
-
-                    api_calls_since_refresh += _verify_and_fill_gaps(conn, ib, refreshed_row.iloc[0], date_of_last_gap_date_polled)
+                    ################## GAP FILL 
+                    if not refreshed_row.empty and refreshed_row.iloc[0]['status'] == 'gap_fill_in_progress':
+                        print('%s: [yellow]============================== Starting gap fill for %s %s %s ==============================[/yellow]' % (datetime.now().strftime('%H:%M:%S'), refreshed_row.iloc[0]['symbol'], refreshed_row.iloc[0]['expiry'], refreshed_row.iloc[0]['interval']))
+
+
+                        date_of_last_gap_date_polled = gap_metadata.loc[
+                            (gap_metadata['tablename'] == refreshed_row.iloc[0]['tablename'])]['date_of_last_gap_date_polled'].iloc[0] if not gap_metadata.loc[
+                            (gap_metadata['tablename'] == refreshed_row.iloc[0]['tablename'])]['date_of_last_gap_date_polled'].empty else None
+
+
+                        api_calls_since_refresh += _verify_and_fill_gaps(conn, ib, refreshed_row.iloc[0], date_of_last_gap_date_polled)
+                except ibkr.IbkrDisconnectedError as e:
+                    # progress is saved per request, so the item resumes from its last fetched window
+                    # an outage only costs its own length: back off and retry rather than ending the run
+                    consecutive_outages += 1
+                    delay = min(config.ibkr_reconnect_backoff_seconds * 2 ** (consecutive_outages - 1), config.ibkr_reconnect_backoff_max_seconds)
+                    if consecutive_outages < config.ibkr_breaker_thresholds['transient']:
+                        resume_tablename = row['tablename']
+                        print('%s: [red]IBKR unavailable (%s), resuming %s in %ss[/red]' % (datetime.now().strftime('%H:%M:%S'), e, row['tablename'], delay))
+                    else:
+                        # keeps failing once the session is back: stop putting it first so the rest of the queue runs
+                        print('%s: [red]IBKR unavailable (%s), %s goes back in the queue, retrying in %ss[/red]' % (datetime.now().strftime('%H:%M:%S'), e, row['tablename'], delay))
+                    time.sleep(delay)
+                    try:
+                        # drop the old socket first, a second session on its client id would be refused (326)
+                        ib = ibkr.refreshConnection(ib)
+                    except ibkr.IbkrDisconnectedError:
+                        pass
+                    continue
+                consecutive_outages = 0
 
                 max_calls = int(getattr(config, 'ibkr_max_consecutive_calls', 50))
                 if api_calls_since_refresh >= max_calls:
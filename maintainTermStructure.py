@@ -1,30 +1,40 @@
 """
     This module maintains term structure data for various futures contracts.
     Data is sourced from the local database with no connections required to the broker api.  
+
+    Updates are incremental: a term structure table is extended with the contract bars from its last
+    stored date on, and only rebuilt from every bar of its contracts when the contracts it is built from
+    (config.table_name_termstructure_metadata) change.
+        python maintainTermStructure.py             incremental update of every tracked symbol
+        python maintainTermStructure.py rebuild     rebuild every tracked symbol
 """
 import config 
 import calendar
 import traceback 
 
 import datetime as dt
+import numpy as np
 import pandas as pd
 import interface_localDB as db 
 import checkDataIntegrity as cdi
 from rich import print
 from sys import argv
-from dateutil.relativedelta import relativedelta
+from functools import lru_cache
 from pandas.tseries.offsets import BDay
 
 dbpath_termstructure = config.dbname_termstructure
 dbpath_futures = config.dbname_futures
 trackedIntervals = config.intervals
 
+@lru_cache(maxsize=None)
+def _get_holidays(exchange, year):
+    return frozenset(cdi._get_holidays_for_exchange(exchange=exchange, years=year))
+
 def _check_if_date_is_holiday(date, exchange='NYSE'):
     """
         Check if a given date is a holiday for a given country and exchange
     """
-    holidays = cdi._get_holidays_for_exchange(exchange=exchange, years=date.year)
-    return date in holidays
+    return date in _get_holidays(exchange, date.year)
 
 def _get_expiry_date_for_month(symbol, date): 
     date = date.date()
@@ -59,6 +69,50 @@ def _get_expiry_date_for_month(symbol, date):
 
     return expiry
 
+@lru_cache(maxsize=None)
+def _get_contract_month_expiry(symbol, year, month):
+    """
+        Memoized expiry of a symbol's contract month
+    """
+    return _get_expiry_date_for_month(symbol, pd.Timestamp(year, month, 1))
+
+def get_contract_month_expiries(symbol, first_month, num_months):
+    """
+        Returns the expiries of num_months consecutive contract months as datetime64[D],
+        months counted as year * 12 + month - 1 from first_month
+    """
+    symbol = symbol.upper()
+    return np.array([
+        _get_contract_month_expiry(symbol, month // 12, month % 12 + 1)
+        for month in range(first_month, first_month + num_months)
+    ], dtype='datetime64[D]')
+
+def roll_expiries(dates, expiries, roll_bdays=0):
+    """
+        Roll-aware contract selection for any consumer holding a (date x month) grid of expiries.
+        dates: n dates, expiries: n x m expiries of the 1st..mth contract month of each date (datetime64)
+        Returns a copy of expiries where month k moves to month k+1 on and after its roll date
+        (roll_bdays business days before expiry), or after its expiry when roll_bdays is 0.
+        The last month is never rolled.
+    """
+    dates = np.asarray(dates, dtype='datetime64[ns]')
+    expiries = np.asarray(expiries, dtype='datetime64[ns]')
+    rolled = expiries.copy()
+    if expiries.ndim != 2 or expiries.shape[1] < 2:
+        return rolled
+
+    current, following = expiries[:, :-1], expiries[:, 1:]
+    roll_bdays = max(int(roll_bdays), 0)
+    if roll_bdays > 0:
+        # BDay semantics: weekend expiries roll forward to monday before stepping back, the time of day is kept
+        expiry_days = current.astype('datetime64[D]')
+        roll_dates = np.busday_offset(expiry_days, -roll_bdays, roll='forward').astype('datetime64[ns]') + (current - expiry_days)
+        rolls = dates[:, None] >= roll_dates
+    else:
+        rolls = dates[:, None] > current
+    rolled[:, :-1] = np.where(rolls, following, current)
+    return rolled
+
 def _adjust_expiry_date_for_roll_days(expiry_table, roll_bdays=0):
     """
         Adjusts the expiry date for each contract in the expiry_table for roll days. 
@@ -75,21 +129,12 @@ def _adjust_expiry_date_for_roll_days(expiry_table, roll_bdays=0):
         print('ERROR: No month columns found in expiry table.', traceback.format_exc())
         exit() 
     
-    roll_bdays = max(int(roll_bdays), 0)
-    for i in range(len(month_columns)-1):
-        current_col = month_columns[i]
-        next_col = month_columns[i+1]
-        if roll_bdays > 0:
-            roll_dates = expiry_table[current_col] - BDay(roll_bdays)
-            expiry_table[current_col] = expiry_table.apply(
-                lambda x: x[next_col] if x['date'] >= roll_dates.loc[x.name] else x[current_col],
-                axis=1
-            )
-        else:
-            expiry_table[current_col] = expiry_table.apply(
-                lambda x: x[next_col] if x['date'] > x[current_col] else x[current_col],
-                axis=1
-            )
+    # every month column is shifted at once, each against the original next column
+    rolled = roll_expiries(expiry_table['date'].to_numpy(), expiry_table[month_columns].to_numpy(), roll_bdays=roll_bdays)
+    for i, col in enumerate(month_columns[:-1]):
+        # rolled columns take the finer unit of the date and expiry columns
+        dtype = np.promote_types(expiry_table['date'].dtype, expiry_table[col].dtype)
+        expiry_table[col] = pd.Series(rolled[:, i], index=expiry_table.index).astype(dtype)
     
     return expiry_table
 
@@ -100,10 +145,13 @@ def _generate_futures_contract_expiry_table(symbol, start_date, end_date, num_mo
     
     expiry_table = pd.DataFrame({'date': date_range})
 
-    # create expiry table for each month ahead 
+    # each expiry is computed once per contract month, month i of a date is its calendar month + i
+    months = (date_range.year * 12 + date_range.month - 1).to_numpy()
+    first_month = int(months.min()) if len(months) else 0
+    num_months = int(months.max()) - first_month + num_months_ahead if len(months) else 0
+    expiries = get_contract_month_expiries(symbol, first_month, num_months)
     for i in range(0, num_months_ahead):
-        expiry_table['month%s'%(i+1)] = expiry_table['date'].apply(lambda x: x + relativedelta(months=i))
-        expiry_table['month%s'%(i+1)] = expiry_table['month%s'%(i+1)].apply(lambda x: _get_expiry_date_for_month(symbol, x))
+        expiry_table['month%s'%(i+1)] = expiries[months - first_month + i]
 
     roll_bdays = config.futures_symbol_metadata.get(symbol.upper(), {}).get('roll_bdays', 0)
     return _adjust_expiry_date_for_roll_days(expiry_table, roll_bdays=roll_bdays)
@@ -118,14 +166,8 @@ def _get_available_term_structure_data(symbol, interval, expiry_table):
     records = records.loc[records['symbol'] == symbol]
     records['lastTradeDate'] = pd.to_datetime(records['lastTradeDate'])
     
-    # find what data we have available locally for the given expiry table 
-    available_data = expiry_table.copy()
-    for col in available_data.columns:
-        if col != 'date':
-            available_data[col] = available_data[col].apply(lambda x: x in records['lastTradeDate'].values)
-
     # remove any dates where TS cannot be determined across the entire curve 
-    available_data = available_data.loc[available_data['month1'] == True]
+    available_data = expiry_table.loc[expiry_table['month1'].isin(records['lastTradeDate'])]
     first_index = available_data.index[0]
     expiry_table = expiry_table.iloc[first_index:]
     
@@ -137,14 +179,11 @@ def _averageContractVolume(conn, tablename):
             - Used to determine which contract is most liquid for a given month, 
             and therefore worth tracking data for 
     """
-    # get data from tablename 
-    sql = "SELECT * FROM %s"%(tablename)
-    df = pd.read_sql(sql, conn)
-    
-    # calculate average volume 
-    averageVolume = df['volume'].mean()
+    # let sqlite average the volume instead of reading the whole table
+    sql = "SELECT AVG(volume) FROM %s"%(tablename)
+    (averageVolume,) = conn.execute(sql).fetchone()
     
-    return averageVolume
+    return np.nan if averageVolume is None else averageVolume
 
 def _getNextContracts(conn, symbol, numContracts, interval='1day'):
     """
@@ -174,23 +213,25 @@ def _getNextContracts(conn, symbol, numContracts, interval='1day'):
 
     return lookupTable
 
-def getTermStructure(symbol:str, interval='1day', lookahead_months=8): 
+def getTermStructure(symbol:str, interval='1day', lookahead_months=8, start_date=None, contracts=None): 
     """
         Gets term structure data for a given symbol
         @param symbol: symbol to get term structure for 
         @param interval: interval to get data for
         @param lookahead_months: number of months to look ahead
+        @param start_date: only read contract bars from the day of start_date on, all bars when None
+        @param contracts: contracts to build from (_getNextContracts), looked up when None
         @return: dataframe of term structure data: [date, close1, close2, ...]
     """
     
     symbol = symbol.upper() # read in pxhistory for next n contracts 
     with db.sqlite_connection(dbpath_futures) as conn_futures:
-        lookupTable = _getNextContracts(conn_futures, symbol, lookahead_months, interval)
+        lookupTable = _getNextContracts(conn_futures, symbol, lookahead_months, interval) if contracts is None else contracts
         # create list of pxHistory dataframes
         termStructure_raw = []
         # get price history for each relevant contract 
         for index, row in lookupTable.iterrows():
-            pxHistory = db.getTable(conn_futures, row['name'], is_pxhistory = True)
+            pxHistory = db.getTable(conn_futures, row['name'], is_pxhistory = True, start_date=start_date)
             # set index to date column
             pxHistory.set_index('date', inplace=True)
             # rename close column
@@ -210,75 +251,67 @@ def getTermStructure(symbol:str, interval='1day', lookahead_months=8):
     return termStructure.reset_index(drop=True)
 
 def get_term_structure_v2(symbol, interval, expiry_table):
+    """
+        Builds term structure data over the dates of the expiry table
+        @return: dataframe indexed by the front month's bar dates: [month1, month2, ...] close of the contract
+            that is month i on that date
+    """
     available_data = _get_available_term_structure_data(symbol, interval, expiry_table)
     month_columns = [col for col in available_data.columns if col.startswith('month')]
-    unique_expiries = available_data[month_columns].stack().unique().strftime('%Y%m%d')
 
-    # create dict of pxhistories
+    # long format: one row per (date, month forward) with the expiry of the contract that is that month
+    contract_months = available_data.melt(id_vars='date', value_vars=month_columns, var_name='month', value_name='expiry').dropna(subset=['expiry'])
+    contract_months['session'] = contract_months['date'].dt.normalize()
+    contract_months['expiry'] = contract_months['expiry'].dt.strftime('%Y%m%d')
+
+    # stack the pxHistory of every contract on the curve: (expiry, date, close)
     with db.sqlite_connection(dbpath_futures) as conn_futures:
-        pxHistory_dict = {expiry: db.getTable(conn_futures, '%s_%s_%s'%(symbol, expiry, interval), is_pxhistory=True) for expiry in unique_expiries}
-        # make sure date is set as index for each pxHistory
-        for key in pxHistory_dict.keys():
-            pxHistory_dict[key]['date_only'] = pxHistory_dict[key]['date'].dt.date
-            pxHistory_dict[key].set_index('date', inplace=True)
-
-    columns = [f'month{i+1}' for i in range(0, 8)]
-    # columns.insert(0, 'date')
-    term_structure = pd.DataFrame(columns=columns)
-    _term_structure = pd.DataFrame(columns=columns)
-    for index, row in available_data.iterrows():
-        for col in term_structure.columns :
-            if col != 'date':
-                # get contract expiry date needed for the current date and month forward  
-                current_expiry = row[col].date().strftime('%Y%m%d')
-                
-                # select the contract, and filter its pxHistory by current date 
-                filtered_pxHistory = pxHistory_dict[current_expiry].loc[pxHistory_dict[current_expiry]['date_only'] == row['date'].date() ]
-                
-                # append pld['close'] to terms structure col 
-                _term_structure[col] = filtered_pxHistory['close']
-                
-        term_structure = term_structure._append(_term_structure)
-        _term_structure = pd.DataFrame(columns=columns)
-
-    return term_structure
-
-def saveTermStructure(termStructure):
+        pxHistory = pd.concat([
+            db.getTable(conn_futures, '%s_%s_%s'%(symbol, expiry, interval), is_pxhistory=True)[['date', 'close']].assign(expiry=expiry)
+            for expiry in contract_months['expiry'].unique()], ignore_index=True)
+    pxHistory = pxHistory.drop_duplicates(subset=['expiry', 'date'], keep='last')
+    pxHistory['session'] = pxHistory['date'].dt.normalize()
+
+    # one join matches every bar to the months its contract covers on that session, then pivot months to columns
+    term_structure = contract_months[['session', 'month', 'expiry']].merge(pxHistory, on=['expiry', 'session'])
+    term_structure = term_structure.pivot(index='date', columns='month', values='close').reindex(columns=month_columns)
+    term_structure.columns.name = None
+
+    # rows are the bars of the front month contract
+    return term_structure.loc[term_structure['month1'].notna()]
+
+def saveTermStructure(termStructure, overwrite_from=None):
     """
         Save term structure data to local db
+        - Rows dated on or after <overwrite_from> replace stored rows, earlier dates are only added when not stored yet
         - Handles duplicate records in input df <termStructure>
     """
     # set the tablename for insertion 
-    dbpath_termstructure = config.dbname_termstructure
-    tablename = '%s_%s'%(termStructure['symbol'][0], termStructure['interval'][0])
+    tablename = '%s_%s'%(termStructure['symbol'].iloc[0], termStructure['interval'].iloc[0])
 
-    # filter out existing records if termstructure data already exists 
+    # format termstructure dataframe for insertion 
+    termStructure = termStructure.drop(columns=['symbol', 'interval']).drop_duplicates(subset='date', keep='last')
+
+    # upsert by date, the db skips the dates we already have 
     with db.sqlite_connection(dbpath_termstructure) as conn:
-        # get tablenames in db 
-        sql_tableNames = "SELECT name FROM sqlite_master WHERE type='table'"
-        tableNames = pd.read_sql(sql_tableNames, conn)['name'].tolist()
-        # filter out duplicates  
-        if tablename in tableNames:
-            ts_db = db.getTable(conn, tablename)
-            termStructure = termStructure.loc[~termStructure['date'].isin(ts_db['date'])].copy()
-    
+        written = db.upsert_termstructure(conn, termStructure, tablename, overwrite_from=overwrite_from)
+
     # handle case where we don't have any new term structure data to update
-    if termStructure.empty:
+    if written == 0:
         print('%s: [green]Termstructure data up to date for %s [/green]'%(pd.Timestamp.today(), tablename))
         return
-    
-    # format termstructure dataframe for insertion 
-    termStructure.drop(columns=['symbol', 'interval'], inplace=True)
+    print('%s: [green]Updated term structure data for %s (%s rows)[/green]'%(pd.Timestamp.today(), tablename, written))
 
-    # save termstructure to db 
-    with db.sqlite_connection(dbpath_termstructure) as conn:
-         termStructure.to_sql(tablename, conn, if_exists='append', index=False)
-         db._removeDuplicates(conn, tablename)
-    print('%s: [green]Updated term structure data for %s[/green]'%(pd.Timestamp.today(), tablename))
+def _get_contracts_signature(contracts):
+    """
+        Identifies the contracts a term structure is built from, changes when a contract rolls off or gets backfilled
+    """
+    return '|'.join('%s:%s'%(row['name'], row['firstRecordDate']) for _, row in contracts.iterrows())
 
-def update_term_structure_data(symbol=None):
+def update_term_structure_data(symbol=None, rebuild=False):
     """ 
         Updates term structure data for all symbols being tracked in the db 
+        - reads contract bars from the last stored date on, unless <rebuild> or the contracts have changed
     """
     if symbol:
         symbols = [symbol.upper()]
@@ -289,13 +322,25 @@ def update_term_structure_data(symbol=None):
         lookahead_months = config.futures_symbol_metadata.get(symbol_i, {}).get('lookahead_months', 8)
         for interval in trackedIntervals:
             interval_clean = interval.replace(' ', '')
+            tablename = '%s_%s'%(symbol_i, interval_clean)
             try:
-                x = getTermStructure(symbol_i, interval=interval_clean, lookahead_months=lookahead_months)
+                with db.sqlite_connection(dbpath_futures) as conn_futures:
+                    contracts = _getNextContracts(conn_futures, symbol_i, lookahead_months, interval_clean)
+                signature = _get_contracts_signature(contracts)
+                with db.sqlite_connection(dbpath_termstructure) as conn:
+                    last_date = db.get_last_date(conn, tablename)
+                    metadata = db.get_termstructure_metadata(conn, tablename, config.table_name_termstructure_metadata)
+
+                # rebuild from every bar when the contracts changed, otherwise read from the last stored date on 
+                incremental = not rebuild and last_date is not None and metadata is not None and metadata['contracts'] == signature
+                x = getTermStructure(symbol_i, interval=interval_clean, lookahead_months=lookahead_months, start_date=last_date if incremental else None, contracts=contracts)
                 if x.empty:
                     continue
                 exchange = config.exchange_mapping.get(symbol_i, 'NYSE')
                 cdi._check_for_missing_dates_in_timeseries(x, exchange=exchange)
-                saveTermStructure(x)
+                saveTermStructure(x, overwrite_from=last_date)
+                with db.sqlite_connection(dbpath_termstructure) as conn:
+                    db.upsert_termstructure_metadata(conn, tablename, signature, config.table_name_termstructure_metadata)
             except Exception as e:
                 print(f'[yellow]Skipping {symbol_i}-{interval_clean}: {e}[/yellow]')
 
@@ -323,6 +368,8 @@ if __name__ == '__main__':
         if argv[1] == 'csvupdate':
             vix_ts_raw = getVixTermstructureFromCSV()
             saveTermStructure(vix_ts_raw)
+        elif argv[1] == 'rebuild':
+            update_term_structure_data(rebuild=True)
         elif argv[1] == 'test':
             _generate_futures_contract_expiry_table('VIX', pd.Timestamp.today() - pd.DateOffset(months=24), pd.Timestamp.today(), 9)
     
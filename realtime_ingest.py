@@ -0,0 +1,208 @@
+"""
+Streams live bars into the local db.
+
+Keeps keepUpToDate=True historical subscriptions open for the equity watchlist and the
+front-month contract of each futures watchlist symbol. Every completed bar is buffered and
+flushed through the batched writer (interface_localDB.save_history_batch), which also advances
+the lookup table, so the nightly updateRecords pass only has to pick up what was missed
+while the stream was down.
+
+    - subscriptions seed with a short window (config.streaming_seed_duration) so the day's
+      earlier bars are written too
+    - subscriptions are capped at config.streaming_max_subscriptions, high priority symbols first
+    - dropped sessions are reconnected and all subscriptions re-opened; 1101 (data lost) also
+      triggers a resubscribe
+
+Usage:
+    python realtime_ingest.py
+"""
+from ib_insync import Index, Stock
+from datetime import datetime
+from rich import print
+
+import pandas as pd
+import sqlite3
+
+import config
+import interface_ibkr as ibkr
+import interface_localDB as db
+import ibkr_connection_pool
+import maintainHistoricalData_futures_v2 as futures_v2
+from maintainHistoricalData_futures import _getWatchlist
+
+_dbName_index = config.dbname_stock
+_dbName_futures = config.dbname_futures
+
+def _now():
+    return datetime.now().strftime('%H:%M:%S')
+
+def _bar_to_history(bar, subscription):
+    """
+        Formats one completed BarData into a saveHistoryToDB frame
+    """
+    history = ibkr.bars_to_frame([bar])
+    history['symbol'] = subscription['symbol']
+    history['interval'] = subscription['interval'].replace(' ', '')
+    if subscription['type'] == 'future':
+        history['lastTradeDate'] = subscription['contract'].lastTradeDateOrContractMonth
+    return history
+
+def _subscription_tablename(subscription):
+    middle = subscription['contract'].lastTradeDateOrContractMonth if subscription['type'] == 'future' else subscription['type']
+    return '%s_%s_%s' % (subscription['symbol'], middle, subscription['interval'].replace(' ', ''))
+
+def _get_equity_targets():
+    watchlist = _getWatchlist(config.watchlist_main)
+    targets = []
+    for symbol in watchlist['symbol'].tolist():
+        if symbol in config.delisted_symbols:
+            continue
+        exchange = config.exchange_mapping_stocks.get(symbol, 'SMART')
+        currency = config.currency_mapping.get(symbol, 'USD')
+        if symbol in config._index:
+            targets.append({'symbol': symbol, 'type': 'index', 'contract': Index(symbol, exchange, currency)})
+        else:
+            targets.append({'symbol': symbol, 'type': 'stock', 'contract': Stock(symbol, exchange, currency)})
+    return targets
+
+def _get_futures_targets(ib):
+    """
+        Returns the front-month (nearest unexpired) contract for each futures watchlist symbol
+    """
+    watchlist = _getWatchlist(config.watchlist_futures)
+    targets = []
+    today = pd.Timestamp.today().strftime('%Y%m%d')
+    for symbol in watchlist['symbol'].tolist():
+        contracts = futures_v2._list_contracts_for_symbol(ib, symbol, lookahead_months=3)
+        contracts = contracts.loc[contracts['expiry'] >= today]
+        if contracts.empty:
+            print('%s: [yellow]No front-month contract found for %s[/yellow]' % (_now(), symbol))
+            continue
+        targets.append({'symbol': symbol, 'type': 'future', 'contract': contracts.iloc[0]['contract']})
+    return targets
+
+def build_subscriptions(ib, intervals=None):
+    """
+        Returns the list of subscriptions to open, high priority symbols first, capped at
+        config.streaming_max_subscriptions
+    """
+    intervals = config.streaming_intervals if intervals is None else intervals
+    targets = _get_futures_targets(ib) + _get_equity_targets()
+    targets.sort(key=lambda t: t['symbol'] not in config.HIGH_PRIORITY_SYMBOLS)
+
+    subscriptions = []
+    for target in targets:
+        for interval in intervals:
+            subscriptions.append(dict(target, interval=interval, bars=None, earliestTimestamp=None))
+
+    if len(subscriptions) > config.streaming_max_subscriptions:
+        print('%s: [yellow]Capping live subscriptions at %s of %s[/yellow]' % (_now(), config.streaming_max_subscriptions, len(subscriptions)))
+        subscriptions = subscriptions[:config.streaming_max_subscriptions]
+    return subscriptions
+
+class BarStream:
+    """
+        Owns the live subscriptions and the buffer of completed bars waiting to be written
+    """
+    def __init__(self, ib, subscriptions):
+        self.ib = ib
+        self.subscriptions = subscriptions
+        self.pending = []
+        self.needs_resubscribe = False
+        self.ib.errorEvent += self._on_error
+
+    def _on_error(self, reqId, errorCode, errorString, contract=None):
+        # 1101: connectivity restored but market data was lost, subscriptions must be re-opened
+        if errorCode == 1101:
+            self.needs_resubscribe = True
+
+    def _on_bar_update(self, bars, hasNewBar, subscription):
+        # a new bar opened, so the one before it is complete
+        if hasNewBar and len(bars) > 1:
+            self.pending.append(_bar_to_history(bars[-2], subscription))
+
+    def subscribe(self):
+        for subscription in self.subscriptions:
+            if subscription['earliestTimestamp'] is None:
+                subscription['earliestTimestamp'] = ibkr.getEarliestTimeStamp(self.ib, subscription['contract'])
+
+            bars = ibkr._request_with_resume(self.ib, 'reqHistoricalData', lambda: self.ib.reqHistoricalData(
+                subscription['contract'],
+                endDateTime='',
+                durationStr=config.streaming_seed_duration,
+                barSizeSetting=subscription['interval'],
+                whatToShow='TRADES',
+                useRTH=False,
+                formatDate=1,
+                keepUpToDate=True),
+                'subscribing to live %s bars for %s' % (subscription['interval'], subscription['symbol']),
+                subscription['contract'])
+            if bars is None:
+                continue
+
+            # seed bars are complete except the last, which is still forming
+            self.pending.extend(_bar_to_history(bar, subscription) for bar in list(bars)[:-1])
+            bars.updateEvent += lambda bars, hasNewBar, subscription=subscription: self._on_bar_update(bars, hasNewBar, subscription)
+            subscription['bars'] = bars
+            print('%s: [green]Streaming %s %s[/green]' % (_now(), subscription['symbol'], subscription['interval']))
+        self.needs_resubscribe = False
+
+    def unsubscribe(self):
+        for subscription in self.subscriptions:
+            if subscription['bars'] is not None:
+                try:
+                    self.ib.cancelHistoricalData(subscription['bars'])
+                except Exception:
+                    pass
+                subscription['bars'] = None
+
+    def flush(self):
+        """
+            Writes buffered bars, one write per table, equities and futures to their own db
+        """
+        if not self.pending:
+            return 0
+        # bars stay buffered until written, a failed write (e.g. database is locked) is retried next flush
+        pending = list(self.pending)
+        earliest = {_subscription_tablename(s): s['earliestTimestamp'] for s in self.subscriptions}
+
+        futures = [h for h in pending if 'lastTradeDate' in h.columns]
+        equities = [h for h in pending if 'lastTradeDate' not in h.columns]
+        if equities:
+            with db.sqlite_connection(_dbName_index) as conn:
+                db.save_history_batch(equities, conn, earliest)
+        if futures:
+            with db.sqlite_connection(_dbName_futures) as conn:
+                db.save_history_batch(futures, conn, earliest)
+        del self.pending[:len(pending)]
+        return len(pending)
+
+    def run(self):
+        self.subscribe()
+        while True:
+            self.ib.sleep(config.streaming_flush_seconds)
+            try:
+                if not self.ib.isConnected() or self.needs_resubscribe:
+                    self.flush()
+                    ibkr._ensure_connected(self.ib, 'live bar streaming')
+                    self.unsubscribe()
+                    self.subscribe()
+                num_bars = self.flush()
+                if num_bars:
+                    print('%s: Wrote %s live bars' % (_now(), num_bars))
+            except ibkr.IbkrDisconnectedError as e:
+                print('%s: [red]IBKR unavailable (%s), retrying[/red]' % (_now(), e))
+            except sqlite3.Error as e:
+                print('%s: [red]Could not write live bars (%s), keeping %s buffered[/red]' % (_now(), e, len(self.pending)))
+
+def main():
+    with ibkr_connection_pool.lease() as ib:
+        stream = BarStream(ib, build_subscriptions(ib))
+        try:
+            stream.run()
+        finally:
+            stream.flush()
+            stream.unsubscribe()
+
+if __name__ == '__main__':
+    main()
@@ -8,6 +8,7 @@ sys.path.append(config.path_lib_analysis_strategies)
 # from strategy_implementation.strategy_vix3m_vix_ratio import *
 
 import interface_ibkr as ib
+import ibkr_connection_pool
 import interface_localDB as db
 import matplotlib.pyplot as plt
 import numpy as np
@@ -316,11 +317,10 @@ def getRealtime_v5():
         # p2 = Ticker(con2)
         # p2.last = np.random.randint(12, 15)
 
-        ibkr = ib.setupConnection() 
-        symbol_bars = ib.getBars(ibkr, symbol = symbol, interval = '1 min', lookback = '45000 S')
-        symbol2_bars = ib.getBars(ibkr, symbol = symbol2, interval = '1 min', lookback = '45000 S')
-        ibkr.sleep(1)
-        ibkr.disconnect()
+        # reuse a pooled session across frames instead of reconnecting every frame
+        with ibkr_connection_pool.lease() as ibkr:
+            symbol_bars = ib.getBars(ibkr, symbol = symbol, interval = '1 min', lookback = '45000 S')
+            symbol2_bars = ib.getBars(ibkr, symbol = symbol2, interval = '1 min', lookback = '45000 S')
         symbol_bars.set_index('date', inplace=True)
         symbol2_bars.set_index('date', inplace=True)
         merged = symbol_bars.merge(symbol2_bars, on='date', suffixes=('_vix3m', '_vix'))
@@ -394,11 +394,10 @@ def getRealtime_v6():
         # p2 = Ticker(con2)
         # p2.last = np.random.randint(12, 15)
 
-        ibkr = ib.setupConnection() 
-        symbol_bars = ib.getBars(ibkr, symbol = symbol, interval = '1 min', lookback = '45000 S')
-        symbol2_bars = ib.getBars(ibkr, symbol = symbol2, interval = '1 min', lookback = '45000 S')
-        ibkr.sleep(1)
-        ibkr.disconnect()
+        # reuse a pooled session across frames instead of reconnecting every frame
+        with ibkr_connection_pool.lease() as ibkr:
+            symbol_bars = ib.getBars(ibkr, symbol = symbol, interval = '1 min', lookback = '45000 S')
+            symbol2_bars = ib.getBars(ibkr, symbol = symbol2, interval = '1 min', lookback = '45000 S')
         symbol_bars.set_index('date', inplace=True)
         symbol2_bars.set_index('date', inplace=True)
         merged = symbol_bars.merge(symbol2_bars, on='date', suffixes=('_vix3m', '_vix'))